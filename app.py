@@ -1,24 +1,39 @@
-# Caché simple en memoria: clave (md5_imagen + disfraz) -> ruta resultante
-EDIT_CACHE = {}
-
 def _read_upload_bytes_from_url(image_url: str):
     if not image_url.startswith('/uploads/'):
         raise RuntimeError('image_url no apunta a uploads/')
     filename = image_url.split('/uploads/', 1)[1]
     src_path = os.path.join(UPLOAD_FOLDER, filename)
-    if not os.path.isfile(src_path):
+    # Subida hecha en otra instancia: traerla del almacén compartido
+    if not os.path.isfile(src_path) and not _ensure_local('uploads', filename):
         raise FileNotFoundError(f'No existe el archivo fuente: {src_path}')
-    with open(src_path, 'rb') as f:
+    with METRICS.stage('upload_read'), open(src_path, 'rb') as f:
         return f.read(), src_path
 
-def _digest_image_and_disfraz(img_bytes: bytes, disfraz: str, extra: str = "", thematic_bg: str = "") -> str:
-    h = hashlib.md5()
-    h.update(img_bytes)
+def _upload_hash_from_url(image_url: str) -> str:
+    # Hash de contenido de la subida: del índice (o del nombre canónico) sin releer la imagen;
+    # sólo las subidas antiguas con nombre uuid se leen y se hashean
+    filename = image_url.split('/uploads/', 1)[1] if image_url.startswith('/uploads/') else ''
+    entry = UPLOAD_INDEX.get_by_filename(filename) if filename else None
+    if entry:
+        return entry['hash']
+    img_bytes, _src_path = _read_upload_bytes_from_url(image_url)
+    return content_hash(img_bytes)
+
+def _digest_image_and_disfraz(image_hash: str, disfraz: str, extra: str = "", thematic_bg: str = "", model: str = "",
+                              version: str = "") -> str:
+    # Clave de la caché de resultados: hash de la imagen + disfraz (y su versión en el registro) +
+    # prompt extra + modo de fondo + modelo
+    h = hashlib.blake2b(digest_size=16)
+    h.update(image_hash.encode('utf-8'))
     h.update(disfraz.encode('utf-8'))
+    if version:
+        h.update(version.encode('utf-8'))
     if extra:
         h.update(extra.encode('utf-8'))
     if thematic_bg:
         h.update(thematic_bg.encode('utf-8'))
+    if model:
+        h.update(model.encode('utf-8'))
     return h.hexdigest()
 
 def _extract_retry_delay_seconds(err: Exception) -> int | None:
@@ -33,38 +48,90 @@ def _extract_retry_delay_seconds(err: Exception) -> int | None:
     return None
 
 import os
-import uuid
 import base64
 import time
+import json
 import hashlib
+import hmac
+import secrets
+import threading
+import click
 from mimetypes import guess_type
-from io import BytesIO
-from PIL import Image
 from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, abort, g, redirect, request, jsonify, send_from_directory
+from werkzeug.security import safe_join
+from urllib.parse import quote
 from dotenv import load_dotenv
-from werkzeug.utils import secure_filename
-
-# Integración opcional con Firestore (soporte de proyecto y base nombrada vía entorno)
-db = None
-try:
-    from google.cloud import firestore  # type: ignore
-    _fs_project = os.environ.get('FIRESTORE_PROJECT_ID')
-    _fs_database = os.environ.get('FIRESTORE_DATABASE_ID')
-    if _fs_project or _fs_database:
-        kwargs = {}
-        if _fs_project:
-            kwargs['project'] = _fs_project
-        if _fs_database:
-            kwargs['database'] = _fs_database
-        db = firestore.Client(**kwargs)
-        print(f"[Firestore] Cliente inicializado con project={kwargs.get('project')} database={kwargs.get('database')}")
-    else:
-        db = firestore.Client()
-        print(f"[Firestore] Cliente inicializado con configuración por defecto: project={getattr(db, 'project', None)}")
-except Exception as e:
-    # Si no hay credenciales o librería, seguimos sin DB
-    print(f"[Aviso] Firestore no inicializado: {e}")
+
+from jobs import TERMINAL_STATES, create_job_queue, public_job
+from result_cache import content_hash, create_result_cache, hash_from_filename
+from singleflight import create_single_flight
+from encoding import result_budget_bytes
+from image_pool import ImagePoolBusy, create_image_pool
+# Tareas del pool de procesos: image_worker es también el módulo principal de sus hijos
+from image_worker import encode_result, normalize_upload, write_derivatives
+from ingest import InvalidImage, UploadIndex, UploadTooLarge, stream_to_temp, upload_max_bytes, upload_max_side
+from model_clients import create_model_clients
+from metrics import StageTimer, create_metrics, server_timing_from_ms
+from image_backends import create_degraded_backend, create_image_backend
+from costumes import POEM_PROMPT, create_costume_registry
+from prewarm import create_prewarmer
+from janitor import create_janitor
+from storage import create_blob_store
+from writebehind import create_write_behind
+from poems import create_poem_service
+from batch import FirestoreBatchWriter, run_batch, summarize
+from ratelimit import PRIORITY_BATCH, PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, create_rate_limiter
+from gallery_index import GalleryIndex, decode_cursor, encode_cursor
+from imaging import (DERIVATIVE_WIDTHS, DERIVED_DIRNAME, FULL_WIDTH, avif_enabled, derivatives_ready,
+                     derived_name, pick_derivative, srcset_for)
+
+# Integración opcional con Firestore (soporte de proyecto y base nombrada vía entorno).
+# El cliente se crea en el primer uso: importar google.cloud.firestore y resolver credenciales
+# no retrasa el arranque del contenedor
+_db = None
+_db_ready = False
+_db_lock = threading.Lock()
+
+
+def get_db():
+    """Cliente de Firestore (creado una vez por proceso) o None si no está disponible."""
+    global _db, _db_ready
+    if _db_ready:
+        return _db
+    with _db_lock:
+        if _db_ready:
+            return _db
+        try:
+            from google.cloud import firestore  # type: ignore
+            _fs_project = os.environ.get('FIRESTORE_PROJECT_ID')
+            _fs_database = os.environ.get('FIRESTORE_DATABASE_ID')
+            if _fs_project or _fs_database:
+                kwargs = {}
+                if _fs_project:
+                    kwargs['project'] = _fs_project
+                if _fs_database:
+                    kwargs['database'] = _fs_database
+                _db = firestore.Client(**kwargs)
+                print(f"[Firestore] Cliente inicializado con project={kwargs.get('project')} database={kwargs.get('database')}")
+            else:
+                _db = firestore.Client()
+                print(f"[Firestore] Cliente inicializado con configuración por defecto: project={getattr(_db, 'project', None)}")
+        except Exception as e:
+            # Si no hay credenciales o librería, seguimos sin DB
+            print(f"[Aviso] Firestore no inicializado: {e}")
+        _db_ready = True
+    return _db
+
+
+def _reset_db_after_fork():
+    # Los canales gRPC del padre no sirven en el hijo: cada worker crea su propio cliente
+    global _db, _db_ready, _db_lock
+    _db, _db_ready, _db_lock = None, False, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_db_after_fork)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
@@ -78,7 +145,294 @@ ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 
 load_dotenv()  # Cargar variables desde .env si existe
 
+# Disfraces (prompts, tema del poema, sonido, versión) desde costumes.json, una vez por proceso
+COSTUMES = create_costume_registry(BASE_DIR)
+
+# Métricas por etapa (histogramas y contadores) para /metrics y la cabecera Server-Timing
+METRICS = create_metrics()
+METRICS.counter('transforms_total', 'Transformaciones por resultado', ('outcome',))
+METRICS.counter('model_calls_total', 'Llamadas a los modelos por resultado', ('model', 'result'))
+
+# Caché persistente y acotada de resultados de IA (compartida entre workers vía SQLite)
+RESULT_CACHE = create_result_cache(RESULTS_FOLDER)
+# Deduplicación de generaciones idénticas en vuelo (hilos del worker y workers del host)
+SINGLE_FLIGHT = create_single_flight(RESULTS_FOLDER)
+# Pool de procesos para decodificar/redimensionar/codificar con Pillow fuera de los hilos de petición
+IMAGE_POOL = create_image_pool()
+# Clientes de los SDK de Gemini reutilizados entre peticiones (uno por SDK/modelo/API key)
+MODEL_CLIENTS = create_model_clients()
+# Cuota de Gemini compartida (token bucket por modelo, pausa global ante 429, prioridad interactiva)
+RATE_LIMITER = create_rate_limiter(BASE_DIR)
+# Backend del modelo de imagen (IMAGE_BACKEND) y modo degradado local si el modelo no responde.
+# El tinte del fake corre en el pool de procesos como el resto del trabajo de Pillow
+_pool_runner = lambda fn, *args: IMAGE_POOL.run(fn, *args, block=True)
+IMAGE_BACKEND = create_image_backend(MODEL_CLIENTS, _pool_runner)
+DEGRADED_BACKEND = create_degraded_backend(_pool_runner)
+if IMAGE_BACKEND is not None and getattr(IMAGE_BACKEND, 'rpm', None):
+    # El fake tiene su propia cuota (FAKE_IMAGE_RPM) salvo que GEMINI_RPM_OVERRIDES diga otra cosa
+    RATE_LIMITER.overrides.setdefault(IMAGE_BACKEND.model, IMAGE_BACKEND.rpm)
+# Almacén de blobs compartido entre instancias (STORAGE_BACKEND); uploads/ y results/ quedan como copia local
+BLOB_STORE = create_blob_store(BASE_DIR)
+# Índice de subidas canónicas (hash, tamaño, dimensiones, mime) y de subidas repetidas
+UPLOAD_INDEX = UploadIndex(UPLOAD_FOLDER)
+# Índice local de la galería para el fallback sin Firestore (paginación por clave, sin listar results/).
+# Con almacén compartido un resultado sin copia local sigue siendo servible: no se descarta del índice
+GALLERY_INDEX = GalleryIndex(RESULTS_FOLDER, verify_files=not BLOB_STORE.shared)
+GALLERY_INDEX.backfill({'.png', '.jpg', '.jpeg', '.gif', '.webp'})
+
+_firestore_refs = {'at': 0.0, 'files': set()}
+_firestore_refs_lock = threading.Lock()
+
+
+def _firestore_result_refs() -> set[str]:
+    """Archivos de results/ que citan los documentos más recientes de Firestore (los que muestra la
+    galería). Se refresca cada JANITOR_FIRESTORE_REFRESH_S; sin Firestore, vacío."""
+    db = get_db()
+    if db is None:
+        return set()
+    try:
+        refresh_s = float(os.environ.get('JANITOR_FIRESTORE_REFRESH_S', '600'))
+        recent = int(os.environ.get('JANITOR_FIRESTORE_RECENT', '500'))
+    except Exception:
+        refresh_s, recent = 600.0, 500
+    with _firestore_refs_lock:
+        if time.time() - _firestore_refs['at'] < refresh_s:
+            return _firestore_refs['files']
+        try:
+            from google.cloud import firestore as _firestore  # type: ignore
+            q = db.collection('transformaciones_halloween') \
+                .order_by('timestamp', direction=_firestore.Query.DESCENDING) \
+                .select(['transformed_image_url']).limit(recent)
+            files = set()
+            for d in q.stream():
+                url = ((d.to_dict() or {}).get('transformed_image_url') or '').strip()
+                if url.startswith('/results/'):
+                    files.add(url.rsplit('/', 1)[-1])
+            _firestore_refs.update(at=time.time(), files=files)
+        except Exception as e:
+            print(f"[Janitor] No se pudieron leer referencias de Firestore: {e}")
+            # Sin la lista nueva, mejor conservar de más: se reintenta en la próxima ventana
+            _firestore_refs['at'] = time.time()
+        return _firestore_refs['files']
+
+
+def _janitor_is_referenced(folder: str, name: str) -> bool:
+    """True si borrar results/<name> perdería una imagen que no tiene otra copia.
+
+    Con el resultado en el almacén compartido la copia local es caché y nada la protege. Sin él la
+    protegen la caché de resultados (acotada por su propio tope), los JANITOR_GALLERY_KEEP resultados
+    más recientes de la galería local y los documentos recientes de Firestore que no llevan la imagen
+    en base64; los que sí la llevan se vuelven a escribir en results/ al listar la galería.
+    """
+    # Las subidas sólo se usan mientras el usuario transforma: las protege JANITOR_MIN_AGE_S
+    if folder != 'results' or _result_durable(name):
+        return False
+    try:
+        gallery_keep = int(os.environ.get('JANITOR_GALLERY_KEEP', '500'))
+    except Exception:
+        gallery_keep = 500
+    if RESULT_CACHE.has_file(name) or GALLERY_INDEX.has_file(name, newest=max(1, gallery_keep)):
+        return True
+    if name not in _firestore_result_refs():
+        return False
+    try:
+        return os.path.getsize(os.path.join(RESULTS_FOLDER, name)) > FIRESTORE_B64_MAX_BYTES
+    except OSError:
+        return False
+
+
+def _janitor_on_delete(folder: str, name: str) -> int:
+    """Limpia índices y derivados de un archivo borrado. Devuelve los bytes extra liberados."""
+    if folder == 'uploads':
+        UPLOAD_INDEX.forget_file(name)
+        return 0
+    RESULT_CACHE.forget_file(name)
+    if not BLOB_STORE.shared:
+        # Con almacén compartido la URL /results/<nombre> sigue sirviéndose desde el almacén
+        GALLERY_INDEX.remove_file(name)
+    freed = 0
+    result_hash = hash_from_filename(name)
+    if result_hash:
+        derived = os.path.join(RESULTS_FOLDER, DERIVED_DIRNAME)
+        for width in (*DERIVATIVE_WIDTHS, FULL_WIDTH):
+            for fmt in ('webp', 'avif'):
+                path = os.path.join(derived, derived_name(result_hash, width, fmt))
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+        try:
+            os.remove(os.path.join(derived, f"{result_hash}.ok"))
+        except FileNotFoundError:
+            pass
+    return freed
+
+
+# Retención de uploads/ y results/ (edad y tope de bytes por carpeta) en un hilo por worker;
+# los archivos escritos se registran al vuelo para no tener que recorrer los directorios
+JANITOR = create_janitor(UPLOAD_FOLDER, RESULTS_FOLDER, os.path.join(RESULTS_FOLDER, DERIVED_DIRNAME),
+                         is_referenced=_janitor_is_referenced, on_delete=_janitor_on_delete)
+METRICS.gauge('storage_bytes', 'Bytes registrados por carpeta', lambda: JANITOR.stats()['bytes'])
+METRICS.gauge('janitor_reclaimed_bytes', 'Bytes liberados por el conserje', lambda: JANITOR.stats()['reclaimed_bytes'])
+METRICS.gauge('storage_transfers', 'Transferencias con el almacén de blobs',
+              lambda: {k: v for k, v in BLOB_STORE.stats().items() if k in ('put', 'multipart', 'fetch', 'fetch_miss', 'errors')})
+
+# Escrituras de Firestore fuera del hilo de la petición: WriteBatch por tamaño/tiempo, reintentos con
+# backoff y journal en results/ si Firestore no responde
+FIRESTORE_WRITER = create_write_behind(get_db, RESULTS_FOLDER)
+METRICS.gauge('firestore_write_behind', 'Documentos de Firestore en cola, escritos y en journal',
+              lambda: {k: v for k, v in FIRESTORE_WRITER.stats().items()
+                       if k in ('pending', 'written', 'commits', 'failed_commits', 'spilled', 'replayed', 'dropped',
+                                'invalid')})
+
+STORED_FOLDERS = {'uploads': UPLOAD_FOLDER, 'results': RESULTS_FOLDER}
+
+
+def _storage_redirect() -> bool:
+    return os.environ.get('STORAGE_REDIRECT', '').strip().lower() in ('1', 'true', 'yes')
+
+
+# Resultados que este proceso ya sabe en el almacén compartido (acotado): evita un HEAD por documento
+_published_results: dict[str, None] = {}
+_published_lock = threading.Lock()
+PUBLISHED_RESULTS_MAX = 4096
+
+
+def _remember_published(filename: str) -> None:
+    with _published_lock:
+        _published_results[filename] = None
+        while len(_published_results) > PUBLISHED_RESULTS_MAX:
+            _published_results.pop(next(iter(_published_results)))
+
+
+def _publish_stored(folder: str, filename: str) -> bool:
+    """Sube al almacén compartido un archivo recién escrito en uploads/ o results/.
+
+    Devuelve True si quedó en el almacén compartido. Si falla (o no hay almacén compartido), el
+    archivo sólo se sirve desde esta instancia; otra instancia responderá 404.
+    """
+    if not BLOB_STORE.shared:
+        return False
+    # Nombres por contenido: inmutables, cacheables para siempre en el bucket / CDN
+    immutable = hash_from_filename(filename) is not None
+    try:
+        with METRICS.stage('storage_put'):
+            BLOB_STORE.put_file(f"{folder}/{filename}", os.path.join(STORED_FOLDERS[folder], filename),
+                                cache_control='public, max-age=31536000, immutable' if immutable else None)
+    except Exception as e:
+        print(f"[Storage] No se pudo subir {folder}/{filename}: {e}")
+        return False
+    if folder == 'results':
+        _remember_published(filename)
+    return True
+
+
+def _result_durable(filename: str) -> bool:
+    """True si results/<filename> está en el almacén compartido, es decir, lo ven todas las instancias."""
+    if not BLOB_STORE.shared:
+        return False
+    with _published_lock:
+        if filename in _published_results:
+            return True
+    try:
+        found = BLOB_STORE.exists(f"results/{filename}")
+    except Exception as e:
+        print(f"[Storage] No se pudo consultar results/{filename}: {e}")
+        return False
+    if found:
+        _remember_published(filename)
+    return found
+
+
+# Firestore limita cada documento a 1 MiB; el base64 ocupa 4/3 de los bytes
+FIRESTORE_B64_MAX_BYTES = 700 * 1024
+
+
+def _record_image_fields(transformed_image_url: str) -> dict:
+    """Campos de imagen del documento de Firestore para un resultado.
+
+    Con el archivo en el almacén compartido basta la URL por contenido. Si sólo está en el disco de
+    esta instancia, el documento lleva además los bytes en base64: es la única copia que ven las demás
+    instancias (la galería los vuelve a escribir en su results/ al listarlos).
+    """
+    if not transformed_image_url.startswith('/results/'):
+        return {'result_hash': None, 'transformed_mime': None}
+    filename = transformed_image_url.rsplit('/', 1)[-1]
+    fields = {'result_hash': hash_from_filename(filename), 'transformed_mime': guess_type(filename)[0] or 'image/webp'}
+    if _result_durable(filename):
+        return fields
+    try:
+        path = RESULT_CACHE.path_for(filename)
+        if os.path.getsize(path) <= FIRESTORE_B64_MAX_BYTES:
+            with open(path, 'rb') as f:
+                fields['transformed_image_b64'] = base64.b64encode(f.read()).decode('ascii')
+        else:
+            print(f"[Aviso] {filename} excede el límite de Firestore; el documento sólo lleva la URL")
+    except Exception as e:
+        print(f"[Aviso] No se pudo leer {filename} para el documento: {e}")
+    return fields
+
+
+def _ensure_local(folder: str, filename: str) -> bool:
+    """True si uploads/<f> o results/<f> está en disco, trayéndolo del almacén si hace falta."""
+    path = safe_join(STORED_FOLDERS[folder], filename)
+    if path is None:
+        return False
+    if os.path.isfile(path):
+        return True
+    if not BLOB_STORE.shared or filename.startswith('.'):
+        return False
+    try:
+        with METRICS.stage('storage_fetch'):
+            if not BLOB_STORE.fetch(f"{folder}/{filename}", path):
+                return False
+    except Exception as e:
+        print(f"[Storage] No se pudo traer {folder}/{filename}: {e}")
+        return False
+    # La copia local es caché: la recorta el conserje como cualquier otro archivo
+    JANITOR.track(folder, filename, os.path.getsize(path))
+    return True
+
+# Gauges leídos al exportar /metrics
+METRICS.gauge('image_pool_pending', 'Tareas en el pool de imágenes', lambda: IMAGE_POOL.stats()['pending'])
+METRICS.gauge('rate_limit_waiting', 'Peticiones esperando cupo por modelo', lambda: RATE_LIMITER.stats()['waiting'])
+METRICS.gauge('result_cache_bytes', 'Bytes en la caché de resultados', lambda: RESULT_CACHE.stats()['bytes'])
+
 app = Flask(__name__, static_folder=STATIC_FOLDER)
+# Werkzeug corta el cuerpo de la petición al superar el límite (413) antes de escribirlo entero
+app.config['MAX_CONTENT_LENGTH'] = upload_max_bytes() + 1024 * 1024
+# X-Sendfile (Apache/lighttpd): el servidor web envía el archivo en lugar del worker
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').strip().lower() in ('1', 'true', 'yes')
+
+@app.before_request
+def start_request_timer():
+    # Etapas medidas durante la petición (p. ej. consulta de la galería) van a Server-Timing
+    timer = StageTimer(METRICS, request.endpoint or 'unknown')
+    g.request_timer = timer
+    METRICS.activate(timer)
+    # Hilo de retención de este worker: se arranca con la primera petición (no sobrevive a un fork)
+    JANITOR.ensure_started()
+    # Journal de Firestore que dejó otra ejecución: reescribirlo sin esperar a la próxima escritura
+    FIRESTORE_WRITER.ensure_started()
+
+
+@app.after_request
+def add_server_timing(response):
+    timer = g.get('request_timer')
+    if timer is not None:
+        if 'Server-Timing' not in response.headers:
+            response.headers['Server-Timing'] = timer.server_timing()
+        METRICS.observe('http_request_seconds', time.perf_counter() - timer.started,
+                        endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def clear_request_timer(_exc):
+    METRICS.activate(None)
+
 
 # Cabeceras de seguridad básicas
 @app.after_request
@@ -88,8 +442,10 @@ def add_security_headers(response):
         response.headers['X-Content-Type-Options'] = 'nosniff'
         response.headers['Referrer-Policy'] = 'no-referrer'
         # CSP: permitir Google Fonts y el CDN de SweetAlert2 (jsDelivr) para scripts
+        # Con almacén compartido las imágenes pueden venir del bucket (redirección o URL pública)
+        img_origins = ''.join(f" {o}" for o in BLOB_STORE.origins())
         csp = "default-src 'self'; " \
-              "img-src 'self' data: blob:; " \
+              f"img-src 'self' data: blob:{img_origins}; " \
               "media-src 'self' data:; " \
               "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com; " \
               "font-src 'self' https://fonts.gstatic.com; " \
@@ -101,40 +457,57 @@ def add_security_headers(response):
     return response
 
 
+@app.errorhandler(ImagePoolBusy)
+def handle_image_pool_busy(e):
+    # Back-pressure: el pool de imágenes está lleno; el cliente debe reintentar
+    response = jsonify({'error': str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@app.errorhandler(413)
+def handle_request_too_large(e):
+    return jsonify({'error': f'La imagen supera el máximo de {upload_max_bytes() // (1024 * 1024)} MB'}), 413
+
+
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # ---- Poem generation helper (Gemini) ----
-def _generate_poem_lines(display_name: str, disfraz: str) -> list[str]:
+def _poem_fallback(display_name: str, disfraz: str) -> list[str]:
     name = (display_name or "una sombra").strip()
-    theme = (disfraz or "fantasma").strip()
-    base_fallback = [
+    theme = COSTUMES.poem_theme(disfraz)
+    return [
         f"{name} camina entre susurros y luna: la noche aprende tu nombre.",
         f"Bajo el signo de {theme}, vibra el aire con metáforas encendidas.",
         "La oscuridad te saluda con elegancia: todo brilla un poco distinto.",
     ]
+
+
+def _generate_poem_lines(display_name: str, disfraz: str, timeout_s: float | None = None) -> list[str] | None:
+    # Devuelve None si no hay IA o falla: POEMS usa entonces el poema base (y no lo cachea)
+    name = (display_name or "una sombra").strip()
+    theme = COSTUMES.poem_theme(disfraz)
+    base_fallback = _poem_fallback(display_name, disfraz)
     api_key = os.environ.get('GEMINI_API_KEY', '').strip()
     if not api_key:
-        return base_fallback
+        return None
     try:
-        import google.generativeai as genai  # type: ignore
-        genai.configure(api_key=api_key)
         model_name = os.environ.get('GEMINI_TEXT_MODEL', 'gemini-1.5-flash')
-        model = genai.GenerativeModel(model_name)
-        prompt = (
-            "Actúa como poeta en español latino. Escribe exactamente 3 versos libres, uno por línea, "
-            "sin numeración ni comillas, máximo 300 caracteres por verso. Tema: Halloween y la figura "
-            f"‘{theme}’. Integra el nombre ‘{name}’ de forma sutil y elegante (no lo repitas en todas las líneas). "
-            "Tono cinematográfico y metáforas sensoriales. Evita clichés obvios, rimas forzadas, emojis y signos innecesarios. "
-            "Devuélveme solo las tres líneas separadas por saltos de línea."
-        )
-        res = model.generate_content(prompt)
+        model = MODEL_CLIENTS.generative_model(model_name, api_key)
+        prompt = POEM_PROMPT.format(theme=theme, name=name)
+        # Corre en el pool de poemas: sus etapas (espera de cuota, llamada) van al ámbito 'poem'
+        with METRICS.timer('poem'):
+            res = _call_with_quota(model_name, PRIORITY_INTERACTIVE,
+                                   lambda: model.generate_content(prompt, request_options={'timeout': timeout_s} if timeout_s else None),
+                                   attempts=1, timeout=timeout_s)
         text = (getattr(res, 'text', '') or '').strip()
         if not text:
             # algunos SDK exponen output_text
             text = (getattr(res, 'output_text', '') or '').strip()
         if not text:
-            return base_fallback
+            return None
         lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
         # Normalizar a exactamente 3 líneas
         if len(lines) >= 3:
@@ -143,7 +516,11 @@ def _generate_poem_lines(display_name: str, disfraz: str) -> list[str]:
             lines.append(base_fallback[len(lines)])
         return lines
     except Exception as _:
-        return base_fallback
+        return None
+
+
+# Poema en paralelo con la imagen, con plazo (POEM_TIMEOUT_S) y caché por (display_name, disfraz)
+POEMS = create_poem_service(_generate_poem_lines, _poem_fallback)
 
 
 @app.route('/', methods=['GET'])
@@ -173,16 +550,27 @@ def serve_gallery_page():
     return send_from_directory(BASE_DIR, 'gallery.html')
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Formato de texto de Prometheus (valores de este proceso)
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/health', methods=['GET'])
 def health():
     # Proyecto y base configurados por entorno (si aplica)
     env_project = os.environ.get('FIRESTORE_PROJECT_ID')
     env_database = os.environ.get('FIRESTORE_DATABASE_ID')
+    db = get_db()
     client_project = None
     try:
         client_project = getattr(db, 'project', None) if db is not None else None
     except Exception:
         client_project = None
+    try:
+        result_cache_stats = RESULT_CACHE.stats()
+    except Exception as e:
+        result_cache_stats = {'error': str(e)}
 
     return jsonify({
         'status': 'ok',
@@ -190,18 +578,152 @@ def health():
         'firestore_project': client_project or env_project,
         'firestore_database': env_database,
         'gemini_enabled': bool(os.environ.get('GEMINI_API_KEY')),
-        'gemini_model': os.environ.get('GEMINI_IMAGE_MODEL', 'imagen-3.0-fast')
+        'gemini_model': os.environ.get('GEMINI_IMAGE_MODEL', 'imagen-3.0-fast'),
+        'image_backend': IMAGE_BACKEND.stats() if IMAGE_BACKEND is not None else None,
+        'degraded_backend': DEGRADED_BACKEND.stats() if DEGRADED_BACKEND is not None else None,
+        'result_cache': result_cache_stats,
+        'image_pool': IMAGE_POOL.stats(),
+        'model_clients': MODEL_CLIENTS.stats(),
+        'poems': POEMS.stats(),
+        'prewarm': PREWARM.stats(),
+        'janitor': JANITOR.stats(),
+        'storage': BLOB_STORE.stats(),
+        'firestore_writer': FIRESTORE_WRITER.stats(),
+        'costumes': COSTUMES.stats(),
+        'rate_limit': RATE_LIMITER.stats()
     })
 
 
+def _send_stored(folder: str, filename: str, etag: str | None = None, max_age: int | None = None):
+    """Sirve un archivo de uploads/ o results/ sin cargarlo en memoria.
+
+    Con X_ACCEL_REDIRECT_PREFIX (nginx) sólo se envían cabeceras y nginx manda el archivo con
+    sendfile (location `internal` que apunta a BASE_DIR). Si no, send_file con ETag, Range y
+    respuestas condicionales (y X-Sendfile con USE_X_SENDFILE).
+    """
+    # Los archivos ocultos (índices SQLite, journal de Firestore, clave de sesiones) no se sirven
+    if any(part.startswith('.') for part in filename.replace('\\', '/').split('/')):
+        abort(404)
+    prefix = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '').strip().rstrip('/')
+    if not prefix:
+        return send_from_directory(folder, filename, etag=etag or True, max_age=max_age)
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    response = Response(status=200, mimetype=guess_type(filename)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = f"{prefix}/{quote(os.path.relpath(path, BASE_DIR).replace(os.sep, '/'))}"
+    if etag:
+        response.set_etag(etag)
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+def _remote_stored(folder: str, filename: str):
+    """Archivo sin copia local: redirección al almacén (STORAGE_REDIRECT=1) o descarga a disco.
+
+    Devuelve la respuesta de redirección, o None si el archivo quedó en disco (o no existe).
+    """
+    path = safe_join(STORED_FOLDERS[folder], filename)
+    if path is None or os.path.isfile(path) or not BLOB_STORE.shared:
+        return None
+    if _storage_redirect():
+        url = BLOB_STORE.url(f"{folder}/{filename}")
+        if url:
+            response = redirect(url, code=302)
+            # La URL firmada caduca: que el navegador no guarde la redirección más que eso
+            response.headers['Cache-Control'] = f"private, max-age={BLOB_STORE.url_expires_s // 2}"
+            return response
+    _ensure_local(folder, filename)
+    return None
+
+
 @app.route('/uploads/<path:filename>', methods=['GET'])
 def serve_upload(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    return _remote_stored('uploads', filename) or _send_stored(UPLOAD_FOLDER, filename)
 
 
 @app.route('/results/<path:filename>', methods=['GET'])
 def serve_result(filename):
-    return send_from_directory(RESULTS_FOLDER, filename)
+    # Los archivos nombrados por contenido son inmutables: ETag fuerte = hash y caché de larga duración
+    result_hash = hash_from_filename(filename)
+    if result_hash is None:
+        return _remote_stored('results', filename) or _send_stored(RESULTS_FOLDER, filename)
+
+    # ?w=256|512 sirve el derivado más pequeño que cubra el ancho; AVIF si el navegador lo acepta
+    try:
+        width = int(request.args.get('w', '0')) or None
+    except Exception:
+        width = None
+    use_avif = avif_enabled()
+    accept_avif = use_avif and 'image/avif' in request.headers.get('Accept', '')
+    if not (width or accept_avif):
+        remote = _remote_stored('results', filename)
+        if remote is not None:
+            return remote
+    elif not derivatives_ready(RESULTS_FOLDER, result_hash):
+        # Los derivados se generan en esta instancia a partir del original
+        _ensure_local('results', filename)
+    if (width or accept_avif) and not derivatives_ready(RESULTS_FOLDER, result_hash):
+        # Resultados antiguos o migrados: generar los derivados la primera vez que se piden
+        try:
+            with open(os.path.join(RESULTS_FOLDER, filename), 'rb') as f:
+                IMAGE_POOL.run(write_derivatives, RESULTS_FOLDER, result_hash, f.read())
+        except FileNotFoundError:
+            return _send_stored(RESULTS_FOLDER, filename)
+        except ImagePoolBusy:
+            raise
+        except Exception as e:
+            print(f"[Aviso] No se pudieron generar derivados de {filename}: {e}")
+    derived = pick_derivative(RESULTS_FOLDER, result_hash, width, accept_avif)
+    if derived:
+        response = _send_stored(os.path.join(RESULTS_FOLDER, DERIVED_DIRNAME), derived,
+                                etag=derived, max_age=31536000)
+    else:
+        response = _send_stored(RESULTS_FOLDER, filename, etag=result_hash, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    if use_avif:
+        response.headers['Vary'] = 'Accept'
+    return response
+
+
+def _ingest_upload(stream, block: bool = False) -> dict:
+    """Guarda en streaming con tope y normaliza: orientación EXIF, sin metadatos, lado máximo UPLOAD_MAX_SIDE.
+
+    El archivo canónico se nombra por su hash de contenido (uploads/<blake2b>.jpg|png). Lanza
+    UploadTooLarge / InvalidImage; con block=False, ImagePoolBusy si el pool está saturado.
+    """
+    tmp_path = None
+    try:
+        with METRICS.stage('upload_read'):
+            tmp_path, raw_hash = stream_to_temp(stream, UPLOAD_FOLDER, upload_max_bytes())
+        # La misma foto subida otra vez resuelve al archivo canónico existente sin decodificarla
+        info = UPLOAD_INDEX.get_by_raw_hash(raw_hash)
+        if info is not None:
+            try:
+                # Reusarla cuenta como uso: la retención la mide desde ahora, no desde la primera subida
+                os.utime(os.path.join(UPLOAD_FOLDER, info['filename']))
+                JANITOR.track('uploads', info['filename'], info['size'])
+            except FileNotFoundError:
+                UPLOAD_INDEX.forget_file(info['filename'])
+                info = None
+        repeated = info is not None
+        if info is None:
+            with METRICS.stage('normalize'):
+                info = IMAGE_POOL.run(normalize_upload, tmp_path, UPLOAD_FOLDER, upload_max_side(), block=block)
+            UPLOAD_INDEX.add(info, raw_hash)
+            JANITOR.track('uploads', info['filename'], info['size'])
+            # Síncrono: /transform puede llegar a otra instancia justo después de responder
+            _publish_stored('uploads', info['filename'])
+    finally:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+    print(f"[Upload] {info['filename']} {info['width']}x{info['height']} ({info['size']} bytes){' (repetida)' if repeated else ''}")
+    return info
 
 
 @app.route('/upload', methods=['POST'])
@@ -216,437 +738,918 @@ def upload_image():
     if not allowed_file(file.filename):
         return jsonify({'error': 'Formato no permitido'}), 400
 
-    filename = secure_filename(file.filename)
-    ext = filename.rsplit('.', 1)[-1].lower()
-    unique_name = f"{uuid.uuid4().hex}.{ext}"
-    save_path = os.path.join(UPLOAD_FOLDER, unique_name)
-    file.save(save_path)
-
-    image_url = f"/uploads/{unique_name}"
-
-    # Registrar en Firestore si está disponible
-    if db is not None:
-        try:
-            doc_ref = db.collection('transformaciones_halloween').document()
-            doc_ref.set({
-                'timestamp': datetime.utcnow().isoformat(),
-                'original_image_url': image_url,
-                'transformed_image_url': '',
-                'disfraz': '',
-                'estado': 'uploaded'
-            })
-        except Exception as e:
-            print(f"[Aviso] No se pudo escribir en Firestore: {e}")
+    try:
+        info = _ingest_upload(file.stream)
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except InvalidImage as e:
+        return jsonify({'error': str(e)}), 400
+
+    image_url = f"/uploads/{info['filename']}"
+
+    # Registrar en Firestore (write-behind: la respuesta no espera al commit)
+    FIRESTORE_WRITER.add('transformaciones_halloween', {
+        'timestamp': datetime.utcnow().isoformat(),
+        'original_image_url': image_url,
+        'original_hash': info['hash'],
+        'transformed_image_url': '',
+        'disfraz': '',
+        'estado': 'uploaded'
+    })
 
-    return jsonify({'image_url': image_url})
+    payload = {'image_url': image_url, 'image_hash': info['hash'], 'width': info['width'], 'height': info['height']}
+    # Con PREWARM=1, el disfraz elegido al subir (si llega) empieza a generarse ya
+    disfraces = [d.strip() for raw in request.form.getlist('disfraz') for d in raw.split(',') if d.strip()]
+    if disfraces and PREWARM.enabled and IMAGE_BACKEND is not None:
+        items = _prefetch_items(image_url, disfraces, request.form.get('extra_prompt', '').strip(),
+                                request.form.get('use_thematic_bg', '1').strip() in ('1', 'true', 'True', 'yes'))
+        statuses = PREWARM.hint(_prefetch_session(), items)
+        payload['prefetch'] = [{'disfraz': item['disfraz'], 'status': status} for item, status in zip(items, statuses)]
+    return jsonify(payload)
 
 
 @app.route('/transform', methods=['POST'])
 def transform_halloween():
-    disfraz = request.form.get('disfraz', '')
-    image_url = request.form.get('image_url', '')
-    extra_prompt = request.form.get('extra_prompt', '').strip()
-    use_thematic_bg = request.form.get('use_thematic_bg', '1').strip() in ('1', 'true', 'True', 'yes')
-    display_name = request.form.get('display_name', '').strip()
+    # Encola el trabajo y responde de inmediato; el pipeline corre en el pool de JOB_QUEUE
+    params = {
+        'disfraz': request.form.get('disfraz', ''),
+        'image_url': request.form.get('image_url', ''),
+        'extra_prompt': request.form.get('extra_prompt', '').strip(),
+        'use_thematic_bg': request.form.get('use_thematic_bg', '1').strip() in ('1', 'true', 'True', 'yes'),
+        'display_name': request.form.get('display_name', '').strip(),
+    }
 
     # Validación de nombre para la imagen generada (mínimo 5 caracteres)
-    if len(display_name) < 5:
+    if len(params['display_name']) < 5:
         return jsonify({'error': 'display_name es obligatorio y debe tener mínimo 5 caracteres'}), 400
 
-    if not image_url:
+    if not params['image_url']:
         return jsonify({'error': 'Falta image_url (usa /upload primero)'}), 400
 
-    # Generar poema (poem_lines) desde IA o fallback
-    poem_lines: list[str] = _generate_poem_lines(display_name, disfraz)
+    # Las pistas de esta pestaña que aún no empezaron ya no hacen falta; las que están en curso
+    # las comparte el trabajo por single-flight
+    if PREWARM.enabled:
+        PREWARM.cancel(_prefetch_session())
+
+    job_id = JOB_QUEUE.submit(params)
+    return jsonify({
+        'job_id': job_id,
+        'state': 'queued',
+        'status_url': f"/api/jobs/{job_id}",
+        'events_url': f"/api/jobs/{job_id}/events"
+    }), 202
+
+
+def _call_with_quota(model_name: str, priority: int, call, attempts: int = 3, timeout: float | None = None):
+    """Ejecuta `call()` con cupo del limitador compartido. Ante un 429 pausa el modelo para todos
+    (retryDelay o 60s, máx. 300s) y reintenta cuando vuelva a haber cupo (3 intentos en total)."""
+    for i in range(attempts):
+        with METRICS.stage('quota_wait'):
+            RATE_LIMITER.acquire(model_name, priority, timeout)
+        try:
+            with METRICS.stage('model_call'):
+                result = call()
+            METRICS.inc('model_calls_total', model=model_name, result='ok')
+            return result
+        except Exception as e:
+            msg = str(e)
+            throttled = '429' in msg or 'RESOURCE_EXHAUSTED' in msg
+            METRICS.inc('model_calls_total', model=model_name, result='429' if throttled else 'error')
+            if throttled and i < attempts - 1:
+                retry_s = min(_extract_retry_delay_seconds(e) or 60, 300)
+                print(f"[Backoff] 429 en {model_name} (intento {i+1}/{attempts-1}), reintento tras {retry_s}s")
+                RATE_LIMITER.pause(model_name, retry_s)
+                continue
+            raise
+
+
+def _generate_ai_image(backend, image_url: str, img_bytes: bytes | None, disfraz: str, extra_prompt: str,
+                       use_thematic_bg: bool, priority: int = PRIORITY_INTERACTIVE, quota: bool = True,
+                       cancelled=None) -> bytes | None:
+    """Pide la imagen a `backend` (Imagen, edición Gemini o fake). Devuelve los bytes generados o None si falla.
+
+    `cancelled()` (precalentamiento) se consulta justo antes de pedir cupo: True evita la llamada.
+    """
+    try:
+        print(f"[Gemini] Modelo seleccionado: {backend.model}")
+        costume = COSTUMES.get(disfraz)
+        prompt = costume.prompt(use_thematic_bg, extra_prompt)
+        print(f"[Prompt] disfraz={disfraz} extra={bool(extra_prompt)} thematic_bg={use_thematic_bg}")
+        if backend.needs_input and img_bytes is None:
+            img_bytes, _src_path = _read_upload_bytes_from_url(image_url)
+        if cancelled is not None and cancelled():
+            return None
+        if quota and priority == PRIORITY_PREFETCH:
+            # El precalentamiento sólo usa cupo sobrante: espera poco y no reintenta tras un 429
+            call = lambda fn: _call_with_quota(backend.model, priority, fn, attempts=1,
+                                              timeout=_prewarm_quota_wait_s())
+        elif quota:
+            # Las interactivas no esperan cupo más de IMAGE_QUOTA_WAIT_S: pasan al modo degradado
+            timeout = None if priority == PRIORITY_BATCH else _image_quota_wait_s()
+            call = lambda fn: _call_with_quota(backend.model, priority, fn, timeout=timeout)
+        else:
+            call = lambda fn: fn()
+        return backend.generate(prompt, img_bytes, costume, call)
+    except Exception as e:
+        print(f"[Aviso] {backend.name} no pudo generar imagen: {e}")
+        return None
+
+
+def _image_quota_wait_s() -> float:
+    try:
+        return float(os.environ.get('IMAGE_QUOTA_WAIT_S', '20'))
+    except Exception:
+        return 20.0
+
+
+def _prewarm_quota_wait_s() -> float:
+    try:
+        return float(os.environ.get('PREWARM_QUOTA_WAIT_S', '5'))
+    except Exception:
+        return 5.0
+
+
+def _encode_result_webp(image_bytes: bytes) -> bytes:
+    # Convertir a WebP comprimido bajo RESULT_MAX_BYTES (por defecto ~900 KiB) con el codificador adaptativo.
+    # Decodificar/redimensionar/codificar corre en el pool de procesos (trabajo en segundo plano: espera turno)
+    t0 = time.perf_counter()
+    webp_bytes, stats = IMAGE_POOL.run(encode_result, image_bytes, 1024, result_budget_bytes(), block=True)
+    # Etapas dentro del proceso del pool y, aparte, la espera en cola + ida y vuelta
+    inside_s = (stats['decode_ms'] + stats['resize_ms'] + stats['ms']) / 1000
+    METRICS.record('decode', stats['decode_ms'] / 1000)
+    METRICS.record('resize', stats['resize_ms'] / 1000)
+    METRICS.record('encode', stats['ms'] / 1000)
+    METRICS.record('pool_wait', max(0.0, time.perf_counter() - t0 - inside_s))
+    print(f"[Encode] WebP q={stats['quality']} {stats['bytes']} bytes en {stats['ms']} ms ({len(stats['attempts'])} intento(s))")
+    return webp_bytes
+
+
+def _write_result(webp_bytes: bytes) -> str:
+    # Resultados fuera de la caché (fallback) también se guardan por contenido: URL estable y cacheable
+    with METRICS.stage('results_write'):
+        filename = RESULT_CACHE.store(webp_bytes)
+    JANITOR.track('results', filename, len(webp_bytes))
+    _publish_stored('results', filename)
+    _write_result_derivatives(filename, webp_bytes)
+    return f"/results/{filename}"
+
+
+def _write_result_derivatives(filename: str, webp_bytes: bytes) -> None:
+    # Miniaturas (256/512) y AVIF opcional junto al original, al momento de escribir el resultado
+    try:
+        with METRICS.stage('derivatives'):
+            IMAGE_POOL.run(write_derivatives, RESULTS_FOLDER, hash_from_filename(filename), webp_bytes, block=True)
+    except Exception as e:
+        print(f"[Aviso] No se pudieron generar derivados de {filename}: {e}")
+
+
+def _gallery_image_fields(img_url: str) -> dict:
+    """URLs para la galería: miniatura/srcset para la grilla y tamaño completo para el lightbox."""
+    fields = {'image_url': img_url}
+    if img_url.startswith('/results/') and BLOB_STORE.shared:
+        # Bucket público o CDN (S3_PUBLIC_BASE_URL): el tamaño completo va directo, sin pasar por la app
+        public = BLOB_STORE.public_url(f"results/{img_url.rsplit('/', 1)[-1]}")
+        if public:
+            fields['image_url'] = public
+    if img_url.startswith('/results/') and hash_from_filename(img_url.rsplit('/', 1)[-1]):
+        fields['thumb_url'] = f"{img_url}?w=256"
+        fields['srcset'] = srcset_for(img_url)
+    return fields
+
+
+def _result_model_name() -> str:
+    # El nombre del modelo entra en la clave de caché: resultados del fake y del modelo real no se mezclan
+    return IMAGE_BACKEND.model if IMAGE_BACKEND is not None else os.environ.get('GEMINI_IMAGE_MODEL', 'imagen-3.0-fast')
+
+
+def _result_cache_key(image_url: str, disfraz: str, extra_prompt: str, use_thematic_bg: bool) -> str:
+    return _digest_image_and_disfraz(_upload_hash_from_url(image_url), disfraz, extra_prompt,
+                                     'bg' if use_thematic_bg else 'nobg', _result_model_name(),
+                                     COSTUMES.get(disfraz).version)
+
+
+def _generate_and_cache(cache_key: str | None, image_url: str, disfraz: str, extra_prompt: str, use_thematic_bg: bool,
+                        priority: int, progress, cancelled=None) -> dict | None:
+    """Genera con IMAGE_BACKEND, codifica a WebP y guarda bajo `cache_key` (sin clave, sólo en results/).
+
+    Devuelve la entrada de la caché (o {'url': ...}) o None si no hubo imagen. Corre dentro de
+    SINGLE_FLIGHT: /transform, los lotes y el precalentamiento comparten la generación en vuelo.
+    """
+    # Otro worker pudo terminar mientras esperábamos su lock: volver a mirar la caché
+    if cache_key:
+        hit = RESULT_CACHE.get(cache_key, count=False)
+        if hit:
+            return dict(hit)
+    # Incluye la espera de cuota y los reintentos tras 429 (también medidos aparte)
+    with METRICS.stage('image_call'):
+        ai_bytes = _generate_ai_image(IMAGE_BACKEND, image_url, None, disfraz, extra_prompt,
+                                      use_thematic_bg, priority, cancelled=cancelled)
+    if ai_bytes is None:
+        return None
+    progress('encoding')
+    try:
+        encoded = _encode_result_webp(ai_bytes)
+    except Exception as e:
+        print(f"[Aviso] No se pudo codificar el resultado de IA: {e}")
+        return None
+    if cache_key:
+        with METRICS.stage('results_write'):
+            entry = RESULT_CACHE.put(cache_key, encoded)
+        JANITOR.track('results', entry['filename'], entry['size'])
+        _publish_stored('results', entry['filename'])
+        _write_result_derivatives(entry['filename'], encoded)
+        print(f"[Cache] Guardado {cache_key} -> {entry['filename']} ({entry['size']} bytes)")
+        return dict(entry)
+    return {'url': _write_result(encoded)}
+
+
+def _run_transform(params: dict, progress=None, record_sink=None) -> dict:
+    """Pipeline completo de /transform (poema + imagen + codificación + registro).
+
+    Se ejecuta fuera del hilo de la petición; `progress(state)` publica el avance del trabajo.
+    Con `record_sink(doc)` el documento de Firestore se entrega al llamador (escrituras por lotes).
+    El resultado incluye `timings` (ms por etapa), que también van a /metrics.
+    """
+    with METRICS.timer('transform') as timer:
+        result = _transform_pipeline(params, progress, record_sink)
+    result['timings'] = timer.as_ms()
+    result['timings']['total'] = round((time.perf_counter() - timer.started) * 1000, 2)
+    return result
+
+
+def _transform_pipeline(params: dict, progress, record_sink) -> dict:
+    disfraz = params.get('disfraz', '')
+    image_url = params.get('image_url', '')
+    extra_prompt = params.get('extra_prompt', '')
+    use_thematic_bg = bool(params.get('use_thematic_bg', True))
+    display_name = params.get('display_name', '')
+    # Los lotes/backfill ceden el turno del limitador de cuota a las transformaciones interactivas
+    priority = PRIORITY_BATCH if params.get('priority') == 'batch' else PRIORITY_INTERACTIVE
+    if progress is None:
+        progress = lambda _state: None
+
+    progress('generating')
+
+    # Lanzar el poema en paralelo con la imagen: la latencia total tiende a max(poema, imagen)
+    poem_handle = POEMS.start(display_name, disfraz)
 
     # Por defecto, usar la misma imagen (fallback)
     transformed_image_url = image_url
-    data_url = None
-    final_image_bytes = None  # bytes de la imagen resultante para almacenar en Firestore
-
-    # Intentar caché (si tenemos bytes de la imagen)
-    img_bytes_for_cache = None
-    try:
-        img_bytes_for_cache, src_path_for_cache = _read_upload_bytes_from_url(image_url)
-        cache_key = _digest_image_and_disfraz(img_bytes_for_cache, disfraz, extra_prompt, 'bg' if use_thematic_bg else 'nobg')
-        cached = EDIT_CACHE.get(cache_key)
-        if cached and os.path.isfile(os.path.join(RESULTS_FOLDER, os.path.basename(cached))):
-            # Cargar bytes desde el resultado cacheado para persistir en Firestore y devolver data_url
-            cached_path = os.path.join(RESULTS_FOLDER, os.path.basename(cached))
-            try:
-                with open(cached_path, 'rb') as f:
-                    final_image_bytes = f.read()
-                transformed_image_url = ''  # evitamos dependencia del filesystem
-                # Data URL provisional; será reemplazado por la versión WebP comprimida más adelante
-                try:
-                    provisional_mime = guess_type(cached_path)[0] or 'image/png'
-                    data_url = f"data:{provisional_mime};base64,{base64.b64encode(final_image_bytes).decode('utf-8')}"
-                except Exception:
-                    pass
-                print(f"[Cache] Usando bytes desde cache {cached_path} para persistir en Firestore")
-            except Exception:
-                # Si falla, continuamos sin cache y dejamos que el flujo normal intente IA o fallback
-                pass
-    except Exception:
-        pass
+    # La respuesta sólo lleva la URL por contenido: los bytes se sirven desde /results (send_file,
+    # Range, ETag) y no se copian a base64 dentro del JSON ni del trabajo guardado
+    stored = False
+    generated = False
+
+    degraded = False
+    prewarmed = False
+    model_name = _result_model_name()
+
+    # Intentar caché con el hash de la subida (del índice, sin releer la imagen). Un acierto devuelve
+    # el WebP guardado tal cual: no se lee, decodifica ni codifica nada, y no se llama al modelo.
+    cache_key = None
+    cache_hit = None
+    try:
+        with METRICS.stage('hash'):
+            cache_key = _result_cache_key(image_url, disfraz, extra_prompt, use_thematic_bg)
+        with METRICS.stage('cache_lookup'):
+            cache_hit = RESULT_CACHE.get(cache_key)
+        if cache_hit:
+            transformed_image_url = f"/results/{cache_hit['filename']}"
+            generated = True
+            prewarmed = PREWARM.consume(cache_key)
+            print(f"[Cache] Acierto {cache_key} -> {cache_hit['filename']}{' (precalentado)' if prewarmed else ''}")
+    except Exception as e:
+        print(f"[Aviso] Caché de resultados no disponible: {e}")
 
-    # Intentar integración con Gemini (Nano Banana) si existe GEMINI_API_KEY
-    gemini_api_key = os.environ.get('GEMINI_API_KEY')
-    if gemini_api_key:
+    # Backend de imagen configurado (Imagen/Gemini con GEMINI_API_KEY, o el fake local)
+    if IMAGE_BACKEND is not None and cache_hit is None:
+        generate_and_store = lambda: _generate_and_cache(cache_key, image_url, disfraz, extra_prompt,
+                                                         use_thematic_bg, priority, progress)
         try:
-            import google.generativeai as genai  # type: ignore
-            genai.configure(api_key=gemini_api_key)
-
-            # Selección de modelo de imagen. Recomendado: 'imagen-3.0-fast' o 'imagen-3.0'.
-            model_name = os.environ.get('GEMINI_IMAGE_MODEL', 'imagen-3.0-fast')
-            print(f"[Gemini] Modelo seleccionado: {model_name}")
-
-            # Construcción de prompts de EDICIÓN (con/sin fondo temático)
-            if use_thematic_bg:
-                prompt_map = {
-                    'vampire': (
-                        "Edit the provided photo. Keep the same person, pose and facial identity. "
-                        "Add an elegant black vampire cape over the shoulders (visible collar) and subtle but visible fangs (open lips slightly if needed). "
-                        "Apply cinematic red–black lighting grade. Replace the background with a gothic night ambience (castle hints, lamps), softly blurred. Do not replace the person."
-                    ),
-                    'witch': (
-                        "Edit the provided photo. Keep the same person and identity. "
-                        "Add a modern witch vibe: soft purple glow, subtle spell particles, and a natural-looking black cloak (optional hat brim). "
-                        "Replace the background with a mystical moonlit scene with light fog and shallow depth of field. Do not generate a different person."
-                    ),
-                    'zombie': (
-                        "Edit the provided photo. Keep the same persona and identity. "
-                        "Apply glamorous zombie makeup: pale skin tone, shadows under the eyes, faint cracks and veins; a haunting green cinematic effect. "
-                        "Replace the background with a spooky look and zombies in the background, softly blurred. Don't replace the person."
-                    ),
-                    'werewolf': (
-                        "Edit the provided photo. Keep the same person and pose. "
-                        "Add werewolf features blended over the face: pointed ears peeking through hair, fine fur on cheeks/temples, visible natural fangs with slightly open mouth. "
-                        "Replace the background with a moonlit forest vibe with light fog and shallow depth of field. Do not replace the person or identity."
-                    ),
-                    'ghost': (
-                        "Edit the provided photo. Preserve the same person and identity. "
-                        "Add ethereal ghostly glow and slight translucency on the subject; cool cinematic atmosphere. "
-                        "Replace the background with a dim haunted interior or misty night street, softly blurred. Do not create a new person."
-                    )
-                }
+            # Peticiones idénticas concurrentes (doble clic, reintentos, un precalentamiento en curso)
+            # comparten una sola generación
+            if cache_key:
+                outcome, shared = SINGLE_FLIGHT.do(cache_key, generate_and_store)
+                if shared and not outcome:
+                    # El líder pudo ser un precalentamiento sin cupo sobrante: probar con la cuota propia
+                    outcome, shared = SINGLE_FLIGHT.do(cache_key, generate_and_store)
             else:
-                prompt_map = {
-                    'vampire': (
-                        "Edit the provided photo. Keep the same person, pose and facial identity. "
-                        "Add elegant vampire makeup (pale skin tint, subtle red–black grading) and small natural fangs (open lips slightly if needed). "
-                        "Preserve the existing background; only adjust global color grading to match the vibe. Do not replace the person."
-                    ),
-                    'witch': (
-                        "Edit the provided photo. Keep the same person and identity. "
-                        "Add a modern witch vibe (soft purple glow, subtle spell particles) and an optional black cloak if it fits naturally. "
-                        "Preserve the existing background with minimal changes. Do not generate a different person."
-                    ),
-                    'zombie': (
-                        "Edit the provided photo. Keep the same person, pose and identity. "
-                        "Apply glamorous zombie makeup: pale skin tint, under-eye shadows, light cracks, faint veins; eerie green cinematic grade. "
-                        "Preserve the existing background with minimal adjustments. Do not replace the person."
-                    ),
-                    'werewolf': (
-                        "Edit the provided photo. Keep the same person and pose. "
-                        "Add werewolf features blended over the face (ears, fine fur texture, subtle fangs) while preserving identity. "
-                        "Preserve the existing background. Do not replace the person."
-                    ),
-                    'ghost': (
-                        "Edit the provided photo. Preserve the same person and identity. "
-                        "Add ethereal ghostly glow and slight translucency; cool cinematic vibe. "
-                        "Preserve the existing background. Do not create a new person."
-                    )
-                }
-            prompt = prompt_map.get(disfraz, prompt_map['ghost'])
-            if extra_prompt:
-                prompt = f"{prompt} Additional details: {extra_prompt}"
-            print(f"[Prompt] disfraz={disfraz} extra={bool(extra_prompt)} thematic_bg={use_thematic_bg}")
-
-            # Si el modelo es de la familia Imagen, intentamos generate_images
-            try:
-                if model_name.lower().startswith('imagen'):
-                    model = genai.GenerativeModel(model_name)
-                    # Backoff para 429: 2 reintentos (total 3 intentos)
-                    # 1er reintento: esperar RetryInfo (cap 300s, default 300s)
-                    # 2do reintento: esperar 180s
-                    attempts = 3
-                    last_err = None
-                    result = None
-                    for i in range(attempts):
-                        try:
-                            result = model.generate_images(
-                                prompt=prompt,
-                                number_of_images=1,
-                                size='1024x1024'
-                            )
-                            break
-                        except Exception as e:
-                            last_err = e
-                            msg = str(e)
-                            if '429' in msg or 'RESOURCE_EXHAUSTED' in msg:
-                                # calcular espera
-                                if i == 0:
-                                    retry_s = _extract_retry_delay_seconds(e) or 300
-                                    retry_s = min(retry_s, 300)
-                                elif i == 1:
-                                    retry_s = 180
-                                else:
-                                    break
-                                print(f"[Backoff] 429 en generate_images, esperando {retry_s}s (intento {i+1}/{attempts-1})…")
-                                time.sleep(retry_s)
-                                continue
-                            else:
-                                raise
-                    if result is None and last_err:
-                        raise last_err
-                    img_b64 = None
-                    if hasattr(result, 'images') and result.images:
-                        first = result.images[0]
-                        if isinstance(first, bytes):
-                            img_b64 = base64.b64encode(first).decode('utf-8')
-                        elif isinstance(first, str):
-                            img_b64 = first
-                        elif hasattr(first, 'data'):
-                            img_b64 = base64.b64encode(first.data).decode('utf-8')
-                    elif hasattr(result, 'generations') and result.generations:
-                        gen0 = result.generations[0]
-                        if hasattr(gen0, 'image') and hasattr(gen0.image, 'base64_data'):
-                            img_b64 = gen0.image.base64_data
-                    if not img_b64:
-                        raise RuntimeError('No se obtuvo imagen de Gemini (sin datos)')
-
-                    img_bytes = base64.b64decode(img_b64)
-                    final_image_bytes = img_bytes
-                    print(f"[Gemini] Imagen generada (en memoria)")
-                else:
-                    # Modelo de la familia Gemini (edición de imagen de entrada)
-                    # Patrón según documentación: contents=[prompt, PIL.Image]
-                    try:
-                        # Abrir imagen con Pillow
-                        if img_bytes_for_cache is None:
-                            img_bytes_for_cache, src_path_for_cache = _read_upload_bytes_from_url(image_url)
-                        image_in = Image.open(BytesIO(img_bytes_for_cache))
-
-                        # Cliente nuevo google-genai
-                        try:
-                            from google import genai as genai_new  # type: ignore
-                        except Exception as _:
-                            raise RuntimeError('Paquete google-genai no disponible. Ejecuta pip install google-genai')
-
-                        client = genai_new.Client(api_key=gemini_api_key)
-
-                        # Backoff para 429 en edición: 2 reintentos (total 3 intentos)
-                        attempts = 3
-                        last_err = None
-                        response = None
-                        for i in range(attempts):
-                            try:
-                                response = client.models.generate_content(
-                                    model=model_name,
-                                    contents=[prompt, image_in]
-                                )
-                                break
-                            except Exception as e:
-                                last_err = e
-                                msg = str(e)
-                                if '429' in msg or 'RESOURCE_EXHAUSTED' in msg:
-                                    if i == 0:
-                                        retry_s = _extract_retry_delay_seconds(e) or 300
-                                        retry_s = min(retry_s, 300)
-                                    elif i == 1:
-                                        retry_s = 180
-                                    else:
-                                        break
-                                    print(f"[Backoff] 429 en edición, esperando {retry_s}s (intento {i+1}/{attempts-1})…")
-                                    time.sleep(retry_s)
-                                    continue
-                                else:
-                                    raise
-                        if response is None and last_err:
-                            raise last_err
-
-                        # Buscar part con inline_data
-                        out_bytes = None
-                        parts_count = 0
-                        has_inline = False
-                        try:
-                            parts = response.candidates[0].content.parts
-                            parts_count = len(parts)
-                            for part in parts:
-                                if getattr(part, 'inline_data', None) and getattr(part.inline_data, 'data', None):
-                                    out_bytes = part.inline_data.data
-                                    has_inline = True
-                                    break
-                        except Exception:
-                            pass
-
-                        if not out_bytes:
-                            raise RuntimeError('La respuesta no contiene imagen (inline_data)')
-
-                        final_image_bytes = out_bytes
-                        # Data URL provisional (se reemplaza por WebP más abajo)
-                        try:
-                            data_url = "data:image/png;base64," + base64.b64encode(out_bytes).decode('utf-8')
-                        except Exception:
-                            data_url = None
-                        print(f"[Gemini Edit] Imagen editada (en memoria) | parts={parts_count} inline={has_inline}")
-                        # Guardar en caché
-                        try:
-                            key = cache_key if img_bytes_for_cache is not None else _digest_image_and_disfraz(img_bytes_for_cache, disfraz, extra_prompt, 'bg' if use_thematic_bg else 'nobg')
-                            EDIT_CACHE[key] = transformed_image_url
-                        except Exception:
-                            pass
-
-                    except Exception as ge2:
-                        print(f"[Aviso] Edición Gemini falló: {ge2}")
-                        # mantenemos fallback (image_url)
-
-            except Exception as ge:
-                print(f"[Aviso] Gemini no pudo generar imagen: {ge}")
-                # mantenemos fallback (image_url)
+                outcome, shared = generate_and_store(), False
+            if outcome:
+                transformed_image_url = outcome.get('url') or f"/results/{outcome['filename']}"
+                stored = True
+                generated = True
+                if shared:
+                    prewarmed = PREWARM.consume(cache_key)
+                    print(f"[SingleFlight] Resultado compartido para {cache_key}")
         except Exception as e:
-            print(f"[Aviso] Integración Gemini no disponible: {e}")
+            print(f"[Aviso] Generación de imagen falló: {e}")
 
-    # Si no hubo bytes de IA (fallback), tomar los bytes de la imagen original subida
-    if final_image_bytes is None:
-        try:
-            if img_bytes_for_cache is None:
-                img_bytes_for_cache, src_path_for_cache = _read_upload_bytes_from_url(image_url)
-            final_image_bytes = img_bytes_for_cache
-        except Exception:
-            final_image_bytes = None
-
-    # Convertir a WebP comprimido (<~900 KiB), construir data_url y (nuevo) guardar también en results/ para galería filesystem
-    stored_b64 = None
-    stored_mime = None
-    if final_image_bytes is not None:
+    progress('encoding')
+
+    # Si no hubo bytes de IA (fallback), modo degradado: la foto con el tinte del disfraz (local, sin
+    # cupo). No se guarda bajo la clave de caché para que la próxima petición vuelva a probar el modelo.
+    # Sin backend degradado se toman los bytes de la imagen original subida.
+    if not generated:
         try:
-            from io import BytesIO as _BytesIO
-            max_side = 1024
-            qualities = [80, 70, 60, 50]
-            img = Image.open(_BytesIO(final_image_bytes)).convert('RGB')
-            w, h = img.size
-            scale = min(1.0, max_side / max(w, h))
-            if scale < 1.0:
-                img = img.resize((int(w*scale), int(h*scale)), Image.LANCZOS)
-            webp_bytes = None
-            for q in qualities:
-                buf = _BytesIO()
-                img.save(buf, format='WEBP', quality=q, method=6)
-                b = buf.getvalue()
-                if len(b) <= 900 * 1024:
-                    webp_bytes = b
-                    break
-            if webp_bytes is None:
-                webp_bytes = b
-            stored_b64 = base64.b64encode(webp_bytes).decode('utf-8')
-            stored_mime = 'image/webp'
-            data_url = f"data:{stored_mime};base64,{stored_b64}"
-
-            # Guardar también en filesystem (results/) para que /api/gallery tenga fallback aunque falle Firestore
-            try:
-                safe_base = ''.join(c.lower() if c.isalnum() or c in ('-','_') else '-' for c in (display_name or 'imagen')).strip('-_') or 'imagen'
-                fname = f"{safe_base}-{uuid.uuid4().hex[:12]}.webp"
-                out_path = os.path.join(RESULTS_FOLDER, fname)
-                with open(out_path, 'wb') as f:
-                    f.write(webp_bytes)
-                transformed_image_url = f"/results/{fname}"
-            except Exception:
-                # Si no podemos escribir, mantenemos sólo data_url
-                transformed_image_url = ''
-        except Exception as _e:
-            pass
+            upload_bytes, _src_path = _read_upload_bytes_from_url(image_url)
+            source_bytes = upload_bytes
+            if DEGRADED_BACKEND is not None:
+                with METRICS.stage('degraded_image'):
+                    tinted = _generate_ai_image(DEGRADED_BACKEND, image_url, upload_bytes, disfraz,
+                                                extra_prompt, use_thematic_bg, priority, quota=False)
+                if tinted is not None:
+                    source_bytes = tinted
+                    degraded = True
+            webp_bytes = _encode_result_webp(source_bytes)
+            # Guardar en results/ (por contenido): la respuesta y la galería usan esa URL.
+            # Si no se puede escribir, queda la URL de la subida
+            transformed_image_url = _write_result(webp_bytes)
+            stored = True
+        except Exception as e:
+            print(f"[Aviso] No se pudo guardar el resultado: {e}")
 
-    if db is not None:
+    # Recoger el poema (el poema base si no llegó dentro del plazo)
+    with METRICS.stage('poem_wait'):
+        poem_lines: list[str] = POEMS.result(poem_handle)
+
+    # Misma regla que la consulta de Firestore (estado == 'generated_ai'): la galería local sólo lista
+    # imágenes del modelo, no el fallback ni el modo degradado
+    if generated and transformed_image_url.startswith('/results/'):
         try:
-            doc_ref = db.collection('transformaciones_halloween').document()
-            doc_ref.set({
-                'timestamp': datetime.utcnow().isoformat(),
-                'original_image_url': image_url,
-                'transformed_image_url': transformed_image_url,
-                'disfraz': disfraz,
-                'estado': 'generated_ai' if final_image_bytes is not None else 'themed_local',
-                'display_name': display_name,
-                'transformed_image_b64': stored_b64 or None,
-                'transformed_mime': stored_mime or None,
-                'poem_lines': poem_lines
-            })
+            with METRICS.stage('gallery_index'):
+                GALLERY_INDEX.add(transformed_image_url.rsplit('/', 1)[-1], disfraz, display_name, poem_lines)
         except Exception as e:
-            print(f"[Aviso] No se pudo escribir en Firestore: {e}")
+            print(f"[Aviso] No se pudo registrar en el índice de galería: {e}")
 
-    return jsonify({
+    record = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'original_image_url': image_url,
         'transformed_image_url': transformed_image_url,
-        'data_url': data_url,
+        'disfraz': disfraz,
+        # Sólo lo que generó el modelo (o su caché) cuenta como IA; el fallback y el modo degradado no
+        'estado': 'generated_ai' if generated else 'themed_local',
+        'display_name': display_name,
+        'poem_lines': poem_lines
+    }
+    # URL por contenido; el base64 sólo mientras el archivo no esté en el almacén compartido
+    with METRICS.stage('record_image'):
+        record.update(_record_image_fields(transformed_image_url))
+    with METRICS.stage('firestore_write'):
+        if record_sink is not None:
+            record_sink(record)
+        else:
+            FIRESTORE_WRITER.add('transformaciones_halloween', record)
+
+    if cache_hit:
+        outcome = 'cached'
+    elif generated:
+        outcome = 'generated'
+    else:
+        outcome = 'degraded' if degraded else 'fallback'
+    METRICS.inc('transforms_total', outcome=outcome)
+
+    return {
+        'transformed_image_url': transformed_image_url,
+        'result_id': record['result_hash'],
         'animation_url': None,
         'sound_url': None,
         'poem_lines': poem_lines,
         'ai_debug': {
-            'model': os.environ.get('GEMINI_IMAGE_MODEL', 'imagen-3.0-fast'),
+            'model': model_name,
+            'backend': IMAGE_BACKEND.name if IMAGE_BACKEND is not None else None,
             'changed': transformed_image_url != image_url,
-            'mode': 'edit' if os.environ.get('GEMINI_IMAGE_MODEL', 'imagen-3.0-fast').lower().startswith('gemini') else 'generate',
+            'mode': IMAGE_BACKEND.mode if IMAGE_BACKEND is not None else None,
+            'degraded': degraded,
+            'prewarmed': prewarmed,
             'use_thematic_bg': use_thematic_bg
         }
+    }
+
+
+JOB_QUEUE = create_job_queue(_run_transform, BASE_DIR)
+JOB_QUEUE.resume_orphans()
+
+
+def _prewarm_run(params: dict, hint) -> tuple[str, str | None]:
+    """Genera hacia la caché el resultado probable de /transform (sin poema, galería ni Firestore)."""
+    if IMAGE_BACKEND is None:
+        return 'failed', None
+    with METRICS.timer('prewarm'):
+        cache_key = _result_cache_key(params['image_url'], params['disfraz'], params['extra_prompt'],
+                                      params['use_thematic_bg'])
+        if RESULT_CACHE.get(cache_key, count=False):
+            return 'cached', cache_key
+        if hint.cancelled:
+            return 'cancelled', cache_key
+        generate = lambda: _generate_and_cache(cache_key, params['image_url'], params['disfraz'],
+                                               params['extra_prompt'], params['use_thematic_bg'],
+                                               PRIORITY_PREFETCH, lambda _state: None,
+                                               cancelled=lambda: hint.cancelled)
+        outcome, shared = SINGLE_FLIGHT.do(cache_key, generate)
+    if not outcome:
+        return ('cancelled' if hint.cancelled else 'failed'), cache_key
+    # Compartida: un /transform ya la había pedido, así que no cuenta como precalentada
+    if shared:
+        return 'cached', cache_key
+    print(f"[Prewarm] {params['disfraz']} listo en caché ({cache_key})")
+    return 'generated', cache_key
+
+
+# Precalentamiento especulativo (PREWARM=1): tras /upload o una pista de /api/prefetch, la imagen
+# probable se genera en segundo plano con cupo sobrante y queda en la caché para /transform
+PREWARM = create_prewarmer(_prewarm_run)
+METRICS.gauge('prewarm_pending', 'Pistas de precalentamiento en cola', PREWARM.pending)
+
+
+PREFETCH_COOKIE = 'prewarm_sid'
+
+
+def _load_prefetch_secret() -> bytes:
+    """Clave HMAC de las cookies de sesión de precalentamiento.
+
+    PREFETCH_SECRET (igual en todas las instancias); sin ella, una clave aleatoria guardada en
+    results/ que comparten los workers del host.
+    """
+    secret = os.environ.get('PREFETCH_SECRET', '').strip()
+    if secret:
+        return secret.encode('utf-8')
+    path = os.path.join(RESULTS_FOLDER, '.prefetch-secret')
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+    except Exception as e:
+        print(f"[Prewarm] No se pudo guardar la clave de sesión, se usa una de este proceso: {e}")
+        return secrets.token_bytes(32)
+    # Otro worker pudo crearlo a la vez: se espera a que el contenido esté escrito
+    for _ in range(50):
+        with open(path) as f:
+            secret = f.read().strip()
+        if secret:
+            return secret.encode('utf-8')
+        time.sleep(0.01)
+    return secrets.token_bytes(32)
+
+
+PREFETCH_SECRET = _load_prefetch_secret()
+
+
+def _sign_prefetch_session(sid: str) -> str:
+    return hmac.new(PREFETCH_SECRET, sid.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+
+def _prefetch_session() -> str:
+    """Sesión de precalentamiento: id aleatorio del servidor en una cookie firmada (HMAC).
+
+    El cliente no elige la sesión, así que no puede gastar el presupuesto ni cancelar las pistas de
+    otra. Sin cookie válida se emite una nueva (ver set_prefetch_cookie); pedir sesiones nuevas no
+    amplía el gasto total, acotado por PREWARM_GLOBAL_BUDGET.
+    """
+    sid = g.get('prefetch_sid')
+    if sid:
+        return sid
+    raw = request.cookies.get(PREFETCH_COOKIE, '')
+    sid, _, sig = raw.partition('.')
+    if not (sid and sig and hmac.compare_digest(sig, _sign_prefetch_session(sid))):
+        sid = secrets.token_hex(16)
+        g.prefetch_cookie = f"{sid}.{_sign_prefetch_session(sid)}"
+    g.prefetch_sid = sid
+    return sid
+
+
+@app.after_request
+def set_prefetch_cookie(response):
+    cookie = g.get('prefetch_cookie')
+    if cookie:
+        response.set_cookie(PREFETCH_COOKIE, cookie, max_age=int(PREWARM.window_s), httponly=True,
+                            samesite='Lax', secure=request.is_secure)
+    return response
+
+
+def _prefetch_items(image_url: str, disfraces: list[str], extra_prompt: str, use_thematic_bg: bool) -> list[dict]:
+    # Sólo disfraces del registro: una pista con un disfraz desconocido no gasta presupuesto
+    return [{
+        'image_url': image_url,
+        'disfraz': disfraz,
+        'extra_prompt': extra_prompt,
+        'use_thematic_bg': use_thematic_bg,
+    } for disfraz in dict.fromkeys(disfraces) if disfraz in COSTUMES]
+
+
+@app.route('/api/prefetch', methods=['GET', 'POST', 'DELETE'])
+def api_prefetch():
+    """Pistas de precalentamiento.
+
+    GET: si está activo y el presupuesto por sesión. POST (form o JSON): image_url, disfraz (o
+    disfraces), extra_prompt, use_thematic_bg. DELETE: cancela lo pendiente de la sesión.
+    La sesión sale de la cookie firmada del servidor, no de parámetros del cliente.
+    """
+    if request.method == 'GET':
+        return jsonify({'enabled': PREWARM.enabled, 'budget': PREWARM.budget})
+    session = _prefetch_session()
+    if request.method == 'DELETE':
+        return jsonify({'cancelled': PREWARM.cancel(session)})
+    if not PREWARM.enabled or IMAGE_BACKEND is None:
+        return jsonify({'enabled': False, 'items': []})
+
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        raw = data.get('disfraces') or data.get('disfraz') or []
+        disfraces = [str(d).strip() for d in (raw if isinstance(raw, list) else str(raw).split(',')) if str(d).strip()]
+        image_url = str(data.get('image_url') or '')
+        extra_prompt = str(data.get('extra_prompt') or '').strip()
+        use_thematic_bg = str(data.get('use_thematic_bg', '1')).strip() in ('1', 'true', 'True', 'yes')
+    else:
+        disfraces = [d.strip() for raw in request.form.getlist('disfraz') for d in raw.split(',') if d.strip()]
+        image_url = request.form.get('image_url', '')
+        extra_prompt = request.form.get('extra_prompt', '').strip()
+        use_thematic_bg = request.form.get('use_thematic_bg', '1').strip() in ('1', 'true', 'True', 'yes')
+
+    if not image_url.startswith('/uploads/') or not _ensure_local('uploads', image_url[len('/uploads/'):]):
+        return jsonify({'error': 'image_url no apunta a una subida existente'}), 400
+    items = _prefetch_items(image_url, disfraces, extra_prompt, use_thematic_bg)
+    statuses = PREWARM.hint(session, items)
+    return jsonify({
+        'enabled': True,
+        'items': [{'disfraz': item['disfraz'], 'status': status} for item, status in zip(items, statuses)]
+    }), 202
+
+
+@app.route('/api/costumes', methods=['GET'])
+def api_costumes():
+    # Disfraces del registro para el selector y los sonidos del frontend
+    response = jsonify({'default': COSTUMES.default, 'items': COSTUMES.public()})
+    response.headers['Cache-Control'] = 'public, max-age=300'
+    return response
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    response = jsonify(public_job(job))
+    # Al terminar, Server-Timing refleja las etapas del pipeline (no sólo esta consulta)
+    timings = (job.get('result') or {}).get('timings')
+    if timings:
+        response.headers['Server-Timing'] = server_timing_from_ms(timings)
+    return response
+
+
+def _sse_settings() -> tuple[int, float]:
+    """SSE_MAX_STREAMS (streams abiertos por proceso, por defecto 4) y SSE_MAX_SECONDS (por defecto 120)."""
+    try:
+        max_streams = int(os.environ.get('SSE_MAX_STREAMS', '4'))
+    except Exception:
+        max_streams = 4
+    try:
+        max_seconds = float(os.environ.get('SSE_MAX_SECONDS', '120'))
+    except Exception:
+        max_seconds = 120.0
+    return max(0, max_streams), max(1.0, max_seconds)
+
+
+# En modo WSGI cada stream ocupa un hilo de gunicorn mientras dura: se acotan los abiertos a la vez
+# para que unos pocos clientes esperando no dejen sin hilos al resto de rutas
+_sse_slots = threading.BoundedSemaphore(max(1, _sse_settings()[0]))
+
+
+def _reset_sse_after_fork():
+    global _sse_slots
+    _sse_slots = threading.BoundedSemaphore(max(1, _sse_settings()[0]))
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_sse_after_fork)
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def api_job_events(job_id):
+    """Stream SSE con los cambios de estado del trabajo hasta que termine (done/failed).
+
+    Sin cupo (SSE_MAX_STREAMS) responde 503: el cliente sigue con polling a /api/jobs/<id>.
+    """
+    if JOB_QUEUE.get(job_id) is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    max_streams, max_seconds = _sse_settings()
+    slots = _sse_slots
+    if max_streams == 0 or not slots.acquire(blocking=False):
+        response = jsonify({'error': 'Demasiados streams abiertos, consulta el estado con polling',
+                            'status_url': f"/api/jobs/{job_id}"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '2'
+        return response
+
+    def stream():
+        since = None
+        deadline = time.time() + max_seconds
+        while time.time() < deadline:
+            wait_s = max(0.0, min(15.0, deadline - time.time()))
+            job = JOB_QUEUE.wait_for_update(job_id, since, timeout=wait_s) if since is not None else JOB_QUEUE.get(job_id)
+            if job is None:
+                return
+            if job['updated_at'] != since:
+                since = job['updated_at']
+                yield f"event: {job['state']}\ndata: {json.dumps(public_job(job))}\n\n"
+                if job['state'] in TERMINAL_STATES:
+                    return
+            else:
+                # Comentario keep-alive para proxies
+                yield ": ping\n\n"
+
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
+    # Se libera al cerrar la respuesta (fin del stream o cliente desconectado), aunque no empiece
+    response.call_on_close(slots.release)
+    return response
+
+
+# --------- Lotes (eventos): /api/batch y `flask batch` ---------
+def _batch_settings() -> tuple[int, int]:
+    """BATCH_MAX_ITEMS (por defecto 500) y BATCH_WORKERS (por defecto 4)."""
+    try:
+        max_items = int(os.environ.get('BATCH_MAX_ITEMS', '500'))
+    except Exception:
+        max_items = 500
+    try:
+        workers = int(os.environ.get('BATCH_WORKERS', '4'))
+    except Exception:
+        workers = 4
+    return max_items, workers
+
+
+def _batch_params(image_urls: list[str], disfraces: list[str], display_name: str,
+                  extra_prompt: str = '', use_thematic_bg: bool = True) -> list[dict]:
+    # Producto imágenes x disfraces, con prioridad de lote frente a las transformaciones interactivas
+    return [{
+        'disfraz': disfraz,
+        'image_url': image_url,
+        'extra_prompt': extra_prompt,
+        'use_thematic_bg': use_thematic_bg,
+        'display_name': display_name,
+        'priority': 'batch',
+    } for image_url in image_urls for disfraz in disfraces]
+
+
+def _stream_batch(items: list[dict], workers: int):
+    """Ejecuta el lote y genera una línea NDJSON por ítem (según terminan) y un resumen final."""
+    writer = FirestoreBatchWriter(get_db(), 'transformaciones_halloween', fallback=FIRESTORE_WRITER.add_many)
+    outcomes = []
+    t0 = time.perf_counter()
+    try:
+        for outcome in run_batch(items, lambda params: _run_transform(params, record_sink=writer.add), workers):
+            outcomes.append(outcome)
+            params = items[outcome['index']]
+            line = {
+                'index': outcome['index'],
+                'image_url': params['image_url'],
+                'disfraz': params['disfraz'],
+                'ok': outcome['ok'],
+                'ms': outcome['ms'],
+            }
+            if outcome['ok']:
+                line['transformed_image_url'] = outcome['result'].get('transformed_image_url')
+                line['poem_lines'] = outcome['result'].get('poem_lines')
+            else:
+                line['error'] = outcome['error']
+            yield json.dumps(line, ensure_ascii=False) + '\n'
+    finally:
+        writer.flush()
+    summary = summarize(outcomes, time.perf_counter() - t0)
+    summary['firestore_writes'] = writer.written
+    summary['firestore_commits'] = writer.commits
+    print(f"[Batch] {summary['ok']}/{summary['items']} ítems en {summary['seconds']}s ({summary['items_per_s']} ítems/s)")
+    yield json.dumps({'summary': summary}, ensure_ascii=False) + '\n'
+
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """Transforma muchas imágenes x disfraces y devuelve NDJSON (una línea por ítem + resumen).
+
+    multipart: images (varios archivos) y/o image_url (varios), disfraz (varios o separados por coma),
+    display_name, extra_prompt, use_thematic_bg. JSON: {image_urls, disfraces, display_name, ...}.
+    """
+    max_items, workers = _batch_settings()
+    body = request.get_json(silent=True) if request.is_json else None
+    if body is not None:
+        image_urls = [str(u) for u in (body.get('image_urls') or [])]
+        disfraces = [str(d) for d in (body.get('disfraces') or [])]
+        display_name = str(body.get('display_name') or '').strip()
+        extra_prompt = str(body.get('extra_prompt') or '').strip()
+        use_thematic_bg = bool(body.get('use_thematic_bg', True))
+    else:
+        image_urls = [u for u in request.form.getlist('image_url') if u]
+        disfraces = [d.strip() for raw in request.form.getlist('disfraz') for d in raw.split(',') if d.strip()]
+        display_name = request.form.get('display_name', '').strip()
+        extra_prompt = request.form.get('extra_prompt', '').strip()
+        use_thematic_bg = request.form.get('use_thematic_bg', '1').strip() in ('1', 'true', 'True', 'yes')
+
+    if len(display_name) < 5:
+        return jsonify({'error': 'display_name es obligatorio y debe tener mínimo 5 caracteres'}), 400
+    if not disfraces:
+        return jsonify({'error': 'Falta al menos un disfraz'}), 400
+
+    files = [f for f in request.files.getlist('images') if f and f.filename]
+    if (len(image_urls) + len(files)) * len(disfraces) > max_items:
+        return jsonify({'error': f'El lote supera el máximo de {max_items} ítems'}), 400
+    for f in files:
+        if not allowed_file(f.filename):
+            return jsonify({'error': f'Formato no permitido: {f.filename}'}), 400
+        try:
+            image_urls.append(f"/uploads/{_ingest_upload(f.stream, block=True)['filename']}")
+        except (UploadTooLarge, InvalidImage) as e:
+            return jsonify({'error': f'{f.filename}: {e}'}), 400
+    if not image_urls:
+        return jsonify({'error': 'Faltan imágenes (images o image_url)'}), 400
+
+    items = _batch_params(image_urls, disfraces, display_name, extra_prompt, use_thematic_bg)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(_stream_batch(items, workers), mimetype='application/x-ndjson', headers=headers)
+
+
+@app.cli.command('batch')
+@click.argument('folder', type=click.Path(exists=True, file_okay=False))
+@click.option('--disfraz', 'disfraces', multiple=True, required=True, help='Disfraz (repetible).')
+@click.option('--display-name', required=True, help='Nombre para los poemas (mínimo 5 caracteres).')
+@click.option('--extra-prompt', default='', help='Detalles adicionales para el prompt.')
+@click.option('--no-thematic-bg', is_flag=True, help='Conservar el fondo original.')
+@click.option('--workers', type=int, default=None, help='Hilos del lote (por defecto BATCH_WORKERS).')
+def batch_command(folder, disfraces, display_name, extra_prompt, no_thematic_bg, workers):
+    """Transforma todas las imágenes de FOLDER con uno o varios disfraces (NDJSON por stdout)."""
+    if len(display_name.strip()) < 5:
+        raise click.BadParameter('debe tener mínimo 5 caracteres', param_hint='--display-name')
+    image_urls = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path) or not allowed_file(name):
+            continue
+        try:
+            with open(path, 'rb') as f:
+                image_urls.append(f"/uploads/{_ingest_upload(f, block=True)['filename']}")
+        except Exception as e:
+            click.echo(f"[Batch] Omitida {name}: {e}", err=True)
+    items = _batch_params(image_urls, list(disfraces), display_name.strip(), extra_prompt.strip(), not no_thematic_bg)
+    for line in _stream_batch(items, workers or _batch_settings()[1]):
+        click.echo(line, nl=False)
+
+
+@app.cli.command('janitor')
+@click.option('--dry-run', is_flag=True, help='Sólo informar lo que se borraría.')
+@click.option('--passes', type=int, default=0, help='Pasadas a ejecutar (por defecto, hasta recorrer todo).')
+def janitor_command(dry_run, passes):
+    """Aplica la retención de uploads/ y results/ ahora (JSON con los bytes liberados por stdout)."""
+    # Cada pasada recorre JANITOR_BATCH nombres por carpeta: sin --passes, tantas como hagan falta
+    # para cubrir el directorio más grande
+    if passes <= 0:
+        largest = max(len(os.listdir(p.path)) for p in JANITOR.folders.values())
+        passes = max(1, -(-largest // JANITOR.batch) + 1)
+    total = {'passes': 0, 'reclaimed_bytes': 0, 'deleted': {}, 'dry_run': dry_run}
+    for i in range(passes):
+        report = JANITOR.run_pass(dry_run=dry_run)
+        total['passes'] += 1
+        # En seco no se borra nada: las pasadas sólo registran archivos y cuenta la última
+        if dry_run and i < passes - 1:
+            continue
+        total['reclaimed_bytes'] += report['reclaimed_bytes']
+        for folder, reasons in report['deleted'].items():
+            for reason, count in reasons.items():
+                total['deleted'].setdefault(folder, {})
+                total['deleted'][folder][reason] = total['deleted'][folder].get(reason, 0) + count
+        total['bytes'] = report.get('bytes', {})
+    click.echo(json.dumps(total, ensure_ascii=False))
 
 
 # --------- API de Galería (antes de app.run) ---------
+def _migrate_legacy_gallery_doc(doc, data: dict) -> str | None:
+    """Escribe los bytes base64 de un documento en results/<hash> y devuelve la URL (None si falla).
+
+    Sólo cuando el archivo está en el almacén compartido se quita el base64 del documento: sin él,
+    el base64 es la única copia que ven las demás instancias y se conserva. Se hace de forma perezosa
+    al listar la galería.
+    """
+    current = (data.get('transformed_image_url') or '').strip()
+    name = current.rsplit('/', 1)[-1] if current.startswith('/results/') else ''
+    try:
+        if name and hash_from_filename(name) and os.path.isfile(RESULT_CACHE.path_for(name)):
+            # Ya escrito en esta instancia: no hace falta decodificar
+            filename = name
+        else:
+            raw = base64.b64decode(data.get('transformed_image_b64') or '')
+            mime = (data.get('transformed_mime') or 'image/webp').strip()
+            ext = (mime.split('/')[-1] or 'webp').lower()
+            filename = RESULT_CACHE.store(raw, ext)
+        img_url = f"/results/{filename}"
+    except Exception as e:
+        print(f"[Aviso] No se pudo migrar documento {getattr(doc, 'id', '?')}: {e}")
+        return None
+    if not (_result_durable(filename) or _publish_stored('results', filename)):
+        return img_url
+    try:
+        from google.cloud import firestore as _firestore  # type: ignore
+        doc.reference.update({
+            'transformed_image_url': img_url,
+            'result_hash': hash_from_filename(filename),
+            'transformed_image_b64': _firestore.DELETE_FIELD,
+        })
+        print(f"[Migración] Documento {doc.id} -> {img_url}")
+    except Exception as e:
+        # Aunque no se pueda actualizar, el archivo ya está en el almacén y la URL sirve
+        print(f"[Aviso] No se pudo actualizar documento {getattr(doc, 'id', '?')}: {e}")
+    return img_url
+
+
+# Campos que lee la galería desde Firestore (proyección). El base64 (documentos antiguos o escritos sin
+# almacén compartido) pesa hasta ~930 KB por documento: no va en la página, se lee documento a
+# documento sólo si la imagen no está en results/ ni en el almacén
+GALLERY_FIELDS = ['timestamp', 'transformed_image_url', 'display_name', 'disfraz', 'poem_lines']
+GALLERY_B64_FIELDS = ['transformed_image_b64', 'transformed_mime']
+
+
+def _gallery_image_missing(img_url: str) -> bool:
+    """True si la imagen de un documento no está en results/ ni en el almacén compartido."""
+    if not img_url:
+        return True
+    if not img_url.startswith('/results/'):
+        return False
+    filename = img_url.rsplit('/', 1)[-1]
+    if os.path.isfile(os.path.join(RESULTS_FOLDER, filename)):
+        return False
+    return not _result_durable(filename)
+
+
+def _gallery_doc_b64(doc) -> dict:
+    """Lee sólo los campos base64 de un documento de la galería ({} si no los tiene o falla)."""
+    try:
+        with METRICS.stage('firestore_b64_get'):
+            return doc.reference.get(field_paths=GALLERY_B64_FIELDS).to_dict() or {}
+    except Exception as e:
+        print(f"[Aviso] No se pudo leer la imagen del documento {getattr(doc, 'id', '?')}: {e}")
+        return {}
+
+
 @app.route('/api/gallery', methods=['GET'])
 def api_gallery():
-    """Devuelve una lista paginada de imágenes transformadas.
+    """Devuelve una lista paginada de imágenes transformadas (sólo metadatos y URLs /results/<hash>).
     Prioriza Firestore; si no está disponible, hace fallback a filesystem en results/.
-    Parámetros (Firestore): limit, cursor (timestamp ISO8601)
-    Parámetros (FS): limit, offset
+    Parámetros: limit, cursor (opaco, devuelto como next_cursor), disfraz (sólo índice local)
     """
     try:
         limit = int(request.args.get('limit', '24'))
     except Exception:
         limit = 24
+    # Mismo tope para Firestore y el índice local: cada documento leído es una lectura facturada
+    limit = max(1, min(limit, 100))
+
+    cursor = request.args.get('cursor', '')
+    after = decode_cursor(cursor) if cursor else None
+    if cursor and not (after and len(after) == 2):
+        # Cursores antiguos (timestamp ISO a secas) o manipulados: no se adivina la página
+        return jsonify({'error': 'cursor inválido; pedir la galería desde el principio'}), 400
+    # Los cursores del índice local son (ts numérico, id); los de Firestore, (timestamp ISO, id del documento)
+    local_cursor = bool(after) and not isinstance(after[0], str)
 
     # Preferir Firestore si está disponible
-    if db is not None:
+    db = get_db()
+    if db is not None and not local_cursor:
         try:
             from google.cloud import firestore as _firestore  # type: ignore
-            cursor = request.args.get('cursor', '')
-            q = db.collection('transformaciones_halloween').order_by('timestamp', direction=_firestore.Query.DESCENDING)
+            from google.cloud.firestore import FieldFilter  # type: ignore
+            coll = db.collection('transformaciones_halloween')
+            # Sólo documentos con imagen generada (índice compuesto estado + timestamp + __name__ en
+            # firestore.indexes.json) y sólo los campos que usa la galería: cada página lee `limit` documentos
+            q = coll.where(filter=FieldFilter('estado', '==', 'generated_ai')) \
+                .order_by('timestamp', direction=_firestore.Query.DESCENDING) \
+                .order_by('__name__', direction=_firestore.Query.DESCENDING) \
+                .select(GALLERY_FIELDS)
             if cursor:
-                try:
-                    # Intentar filtrar por timestamp menor al cursor
-                    q = q.where('timestamp', '<', cursor)
-                except Exception as _:
-                    pass
+                # Clave completa (timestamp, id): no se saltan documentos con el mismo timestamp
+                q = q.start_after({'timestamp': after[0], '__name__': coll.document(str(after[1]))})
             q = q.limit(limit)
-            docs = list(q.stream())
+            with METRICS.stage('firestore_query'):
+                docs = list(q.stream())
             items = []
-            last_ts = None
+            last_key = None
             for d in docs:
                 data = d.to_dict() or {}
+                # El cursor avanza por cada documento leído, aunque se descarte por no tener imagen
+                last_key = (data.get('timestamp'), d.id)
                 dn = (data.get('display_name') or '').strip()
-                b64 = (data.get('transformed_image_b64') or '').strip()
-                mime = (data.get('transformed_mime') or 'image/webp').strip()
                 img_url = (data.get('transformed_image_url') or '').strip()
-                item = {}
-                if b64:
-                    item['data_url'] = f"data:{mime};base64,{b64}"
-                elif img_url:
-                    # Intentar leer del filesystem si apunta a /results/
-                    if img_url.startswith('/results/'):
-                        try:
-                            filename = img_url.split('/results/', 1)[1]
-                            fs_path = os.path.join(RESULTS_FOLDER, filename)
-                            if os.path.isfile(fs_path):
-                                with open(fs_path, 'rb') as f:
-                                    raw = f.read()
-                                _mime = guess_type(fs_path)[0] or 'image/png'
-                                item['data_url'] = f"data:{_mime};base64,{base64.b64encode(raw).decode('utf-8')}"
-                            else:
-                                item['image_url'] = img_url
-                        except Exception:
-                            item['image_url'] = img_url
-                    else:
-                        item['image_url'] = img_url
-                else:
+                if _gallery_image_missing(img_url):
+                    # Sin copia en esta instancia ni en el almacén: escribir en results/ el base64 del
+                    # documento (documento antiguo o escrito sin almacén compartido), si lo tiene
+                    legacy = _gallery_doc_b64(d)
+                    if (legacy.get('transformed_image_b64') or '').strip():
+                        img_url = _migrate_legacy_gallery_doc(d, dict(data, **legacy)) or img_url
+                if not img_url:
                     continue
+                # Sólo metadatos + URL estable; el navegador/CDN cachea la imagen por ETag
+                item = _gallery_image_fields(img_url)
                 if dn:
                     item['display_name'] = dn
                 # Incluir disfraz para narrativa/sonido en galería
@@ -667,48 +1670,52 @@ def api_gallery():
                 # Nombre sugerido para descarga
                 try:
                     base = ''.join(c.lower() if c.isalnum() or c in ('-', '_') else '-' for c in dn).strip('-_') or 'imagen'
-                    if 'data_url' in item:
-                        ext = 'webp' if (mime.endswith('webp')) else (mime.split('/')[-1] or 'png')
-                    else:
-                        guessed = guess_type(img_url)[0] or 'image/png'
-                        ext = (guessed.split('/')[-1] or 'png')
+                    guessed = guess_type(img_url)[0] or 'image/png'
+                    ext = (guessed.split('/')[-1] or 'png')
                     item['suggested_name'] = f"{base}.{ext}"
                 except Exception:
                     pass
                 items.append(item)
-                last_ts = data.get('timestamp') or last_ts
             # Si hay items desde Firestore, devolverlos; si no, hacer fallback a filesystem
-            if items:
+            if items or cursor:
                 resp = {'items': items}
-                if last_ts and len(items) >= limit:
-                    resp['next_cursor'] = last_ts
+                if last_key and len(docs) >= limit:
+                    resp['next_cursor'] = encode_cursor(*last_key)
                 return jsonify(resp)
         except Exception as e:
+            if cursor:
+                # El cursor es de Firestore: la primera página del índice local duplicaría ítems
+                print(f"[Aviso] /api/gallery Firestore fallo con cursor: {e}")
+                return jsonify({'items': [], 'error': 'galería no disponible; reintentar'}), 503, {'Retry-After': '2'}
             print(f"[Aviso] /api/gallery Firestore fallo, usando filesystem: {e}")
 
-    # Fallback a filesystem en results/
+    # Fallback al índice local de results/: paginación por (ts, id), coste constante por página
     try:
-        try:
-            offset = int(request.args.get('offset', '0'))
-        except Exception:
-            offset = 0
-        exts = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
-        files = []
-        for name in os.listdir(RESULTS_FOLDER):
-            p = os.path.join(RESULTS_FOLDER, name)
-            if os.path.isfile(p) and os.path.splitext(name)[1].lower() in exts:
-                files.append((name, os.path.getmtime(p)))
-        files.sort(key=lambda x: x[1], reverse=True)
-        slice_files = files[offset: offset + limit]
-        items = [{'image_url': f"/results/{name}"} for name, _ in slice_files]
+        with METRICS.stage('index_page'):
+            rows, next_cursor = GALLERY_INDEX.page(limit, cursor if local_cursor else None,
+                                                   (request.args.get('disfraz') or '').strip() or None)
+        items = []
+        for row in rows:
+            item = _gallery_image_fields(f"/results/{row['filename']}")
+            if row['display_name']:
+                item['display_name'] = row['display_name']
+            if row['disfraz']:
+                item['disfraz'] = row['disfraz']
+            if row['poem_lines']:
+                item['poem_lines'] = [str(x) for x in row['poem_lines']][:3]
+            items.append(item)
         resp = {'items': items}
-        if offset + limit < len(files):
-            resp['next_offset'] = offset + limit
+        if next_cursor:
+            resp['next_cursor'] = next_cursor
         return jsonify(resp)
     except Exception as e:
         return jsonify({'items': [], 'error': str(e)}), 200
 
 
 if __name__ == '__main__':
+    if 'IMAGE_POOL_WORKERS' not in os.environ:
+        # Los hijos del pool importan el `__main__` del padre: con `python app.py`, la app entera.
+        # En desarrollo Pillow corre en el mismo proceso (IMAGE_POOL_WORKERS fuerza el pool)
+        IMAGE_POOL.workers = 0
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
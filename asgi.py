@@ -0,0 +1,327 @@
+# Modo de servicio ASGI (uvicorn), junto al WSGI de siempre (gunicorn app:app).
+#
+# - Las conexiones que sólo esperan no ocupan un hilo: el stream SSE de /api/jobs/<id>/events es
+#   una corrutina que despierta con los cambios del trabajo, y el cuerpo de cada petición (p. ej.
+#   una subida lenta desde un móvil) se recibe de forma asíncrona a un archivo temporal antes de
+#   pasar a la app Flask.
+# - El resto de rutas es la misma app Flask, ejecutada en un pool acotado de hilos
+#   (ASGI_WSGI_THREADS) sólo durante el trabajo real de la petición.
+# - /transform ya responde al instante (cola de trabajos); las transformaciones en vuelo esperan al
+#   modelo en los hilos de JOB_QUEUE, no en conexiones abiertas.
+#
+#   gunicorn -c gunicorn_asgi.py asgi:application      (o python asgi.py en desarrollo)
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from app import JOB_QUEUE, _sse_settings, app as flask_app
+from jobs import TERMINAL_STATES, public_job
+
+# Cuerpos de hasta 1 MiB en memoria; los mayores (subidas) se vuelcan a disco mientras llegan
+SPOOL_MAX_MEMORY = 1024 * 1024
+SSE_PING_SECONDS = 15.0
+
+_END = object()
+
+
+async def _send_json(send, status: int, payload: dict, headers: list | None = None) -> None:
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode('latin-1')),
+        *(headers or []),
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class WSGIBridge:
+    """Ejecuta una app WSGI desde ASGI: cuerpo recibido de forma asíncrona, app en un pool de hilos.
+
+    La respuesta se envía por partes a medida que la app la genera (streams NDJSON/SSE de Flask).
+    """
+
+    def __init__(self, wsgi_app, threads: int = 32, max_body: int | None = None):
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        self.threads = max(1, threads)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='wsgi')
+
+    @staticmethod
+    def _environ(scope: dict, body, size: int) -> dict:
+        root_path = scope.get('root_path', '')
+        path = scope.get('path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            # PEP 3333: cadenas "nativas" con los bytes UTF-8 decodificados como latin-1
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': str(client[0]),
+            'CONTENT_LENGTH': str(size),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin-1').lower()
+            value = raw_value.decode('latin-1')
+            if name == 'content-length':
+                continue
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+                continue
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _read_body(self, receive, send):
+        body = SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        size = 0
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None, 0
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if self.max_body is not None and size > self.max_body:
+                body.close()
+                await _send_json(send, 413, {'error': 'El cuerpo de la petición supera el máximo permitido'})
+                return None, 0
+            if chunk:
+                body.write(chunk)
+            more = message.get('more_body', False)
+        body.seek(0)
+        return body, size
+
+    async def __call__(self, scope, receive, send):
+        body, size = await self._read_body(receive, send)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        state = {'status': None, 'headers': None, 'sent': False}
+        # Datos del callable write() de start_response (API imperativa de PEP 3333): se envían en
+        # orden, antes del siguiente trozo del iterable
+        written: list[bytes] = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None:
+                try:
+                    if state['sent']:
+                        # Con la cabecera ya enviada no se puede cambiar la respuesta: se aborta
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            elif state['status'] is not None:
+                raise AssertionError('start_response ya fue llamado sin exc_info')
+            state['status'] = int(status.split(' ', 1)[0])
+            state['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return written.append
+
+        async def send_body(chunk: bytes) -> None:
+            # La cabecera sale con el primer dato no vacío: hasta entonces la app puede sustituirla
+            # (start_response con exc_info)
+            if not state['sent']:
+                if state['status'] is None:
+                    raise RuntimeError('La app WSGI no llamó a start_response')
+                state['sent'] = True
+                await send({'type': 'http.response.start', 'status': state['status'], 'headers': state['headers']})
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        def call_app():
+            result = self.wsgi_app(self._environ(scope, body, size), start_response)
+            try:
+                return result, iter(result)
+            except BaseException:
+                if hasattr(result, 'close'):
+                    result.close()
+                raise
+
+        result = None
+        try:
+            result, iterator = await loop.run_in_executor(self.executor, call_app)
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, iterator, _END)
+                while written:
+                    data = written.pop(0)
+                    if data:
+                        await send_body(data)
+                if chunk is _END:
+                    break
+                if chunk:
+                    await send_body(chunk)
+            await send_body(b'')
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            try:
+                if result is not None and hasattr(result, 'close'):
+                    await loop.run_in_executor(self.executor, result.close)
+            finally:
+                body.close()
+
+
+class JobEvents:
+    """SSE de /api/jobs/<id>/events como corrutina: espera cambios sin ocupar un hilo.
+
+    Mismos límites que la ruta WSGI (SSE_MAX_STREAMS, SSE_MAX_SECONDS): sin cupo responde 503.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        # Streams abiertos en este proceso; sólo lo toca el loop, no hace falta lock
+        self.open_streams = 0
+        self._loop = None
+        self._registered = False
+        self._waiters: dict[str, set[asyncio.Event]] = {}
+
+    def _attach(self) -> None:
+        # Un loop por proceso worker: se toma (y se registra el listener) en el primer stream
+        self._loop = asyncio.get_running_loop()
+        if not self._registered:
+            self._registered = True
+            self.queue.add_listener(self._on_change)
+
+    def _on_change(self, job_id: str) -> None:
+        loop = self._loop
+        if loop is not None and job_id in self._waiters:
+            loop.call_soon_threadsafe(self._wake, job_id)
+
+    def _wake(self, job_id: str) -> None:
+        for event in self._waiters.get(job_id, ()):
+            event.set()
+
+    async def _get(self, job_id: str):
+        # El almacén SQLite hace E/S: fuera del loop
+        return await asyncio.get_running_loop().run_in_executor(None, self.queue.get, job_id)
+
+    async def __call__(self, scope, receive, send, job_id: str):
+        self._attach()
+        job = await self._get(job_id)
+        if job is None:
+            await _send_json(send, 404, {'error': 'Trabajo no encontrado'})
+            return
+        max_streams, max_seconds = _sse_settings()
+        if self.open_streams >= max_streams:
+            await _send_json(send, 503, {'error': 'Demasiados streams abiertos, consulta el estado con polling',
+                                         'status_url': f"/api/jobs/{job_id}"}, [(b'retry-after', b'2')])
+            return
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    disconnected.set()
+                    return
+
+        changed = asyncio.Event()
+        self._waiters.setdefault(job_id, set()).add(changed)
+        watcher = asyncio.create_task(watch_disconnect())
+        self.open_streams += 1
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                (b'x-content-type-options', b'nosniff'),
+            ]})
+            since = None
+            deadline = time.monotonic() + max_seconds
+            last_sent = time.monotonic()
+            while time.monotonic() < deadline and not disconnected.is_set():
+                if job is None:
+                    break
+                if job['updated_at'] != since:
+                    since = job['updated_at']
+                    data = f"event: {job['state']}\ndata: {json.dumps(public_job(job))}\n\n"
+                    await send({'type': 'http.response.body', 'body': data.encode('utf-8'), 'more_body': True})
+                    last_sent = time.monotonic()
+                    if job['state'] in TERMINAL_STATES:
+                        break
+                elif time.monotonic() - last_sent >= SSE_PING_SECONDS:
+                    # Comentario keep-alive para proxies
+                    await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                    last_sent = time.monotonic()
+                # Cambios de este proceso despiertan al instante; los de otro worker (backend SQLite)
+                # se ven al re-consultar cada segundo
+                changed.clear()
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                job = await self._get(job_id)
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            self.open_streams -= 1
+            watcher.cancel()
+            waiters = self._waiters.get(job_id)
+            if waiters is not None:
+                waiters.discard(changed)
+                if not waiters:
+                    self._waiters.pop(job_id, None)
+
+
+def _bridge_threads() -> int:
+    try:
+        return int(os.environ.get('ASGI_WSGI_THREADS', '32'))
+    except Exception:
+        return 32
+
+
+BRIDGE = WSGIBridge(flask_app, threads=_bridge_threads(), max_body=flask_app.config.get('MAX_CONTENT_LENGTH'))
+JOB_EVENTS = JobEvents(JOB_QUEUE)
+_JOB_EVENTS_PATH = re.compile(r'^/api/jobs/([^/]+)/events$')
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            print(f"[ASGI] Listo ({BRIDGE.threads} hilos para la app WSGI)")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            BRIDGE.executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    match = _JOB_EVENTS_PATH.match(scope.get('path', ''))
+    if match and scope['method'] == 'GET':
+        await JOB_EVENTS(scope, receive, send, match.group(1))
+        return
+    await BRIDGE(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    from app import IMAGE_POOL
+    if 'IMAGE_POOL_WORKERS' not in os.environ:
+        # Como `python app.py`: los hijos del pool reimportarían este script y la app
+        IMAGE_POOL.workers = 0
+    uvicorn.run(application, host='0.0.0.0', port=int(os.environ.get('PORT', '8080')))
@@ -0,0 +1,125 @@
+# Lotes para eventos: muchas fotos x varios disfraces por el mismo pipeline de /transform.
+# Los ítems se reparten en un pool de hilos (la caché, el single-flight y el limitador de cuota
+# siguen aplicando), los resultados se emiten a medida que terminan y los registros de Firestore
+# se escriben en lotes (WriteBatch) en lugar de un set() por ítem.
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Firestore admite hasta 500 operaciones por WriteBatch, 10 MiB por petición de commit y 1 MiB por
+# documento. Los lotes se cortan antes del límite de la petición, con margen para su sobrecarga
+FIRESTORE_BATCH_LIMIT = 500
+FIRESTORE_COMMIT_MAX_BYTES = 9 * 1024 * 1024
+FIRESTORE_DOC_MAX_BYTES = 1024 * 1024
+
+
+def record_size(record: dict) -> int:
+    """Tamaño aproximado del documento serializado (alcanza para cortar lotes por bytes)."""
+    return len(json.dumps(record, ensure_ascii=False, default=str).encode('utf-8'))
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """True si reintentar el commit no sirve: InvalidArgument (documento inválido o lote demasiado grande)."""
+    return type(error).__name__ == 'InvalidArgument' or getattr(error, 'code', None) == 400
+
+
+class FirestoreBatchWriter:
+    """Acumula documentos y los escribe con WriteBatch cada `max_ops` o `max_bytes` (y al cerrar).
+
+    Si un commit falla, los documentos pasan a `fallback(collection, records)` (el buffer
+    write-behind, que reintenta y los guarda en el journal) en lugar de perderse.
+    """
+
+    def __init__(self, db, collection: str, max_ops: int = 100, fallback=None,
+                 max_bytes: int = FIRESTORE_COMMIT_MAX_BYTES):
+        self.db = db
+        self.collection = collection
+        self.fallback = fallback
+        self.max_ops = max(1, min(max_ops, FIRESTORE_BATCH_LIMIT))
+        self.max_bytes = max(1, min(max_bytes, FIRESTORE_COMMIT_MAX_BYTES))
+        self._pending: list[dict] = []
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        self.written = 0
+        self.commits = 0
+
+    def add(self, record: dict) -> None:
+        if self.db is None:
+            return
+        size = record_size(record)
+        with self._lock:
+            # Un registro puede traer ~930 KB de base64: el lote se corta antes de pasar de max_bytes
+            if self._pending and self._pending_bytes + size > self.max_bytes:
+                pending, self._pending, self._pending_bytes = self._pending, [], 0
+            else:
+                pending = None
+            self._pending.append(record)
+            self._pending_bytes += size
+            if pending is None and len(self._pending) >= self.max_ops:
+                pending, self._pending, self._pending_bytes = self._pending, [], 0
+        if pending:
+            self._commit(pending)
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending, self._pending_bytes = self._pending, [], 0
+        if pending:
+            self._commit(pending)
+
+    def _commit(self, records: list[dict]) -> None:
+        try:
+            coll = self.db.collection(self.collection)
+            wb = self.db.batch()
+            for record in records:
+                wb.set(coll.document(), record)
+            wb.commit()
+            with self._lock:
+                self.written += len(records)
+                self.commits += 1
+        except Exception as e:
+            print(f"[Batch] No se pudieron escribir {len(records)} documentos en Firestore: {e}")
+            if self.fallback is not None:
+                self.fallback(self.collection, records)
+
+
+def run_batch(items: list[dict], handler, workers: int = 4):
+    """Ejecuta `handler(item)` para cada ítem con `workers` hilos.
+
+    Genera un dict por ítem en orden de finalización: {'index', 'ok', 'result' | 'error', 'ms'}.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='batch') as pool:
+        started = {}
+        futures = {}
+        for index, item in enumerate(items):
+            started[index] = time.perf_counter()
+            futures[pool.submit(handler, item)] = index
+        for future in as_completed(futures):
+            index = futures[future]
+            # Tiempo desde que el ítem entró al pool (incluye la espera por un hilo libre)
+            ms = round((time.perf_counter() - started[index]) * 1000, 1)
+            try:
+                yield {'index': index, 'ok': True, 'result': future.result(), 'ms': ms}
+            except Exception as e:
+                yield {'index': index, 'ok': False, 'error': str(e), 'ms': ms}
+
+
+def summarize(outcomes: list[dict], elapsed_s: float) -> dict:
+    """Resumen agregado del lote: ítems, fallos y rendimiento."""
+    latencies = sorted(o['ms'] for o in outcomes)
+    ok = sum(1 for o in outcomes if o['ok'])
+
+    def pct(p: float) -> float | None:
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(round(p * (len(latencies) - 1))))]
+
+    return {
+        'items': len(outcomes),
+        'ok': ok,
+        'failed': len(outcomes) - ok,
+        'seconds': round(elapsed_s, 3),
+        'items_per_s': round(len(outcomes) / elapsed_s, 3) if elapsed_s > 0 else None,
+        'p50_ms': pct(0.5),
+        'p95_ms': pct(0.95),
+    }
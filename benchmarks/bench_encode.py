@@ -0,0 +1,82 @@
+"""Benchmark del codificador WebP: escalera original vs. codificador adaptativo (encoding.py).
+
+Uso:
+    python benchmarks/bench_encode.py [--budget BYTES ...] [--repeat N] [--images GLOB]
+
+Usa las imágenes de uploads/ (a su tamaño y reescaladas a 1024 px, como en /transform)
+y emite un JSON con tiempo, bytes e intentos por imagen y presupuesto.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from PIL import Image  # noqa: E402
+
+from encoding import DEFAULT_BUDGET_BYTES, encode_webp, encode_webp_ladder  # noqa: E402
+
+
+def _variants(path: str):
+    img = Image.open(path).convert('RGB')
+    yield f"{os.path.basename(path)}@{img.width}", img
+    w, h = img.size
+    scale = 1024 / max(w, h)
+    if scale != 1.0:
+        yield f"{os.path.basename(path)}@1024", img.resize((round(w * scale), round(h * scale)), Image.LANCZOS)
+
+
+def run(paths: list[str], budgets: list[int], repeat: int) -> dict:
+    results = []
+    seen = set()
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest = hash(f.read())
+        if digest in seen:
+            # uploads/ puede tener copias idénticas: no repetir la medición
+            continue
+        seen.add(digest)
+        for name, img in _variants(path):
+            for budget in budgets:
+                row = {'image': name, 'budget': budget}
+                for label, fn in (('ladder', encode_webp_ladder), ('adaptive', encode_webp)):
+                    times = []
+                    stats = None
+                    for _ in range(repeat):
+                        _, stats = fn(img, budget)
+                        times.append(stats['ms'])
+                    row[label] = {
+                        'ms_median': round(statistics.median(times), 2),
+                        'bytes': stats['bytes'],
+                        'quality': stats['quality'],
+                        'within_budget': stats['bytes'] <= budget,
+                        'attempts': stats['attempts'],
+                    }
+                row['speedup'] = round(row['ladder']['ms_median'] / max(0.01, row['adaptive']['ms_median']), 2)
+                results.append(row)
+    return {
+        'benchmark': 'encode_webp',
+        'repeat': repeat,
+        'results': results,
+        'speedup_median': round(statistics.median(r['speedup'] for r in results), 2) if results else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=int, action='append',
+                        help='Presupuesto en bytes (repetible). Por defecto: 900 KiB, 40 KiB y 25 KiB')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--images', default=os.path.join(BASE_DIR, 'uploads', '*'))
+    args = parser.parse_args()
+    budgets = args.budget or [DEFAULT_BUDGET_BYTES, 40 * 1024, 25 * 1024]
+    paths = sorted(p for p in glob.glob(args.images) if os.path.isfile(p))
+    print(json.dumps(run(paths, budgets, args.repeat), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,462 @@
+"""Benchmark de carga del servicio: /upload, /transform (frío vs. en caché) y /api/gallery.
+
+Uso:
+    python benchmarks/bench_service.py [--requests N] [--concurrency C] [--gallery-sizes 100,100000]
+                                       [--fake-latency-ms MS] [--baseline ANTERIOR.json] [--output SALIDA.json]
+
+Corre la app con el cliente de pruebas de Flask sobre una copia temporal del árbol (no toca uploads/
+ni results/ del repositorio) con el backend de imagen fake (IMAGE_BACKEND=fake, sin API key) y
+las imágenes de uploads/ como entrada. Mide p50/p95/p99, peticiones/s, pico de RSS y bytes de
+respuesta por escenario, más micro-benchmarks (clave de caché, búsqueda en caché, página del índice
+de galería, codificación). La galería se mide sobre el índice local (filesystem) con 100 y 100k
+resultados y, si FIRESTORE_EMULATOR_HOST apunta a un emulador, también sobre Firestore.
+Emite JSON; con --baseline añade el cociente respecto a una corrida anterior (otro commit).
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DISFRACES = ['vampire', 'witch', 'zombie', 'werewolf', 'ghost']
+
+
+def _pct(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))], 3)
+
+
+def _rss_mb() -> float | None:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except Exception:
+        pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # KiB en Linux, bytes en macOS
+        return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    except Exception:
+        return None
+
+
+class RSSSampler:
+    """Pico de RSS del proceso mientras dura un escenario (muestreo cada 50 ms)."""
+
+    def __init__(self, interval_s: float = 0.05):
+        self.interval_s = interval_s
+        self.peak = _rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            rss = _rss_mb()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def drive(app, name: str, fn, requests: int, concurrency: int) -> dict:
+    """Ejecuta `fn(client, i)` `requests` veces con `concurrency` hilos (un cliente por hilo).
+
+    `fn` devuelve los bytes de respuesta o lanza una excepción (cuenta como error).
+    """
+    local = threading.local()
+    latencies, sizes, errors = [], [], []
+    lock = threading.Lock()
+
+    def one(i):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        t0 = time.perf_counter()
+        try:
+            size = fn(client, i)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        ms = (time.perf_counter() - t0) * 1000
+        with lock:
+            latencies.append(ms)
+            sizes.append(size)
+
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            list(pool.map(one, range(requests)))
+        elapsed = time.perf_counter() - start
+    return {
+        'name': name,
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'error_sample': errors[:3],
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'p50_ms': _pct(latencies, 0.50),
+        'p95_ms': _pct(latencies, 0.95),
+        'p99_ms': _pct(latencies, 0.99),
+        'bytes_total': sum(sizes),
+        'bytes_mean': round(statistics.mean(sizes), 1) if sizes else None,
+        'peak_rss_mb': rss.peak,
+    }
+
+
+def micro(name: str, fn, iterations: int) -> dict:
+    times = []
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        fn(i)
+        times.append((time.perf_counter() - t0) * 1_000_000)
+    total_s = sum(times) / 1_000_000
+    return {
+        'name': name,
+        'iterations': iterations,
+        'p50_us': _pct(times, 0.50),
+        'p95_us': _pct(times, 0.95),
+        'p99_us': _pct(times, 0.99),
+        'ops_per_s': round(iterations / total_s, 1) if total_s > 0 else None,
+    }
+
+
+def _stage_tree() -> str:
+    """Copia el código de la app a un directorio temporal (sin datos, caches ni .env)."""
+    work = tempfile.mkdtemp(prefix='bench-service-')
+    shutil.copytree(BASE_DIR, work, dirs_exist_ok=True, ignore=shutil.ignore_patterns(
+        '.git', 'uploads', 'results', 'benchmarks', '__pycache__', '.env', '*.sqlite3', '*.sqlite3-*', 'node_modules'))
+    return work
+
+
+def _load_app(work: str, fake_latency_ms: float):
+    # Backend fake sin API key: nada sale a la red (tampoco el poema, que usa el poema base)
+    os.environ['IMAGE_BACKEND'] = 'fake'
+    os.environ['GEMINI_API_KEY'] = ''
+    os.environ['FAKE_IMAGE_LATENCY_MS'] = str(fake_latency_ms)
+    os.environ.setdefault('FAKE_IMAGE_RPM', '100000')
+    os.environ.setdefault('JOBS_BACKEND', 'memory')
+    os.environ.setdefault('RATE_LIMIT_BACKEND', 'memory')
+    sys.path.insert(0, work)
+    os.chdir(work)
+    import app as service
+    return service
+
+
+def _shutdown(service) -> None:
+    # Cierre explícito de lo que deja procesos o hilos vivos: los hijos del pool de imágenes heredan
+    # stdout y, sin cerrarlos, un `| tail` esperaría a que terminen
+    service.IMAGE_POOL.shutdown()
+    service.JOB_QUEUE.shutdown()
+    service.FIRESTORE_WRITER.close()
+
+
+def _use_firestore(service, enabled: bool) -> None:
+    # Sin emulador se fuerza el modo sin Firestore: nunca escribir en un proyecto real
+    with service._db_lock:
+        service._db, service._db_ready = None, not enabled
+
+
+def _wait_job(client, job_id: str, timeout_s: float = 120.0) -> tuple[dict, int]:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        res = client.get(f'/api/jobs/{job_id}')
+        job = res.get_json()
+        if job.get('state') in ('done', 'failed'):
+            if job['state'] == 'failed':
+                raise RuntimeError(job.get('error') or 'trabajo fallido')
+            return job, len(res.data)
+        time.sleep(0.01)
+    raise TimeoutError(f'Trabajo {job_id} sin terminar en {timeout_s}s')
+
+
+def bench_upload(service, images: list[bytes], requests: int, concurrency: int) -> tuple[dict, list[str]]:
+    urls = [None] * len(images)
+
+    def fn(client, i):
+        res = client.post('/upload', data={'image': (BytesIO(images[i % len(images)]), f'bench{i}.jpg')},
+                          content_type='multipart/form-data')
+        if res.status_code != 200:
+            raise RuntimeError(f'/upload {res.status_code}')
+        urls[i % len(images)] = res.get_json()['image_url']
+        return len(res.data)
+
+    result = drive(service.app, 'upload', fn, max(requests, len(images)), concurrency)
+    return result, [u for u in urls if u]
+
+
+def bench_transform(service, urls: list[str], requests: int, concurrency: int, cached: bool, run_id: str) -> dict:
+    def params(i):
+        disfraz = DISFRACES[i % len(DISFRACES)]
+        image_url = urls[(i // len(DISFRACES)) % len(urls)]
+        # En frío, extra_prompt único por petición: clave de caché nueva y llamada al backend
+        extra = f'bench-{run_id}' if cached else f'bench-{run_id}-{i}'
+        return {'image_url': image_url, 'disfraz': disfraz, 'extra_prompt': extra, 'display_name': 'Benchmark'}
+
+    def fn(client, i):
+        res = client.post('/transform', data=params(i))
+        if res.status_code != 202:
+            raise RuntimeError(f'/transform {res.status_code}')
+        _job, size = _wait_job(client, res.get_json()['job_id'])
+        return len(res.data) + size
+
+    if cached:
+        # Calentar la caché con cada combinación (foto, disfraz) que se va a pedir
+        warm = service.app.test_client()
+        for i in range(min(requests, len(urls) * len(DISFRACES))):
+            res = warm.post('/transform', data=params(i))
+            _wait_job(warm, res.get_json()['job_id'])
+    return drive(service.app, 'transform_cached' if cached else 'transform_cold', fn, requests, concurrency)
+
+
+def _walk_gallery(service, name: str, pages: int, walkers: int) -> dict:
+    """Cada cliente recorre `pages` páginas siguiendo next_cursor; cada página es una muestra."""
+    latencies, sizes, errors = [], [], []
+    lock = threading.Lock()
+
+    def walk(_walker):
+        client = service.app.test_client()
+        cursor = None
+        for _ in range(pages):
+            url = '/api/gallery?limit=24' + (f'&cursor={cursor}' if cursor else '')
+            t0 = time.perf_counter()
+            res = client.get(url)
+            ms = (time.perf_counter() - t0) * 1000
+            if res.status_code != 200:
+                raise RuntimeError(f'/api/gallery {res.status_code}')
+            with lock:
+                latencies.append(ms)
+                sizes.append(len(res.data))
+            cursor = res.get_json().get('next_cursor')
+            if not cursor:
+                break
+
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, walkers)) as pool:
+            for future in [pool.submit(walk, w) for w in range(walkers)]:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(str(e))
+        elapsed = time.perf_counter() - start
+    return {
+        'name': name,
+        'requests': len(latencies),
+        'concurrency': walkers,
+        'pages_per_client': pages,
+        'errors': len(errors),
+        'error_sample': errors[:3],
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'p50_ms': _pct(latencies, 0.50),
+        'p95_ms': _pct(latencies, 0.95),
+        'p99_ms': _pct(latencies, 0.99),
+        'bytes_total': sum(sizes),
+        'bytes_mean': round(statistics.mean(sizes), 1) if sizes else None,
+        'peak_rss_mb': rss.peak,
+    }
+
+
+def _seed_gallery_index(service, size: int, filenames: list[str]) -> None:
+    import sqlite3
+    now = time.time()
+    rows = [(now - i, filenames[i % len(filenames)], DISFRACES[i % len(DISFRACES)], 'Benchmark',
+             json.dumps(['uno', 'dos', 'tres'])) for i in range(size)]
+    with sqlite3.connect(service.GALLERY_INDEX.db_path, timeout=30, isolation_level=None) as conn:
+        conn.execute('BEGIN')
+        conn.execute('DELETE FROM items')
+        conn.executemany('INSERT INTO items (ts, filename, disfraz, display_name, poem_lines) VALUES (?, ?, ?, ?, ?)', rows)
+        conn.execute('COMMIT')
+
+
+def _seed_firestore(service, size: int, filenames: list[str]) -> None:
+    from batch import FIRESTORE_BATCH_LIMIT, FirestoreBatchWriter
+    db = service.get_db()
+    project = getattr(db, 'project', None) or 'demo'
+    # Vaciar el emulador (sólo existe en el emulador: nunca en un proyecto real)
+    req = urllib.request.Request(
+        f"http://{os.environ['FIRESTORE_EMULATOR_HOST']}/emulator/v1/projects/{project}/databases/(default)/documents",
+        method='DELETE')
+    urllib.request.urlopen(req, timeout=30).read()
+    writer = FirestoreBatchWriter(db, 'transformaciones_halloween', max_ops=FIRESTORE_BATCH_LIMIT)
+    base = datetime.utcnow()
+    for i in range(size):
+        name = filenames[i % len(filenames)]
+        writer.add({
+            'timestamp': (base - timedelta(seconds=i)).isoformat(),
+            'estado': 'generated_ai',
+            'transformed_image_url': f'/results/{name}',
+            'transformed_mime': 'image/webp',
+            'disfraz': DISFRACES[i % len(DISFRACES)],
+            'display_name': 'Benchmark',
+            'poem_lines': ['uno', 'dos', 'tres'],
+        })
+    writer.flush()
+
+
+def run_micro(service, images: list[bytes], urls: list[str], iterations: int) -> list[dict]:
+    from encoding import encode_result
+    out = []
+    upload_hash = service._upload_hash_from_url(urls[0]) if urls else 'x' * 32
+    # Incluye la consulta de la versión del disfraz en el registro, como el pipeline
+    out.append(micro('digest_image_and_disfraz', lambda i: service._digest_image_and_disfraz(
+        upload_hash, DISFRACES[i % len(DISFRACES)], f'extra{i}', 'bg', 'fake-image',
+        service.COSTUMES.get(DISFRACES[i % len(DISFRACES)]).version), iterations))
+    key = service._digest_image_and_disfraz(upload_hash, 'witch', '', 'bg', 'fake-image',
+                                            service.COSTUMES.get('witch').version)
+    if service.RESULT_CACHE.get(key, count=False) is None:
+        encoded, _stats = encode_result(images[0])
+        service.RESULT_CACHE.put(key, encoded)
+    out.append(micro('result_cache_get_hit', lambda i: service.RESULT_CACHE.get(key, count=False), iterations))
+    out.append(micro('result_cache_get_miss', lambda i: service.RESULT_CACHE.get(f'{i:032x}', count=False), iterations))
+    out.append(micro('gallery_index_page', lambda i: service.GALLERY_INDEX.page(24), iterations))
+    out.append(micro('encode_result', lambda i: encode_result(images[i % len(images)]), max(1, min(iterations, 5))))
+    return out
+
+
+def compare(report: dict, baseline: dict) -> None:
+    """Añade a cada escenario el cociente actual/anterior (>1 en latencia = más lento)."""
+    previous = {s['name']: s for s in baseline.get('scenarios', []) if 'skipped' not in s}
+    for scenario in report['scenarios']:
+        old = previous.get(scenario['name'])
+        if not old or 'skipped' in scenario:
+            continue
+        delta = {}
+        for field in ('p50_ms', 'p95_ms', 'p99_ms', 'rps', 'bytes_mean', 'peak_rss_mb'):
+            if scenario.get(field) and old.get(field):
+                delta[field] = round(scenario[field] / old[field], 3)
+        scenario['vs_baseline'] = delta
+    report['baseline_commit'] = baseline.get('commit')
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', '-C', BASE_DIR, 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args) -> dict:
+    paths = sorted(p for p in glob.glob(args.images) if os.path.isfile(p))
+    if not paths:
+        raise SystemExit(f'No hay imágenes en {args.images}')
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+
+    commit = _git_commit()
+    work = _stage_tree()
+    service = None
+    try:
+        service = _load_app(work, args.fake_latency_ms)
+        _use_firestore(service, False)
+        run_id = str(int(time.time()))
+        scenarios = []
+
+        upload, urls = bench_upload(service, images, args.requests, args.concurrency)
+        scenarios.append(upload)
+        scenarios.append(bench_transform(service, urls, args.requests, args.concurrency, False, run_id))
+        scenarios.append(bench_transform(service, urls, args.requests, args.concurrency, True, run_id))
+
+        results_folder = service.RESULTS_FOLDER
+        filenames = sorted(n for n in os.listdir(results_folder) if n.endswith('.webp'))
+        for size in args.gallery_sizes:
+            _seed_gallery_index(service, size, filenames)
+            scenarios.append(_walk_gallery(service, f'gallery_fs_{size}', args.gallery_pages, args.concurrency))
+
+        micro_results = run_micro(service, images, urls, args.micro_iterations)
+
+        if os.environ.get('FIRESTORE_EMULATOR_HOST'):
+            _use_firestore(service, True)
+            if service.get_db() is None:
+                scenarios.extend({'name': f'gallery_firestore_{s}', 'skipped': 'cliente de Firestore no disponible'}
+                                 for s in args.gallery_sizes)
+            else:
+                for size in args.gallery_sizes:
+                    _seed_firestore(service, size, filenames)
+                    scenarios.append(_walk_gallery(service, f'gallery_firestore_{size}', args.gallery_pages, args.concurrency))
+        else:
+            scenarios.extend({'name': f'gallery_firestore_{s}', 'skipped': 'FIRESTORE_EMULATOR_HOST no definido'}
+                             for s in args.gallery_sizes)
+    finally:
+        if service is not None:
+            _shutdown(service)
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    return {
+        'benchmark': 'service',
+        'commit': commit,
+        'started_at': datetime.utcnow().isoformat(),
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'fake_latency_ms': args.fake_latency_ms,
+            'images': len(images),
+            'gallery_sizes': args.gallery_sizes,
+            'gallery_pages': args.gallery_pages,
+            'image_pool_workers': os.environ.get('IMAGE_POOL_WORKERS', ''),
+            'jobs_workers': os.environ.get('JOBS_WORKERS', '4'),
+        },
+        'scenarios': scenarios,
+        'micro': micro_results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50, help='Peticiones por escenario de /upload y /transform')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--fake-latency-ms', type=float, default=300.0, help='Latencia simulada del modelo de imagen')
+    parser.add_argument('--gallery-sizes', default='100,100000', help='Resultados en la galería (separados por comas)')
+    parser.add_argument('--gallery-pages', type=int, default=20, help='Páginas que recorre cada cliente de la galería')
+    parser.add_argument('--micro-iterations', type=int, default=1000)
+    parser.add_argument('--images', default=os.path.join(BASE_DIR, 'uploads', '*'))
+    parser.add_argument('--baseline', help='JSON de una corrida anterior para comparar')
+    parser.add_argument('--output', help='Guardar el JSON también en este archivo')
+    parser.add_argument('--keep', action='store_true', help='No borrar la copia temporal del árbol')
+    args = parser.parse_args()
+    args.gallery_sizes = [int(s) for s in args.gallery_sizes.split(',') if s.strip()]
+
+    # Los registros de la app van a stderr: stdout queda sólo para el JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
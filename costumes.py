@@ -0,0 +1,100 @@
+# Registro de disfraces: prompts de edición (con fondo temático / conservando el fondo), tema del
+# poema, sonido, tinte del backend fake y versión de cada disfraz, cargados una vez al arrancar desde
+# un archivo de datos (costumes.json o COSTUMES_PATH). Añadir o ajustar un disfraz es un cambio de
+# datos. La versión de cada disfraz (campo `version` + huella de sus prompts y su tinte) entra en la
+# clave de la caché de resultados: editar un prompt invalida sólo los resultados de ese disfraz.
+import hashlib
+import json
+import os
+
+# Plantilla del poema (modelo de texto); {theme} sale del registro y {name} de la petición
+POEM_PROMPT = (
+    "Actúa como poeta en español latino. Escribe exactamente 3 versos libres, uno por línea, "
+    "sin numeración ni comillas, máximo 300 caracteres por verso. Tema: Halloween y la figura "
+    "‘{theme}’. Integra el nombre ‘{name}’ de forma sutil y elegante (no lo repitas en todas las líneas). "
+    "Tono cinematográfico y metáforas sensoriales. Evita clichés obvios, rimas forzadas, emojis y signos innecesarios. "
+    "Devuélveme solo las tres líneas separadas por saltos de línea."
+)
+
+_DEFAULT_TINT = ((15, 25, 45), (225, 240, 255))
+
+
+class Costume:
+    """Un disfraz del registro. Los prompts quedan armados al cargar; sólo se añade el extra del usuario."""
+
+    def __init__(self, key: str, data: dict):
+        prompts = data.get('prompts') or {}
+        if not prompts.get('thematic_bg') or not prompts.get('keep_bg'):
+            raise ValueError(f"Disfraz '{key}': faltan prompts.thematic_bg / prompts.keep_bg")
+        self.key = key
+        self.label = str(data.get('label') or key)
+        self.prompt_thematic_bg = str(prompts['thematic_bg']).strip()
+        self.prompt_keep_bg = str(prompts['keep_bg']).strip()
+        self.poem_theme = str(data.get('poem_theme') or key).strip()
+        self.sound = data.get('sound') or None
+        tint = data.get('tint') or _DEFAULT_TINT
+        self.tint = (tuple(int(c) for c in tint[0]), tuple(int(c) for c in tint[1]))
+        # Huella de lo que decide la imagen generada; `version` permite invalidar a mano (p. ej. al
+        # cambiar de modelo) sin tocar los prompts
+        h = hashlib.blake2b(digest_size=6)
+        h.update(self.prompt_thematic_bg.encode('utf-8'))
+        h.update(b'\0')
+        h.update(self.prompt_keep_bg.encode('utf-8'))
+        h.update(repr(self.tint).encode('utf-8'))
+        self.version = f"{data.get('version', 1)}-{h.hexdigest()}"
+
+    def prompt(self, use_thematic_bg: bool = True, extra_prompt: str = '') -> str:
+        prompt = self.prompt_thematic_bg if use_thematic_bg else self.prompt_keep_bg
+        if extra_prompt:
+            prompt = f"{prompt} Additional details: {extra_prompt}"
+        return prompt
+
+    def public(self) -> dict:
+        return {'id': self.key, 'label': self.label, 'sound': self.sound, 'version': self.version}
+
+
+class CostumeRegistry:
+    def __init__(self, costumes: dict[str, Costume], default: str):
+        if not costumes:
+            raise ValueError('El registro de disfraces está vacío')
+        if default not in costumes:
+            raise ValueError(f"Disfraz por defecto desconocido: {default}")
+        self.costumes = costumes
+        self.default = default
+
+    @classmethod
+    def load(cls, path: str) -> 'CostumeRegistry':
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        costumes = {key: Costume(key, item) for key, item in (data.get('costumes') or {}).items()}
+        return cls(costumes, data.get('default') or next(iter(costumes), ''))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.costumes
+
+    def keys(self) -> list[str]:
+        return list(self.costumes)
+
+    def get(self, key: str) -> Costume:
+        """Disfraz por clave; los desconocidos usan el disfraz por defecto (como antes, 'ghost')."""
+        return self.costumes.get((key or '').strip()) or self.costumes[self.default]
+
+    def poem_theme(self, key: str) -> str:
+        # Disfraces fuera del registro: el nombre tal cual, como tema del poema
+        key = (key or '').strip()
+        return self.costumes[key].poem_theme if key in self.costumes else (key or 'fantasma')
+
+    def public(self) -> list[dict]:
+        return [costume.public() for costume in self.costumes.values()]
+
+    def stats(self) -> dict:
+        return {'costumes': len(self.costumes), 'default': self.default,
+                'versions': {key: c.version for key, c in self.costumes.items()}}
+
+
+def create_costume_registry(base_dir: str) -> CostumeRegistry:
+    """Carga COSTUMES_PATH (por defecto costumes.json junto a la app). Un archivo inválido corta el arranque."""
+    path = os.environ.get('COSTUMES_PATH', '').strip() or os.path.join(base_dir, 'costumes.json')
+    registry = CostumeRegistry.load(path)
+    print(f"[Disfraces] {len(registry.costumes)} cargados desde {os.path.basename(path)}")
+    return registry
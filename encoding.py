@@ -0,0 +1,166 @@
+# Codificador WebP adaptativo para los resultados.
+# En lugar de la escalera fija de calidades [80, 70, 60, 50] con method=6 en cada intento,
+# predice la calidad inicial a partir del tamaño/entropía de la imagen, busca por bisección
+# con un esfuerzo barato (method bajo) y hace una sola pasada final de alto esfuerzo.
+import os
+import time
+from io import BytesIO
+
+from PIL import Image
+
+DEFAULT_BUDGET_BYTES = 900 * 1024
+MAX_QUALITY = 80
+MIN_QUALITY = 50
+QUALITY_STEP = 5
+PROBE_METHOD = 2
+FINAL_METHOD = 6
+
+# Bits por píxel esperados a MAX_QUALITY por cada bit de entropía (estimación conservadora:
+# en fotos medidas queda entre 0.05 y 0.25). Si el presupuesto lo cubre no hace falta sondear.
+_BPP_PER_ENTROPY = 0.3
+
+
+def result_budget_bytes() -> int:
+    try:
+        return int(os.environ.get('RESULT_MAX_BYTES', str(DEFAULT_BUDGET_BYTES)))
+    except Exception:
+        return DEFAULT_BUDGET_BYTES
+
+
+def final_method() -> int:
+    try:
+        return max(0, min(6, int(os.environ.get('RESULT_WEBP_METHOD', str(FINAL_METHOD)))))
+    except Exception:
+        return FINAL_METHOD
+
+
+def _entropy(img: Image.Image) -> float:
+    # Sobre una miniatura en gris: suficiente para estimar la complejidad y casi gratis
+    thumb = img.convert('L')
+    thumb.thumbnail((256, 256))
+    return thumb.entropy()
+
+
+def predict_quality(width: int, height: int, entropy: float, budget: int) -> tuple[int, bool]:
+    """Devuelve (calidad inicial, confiable). `confiable` = el presupuesto sobra a calidad máxima.
+
+    Si no sobra, la calidad es la que cabría en el presupuesto según el tamaño estimado a calidad
+    máxima (entropía x píxeles) y el mismo modelo lineal que calibra el sondeo.
+    """
+    pixels = max(1, width * height)
+    expected_bytes = max(0.1, _BPP_PER_ENTROPY * entropy) * pixels / 8
+    if budget >= expected_bytes:
+        return MAX_QUALITY, True
+    return _quality_from_probe(int(expected_bytes), budget), False
+
+
+def _quality_from_probe(size_at_max: int, budget: int) -> int:
+    # Modelo lineal aproximado del tamaño respecto a la calidad: size(q) ≈ size(80) * (0.3 + 0.7 * q / 80)
+    q = MAX_QUALITY * (budget / max(1, size_at_max) - 0.3) / 0.7
+    q = int(q // QUALITY_STEP * QUALITY_STEP)
+    return max(MIN_QUALITY, min(MAX_QUALITY - QUALITY_STEP, q))
+
+
+def _encode(img: Image.Image, quality: int, method: int, attempts: list) -> bytes:
+    t0 = time.perf_counter()
+    buf = BytesIO()
+    img.save(buf, format='WEBP', quality=quality, method=method)
+    data = buf.getvalue()
+    attempts.append({
+        'quality': quality, 'method': method, 'bytes': len(data),
+        'ms': round((time.perf_counter() - t0) * 1000, 2),
+    })
+    return data
+
+
+def encode_webp(img: Image.Image, budget: int | None = None) -> tuple[bytes, dict]:
+    """Codifica `img` en WebP bajo `budget` bytes. Devuelve (bytes, estadísticas por intento)."""
+    budget = budget or result_budget_bytes()
+    method = final_method()
+    t0 = time.perf_counter()
+    attempts: list[dict] = []
+    w, h = img.size
+    quality, confident = predict_quality(w, h, _entropy(img), budget)
+
+    data = None
+    if confident:
+        data = _encode(img, quality, method, attempts)
+        if len(data) > budget:
+            data = None
+
+    if data is None:
+        grid = list(range(MIN_QUALITY, MAX_QUALITY + 1, QUALITY_STEP))
+        if confident:
+            # La pasada a calidad máxima no cupo: su tamaño real calibra el primer sondeo
+            start = _quality_from_probe(attempts[-1]['bytes'], budget)
+            hi = len(grid) - 2
+        else:
+            # Sin pasada previa: el primer sondeo es la calidad estimada por entropía
+            start = quality
+            hi = len(grid) - 1
+        # Bisección sobre la rejilla con esfuerzo bajo (method barato)
+        lo = 0
+        best = None
+        probe = grid.index(start)
+        while lo <= hi:
+            size = len(_encode(img, grid[probe], PROBE_METHOD, attempts))
+            if size <= budget:
+                best = probe
+                lo = probe + 1
+            else:
+                hi = probe - 1
+            probe = (lo + hi) // 2
+        idx = best if best is not None else 0
+        data = _encode(img, grid[idx], method, attempts)
+        # La pasada final comprime mejor que el sondeo, pero por seguridad bajamos si se pasa
+        while len(data) > budget and idx > 0:
+            idx -= 1
+            data = _encode(img, grid[idx], method, attempts)
+
+    stats = {
+        'quality': attempts[-1]['quality'],
+        'bytes': len(data),
+        'budget': budget,
+        'ms': round((time.perf_counter() - t0) * 1000, 2),
+        'attempts': attempts,
+    }
+    return data, stats
+
+
+def encode_result(image_bytes: bytes, max_side: int = 1024, budget: int | None = None) -> tuple[bytes, dict]:
+    """Decodifica, limita el lado mayor a `max_side` y codifica en WebP bajo presupuesto.
+
+    Función de nivel de módulo (serializable) para ejecutarse en el pool de procesos.
+    """
+    t0 = time.perf_counter()
+    img = Image.open(BytesIO(image_bytes)).convert('RGB')
+    t1 = time.perf_counter()
+    w, h = img.size
+    scale = min(1.0, max_side / max(w, h))
+    if scale < 1.0:
+        img = img.resize((int(w*scale), int(h*scale)), Image.LANCZOS)
+    t2 = time.perf_counter()
+    data, stats = encode_webp(img, budget)
+    # Tiempos de cada etapa dentro del proceso del pool (el llamador mide además la espera en cola)
+    stats['decode_ms'] = round((t1 - t0) * 1000, 2)
+    stats['resize_ms'] = round((t2 - t1) * 1000, 2)
+    return data, stats
+
+
+def encode_webp_ladder(img: Image.Image, budget: int = DEFAULT_BUDGET_BYTES) -> tuple[bytes, dict]:
+    """Escalera original ([80, 70, 60, 50] con method=6), conservada como referencia para benchmarks."""
+    t0 = time.perf_counter()
+    attempts: list[dict] = []
+    data = None
+    for q in (80, 70, 60, 50):
+        data = _encode(img, q, 6, attempts)
+        if len(data) <= budget:
+            break
+    stats = {
+        'quality': attempts[-1]['quality'],
+        'bytes': len(data),
+        'budget': budget,
+        'ms': round((time.perf_counter() - t0) * 1000, 2),
+        'attempts': attempts,
+    }
+    return data, stats
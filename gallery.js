@@ -22,12 +22,28 @@
 
   let isLoading = false;
   let endReached = false;
-  let cursor = null;     // Firestore cursor (timestamp ISO)
-  let offset = 0;        // Filesystem offset
+  let cursor = null;     // next_cursor opaco (Firestore o índice local)
+  let offset = 0;        // Offset (servidores antiguos sin cursor)
   const limit = 24;
   let mode = null;       // 'fs' | 'fs_guess' | 'firestore'
   const allItems = [];   // mantener orden para lightbox
   let lbIndex = -1;
+  // Sonido por disfraz; se completa con el registro del servidor (/api/costumes)
+  const costumeSounds = {
+    'vampire': 'static/sounds/vampire_sound.mp3',
+    'witch': 'static/sounds/witch_sound.mp3',
+    'zombie': 'static/sounds/zombie_sound.mp3',
+    'werewolf': 'static/sounds/werewolf_sound.mp3',
+    'ghost': 'static/sounds/ghost_sound.mp3'
+  };
+  fetch('/api/costumes')
+    .then(resp => resp.ok ? resp.json() : null)
+    .then(data => {
+      (data && Array.isArray(data.items) ? data.items : []).forEach(item => {
+        if (item.sound) costumeSounds[item.id] = item.sound;
+      });
+    })
+    .catch(() => {});
 
   // ---- Narrativa y audio helpers (para lightbox) ----
   function emojiFor(disfraz){
@@ -308,6 +324,12 @@
         params.set('offset', String(offset));
       }
       const res = await fetch(`/api/gallery?${params.toString()}`);
+      if (res.status === 503) {
+        // Firestore no respondió a mitad de la paginación: conservar el cursor y reintentar
+        const wait = Number(res.headers.get('Retry-After') || '2') * 1000;
+        setTimeout(fetchPage, wait);
+        return;
+      }
       if (!res.ok) throw new Error(`HTTP ${res.status}`);
       const data = await res.json();
 
@@ -335,7 +357,14 @@
         const card = document.createElement('div');
         card.className = 'gallery-card';
         const img = document.createElement('img');
-        img.src = it.data_url || it.image_url;
+        // Grilla: miniatura (srcset 256/512) en lugar del original de 1024px; el lightbox usa el tamaño completo
+        if (it.srcset) {
+          img.srcset = it.srcset;
+          img.sizes = '(max-width: 600px) 50vw, 260px';
+        }
+        img.src = it.thumb_url || it.data_url || it.image_url;
+        img.loading = 'lazy';
+        img.decoding = 'async';
         img.alt = 'Imagen transformada';
         img.style.cursor = 'zoom-in';
         card.appendChild(img);
@@ -369,15 +398,11 @@
         cursor = data.next_cursor || null;
         if (!cursor || items.length < limit) endReached = true;
       } else {
-        const nextOffset = typeof data.next_offset === 'number' ? data.next_offset : offset + items.length;
-        if (nextOffset === offset) {
+        // Sin next_cursor ni next_offset no hay más páginas
+        if (typeof data.next_offset !== 'number' || data.next_offset === offset) {
           endReached = true;
         } else {
-          offset = nextOffset;
-          if (items.length < limit && typeof data.next_offset === 'undefined') {
-            // Sin next_offset y menos de limit -> asumir fin
-            endReached = true;
-          }
+          offset = data.next_offset;
         }
       }
     } catch (e) {
@@ -435,16 +460,9 @@
       }
       // Sonido por disfraz
       try {
-        const soundMap = {
-          'vampire': 'static/sounds/vampire_sound.mp3',
-          'witch': 'static/sounds/witch_sound.mp3',
-          'zombie': 'static/sounds/zombie_sound.mp3',
-          'werewolf': 'static/sounds/werewolf_sound.mp3',
-          'ghost': 'static/sounds/ghost_sound.mp3'
-        };
         if (lb.sound) {
           lb.sound.pause();
-          lb.sound.src = soundMap[disfraz] || '';
+          lb.sound.src = costumeSounds[disfraz] || '';
           lb.sound.currentTime = 0;
           // Ocultar controles por defecto; sólo mostrarlos si falla autoplay
           lb.sound.style.display = 'none';
@@ -0,0 +1,141 @@
+# Índice local de la galería (fallback sin Firestore): cada resultado escrito por /transform se
+# registra en SQLite con su timestamp y metadatos, y /api/gallery pagina por clave (ts, id)
+# en lugar de listar results/ y ordenar todos los archivos en cada petición.
+import base64
+import json
+import os
+import sqlite3
+import time
+
+
+class GalleryIndex:
+    def __init__(self, results_folder: str, db_path: str | None = None, verify_files: bool = True):
+        self.results_folder = results_folder
+        # False con almacén compartido: un archivo sin copia local se sirve desde el almacén
+        self.verify_files = verify_files
+        self.db_path = db_path or os.path.join(results_folder, '.gallery.sqlite3')
+        os.makedirs(results_folder, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS items ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, filename TEXT NOT NULL,'
+                ' disfraz TEXT NOT NULL DEFAULT \'\', display_name TEXT NOT NULL DEFAULT \'\','
+                ' poem_lines TEXT NOT NULL DEFAULT \'[]\')'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS items_ts ON items(ts, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS items_disfraz_ts ON items(disfraz, ts, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS items_filename ON items(filename)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(self, filename: str, disfraz: str = '', display_name: str = '',
+            poem_lines: list[str] | None = None, ts: float | None = None) -> int:
+        with self._connect() as conn:
+            cur = conn.execute(
+                'INSERT INTO items (ts, filename, disfraz, display_name, poem_lines) VALUES (?, ?, ?, ?, ?)',
+                (ts or time.time(), filename, disfraz or '', display_name or '', json.dumps(poem_lines or []))
+            )
+            return cur.lastrowid
+
+    def has_file(self, filename: str, newest: int = 0) -> bool:
+        """True si el archivo está en el índice; con `newest`, sólo si está entre los `newest` más recientes."""
+        with self._connect() as conn:
+            if newest <= 0:
+                return conn.execute('SELECT 1 FROM items WHERE filename = ? LIMIT 1', (filename,)).fetchone() is not None
+            return conn.execute(
+                'SELECT 1 FROM (SELECT filename FROM items ORDER BY ts DESC, id DESC LIMIT ?) WHERE filename = ? LIMIT 1',
+                (newest, filename)).fetchone() is not None
+
+    def remove_file(self, filename: str) -> int:
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM items WHERE filename = ?', (filename,)).rowcount
+
+    def backfill(self, exts: set[str]) -> int:
+        """Registra una sola vez los resultados que ya existían en results/ antes del índice."""
+        with self._connect() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE name = 'backfilled'").fetchone():
+                return 0
+            known = {r['filename'] for r in conn.execute('SELECT DISTINCT filename FROM items')}
+            rows = []
+            for name in os.listdir(self.results_folder):
+                path = os.path.join(self.results_folder, name)
+                if name.startswith('.') or name in known or os.path.splitext(name)[1].lower() not in exts:
+                    continue
+                if os.path.isfile(path):
+                    rows.append((os.path.getmtime(path), name))
+            conn.execute('BEGIN')
+            conn.executemany('INSERT INTO items (ts, filename) VALUES (?, ?)', sorted(rows))
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('backfilled', ?)", (str(time.time()),))
+            conn.execute('COMMIT')
+        if rows:
+            print(f"[Gallery] Índice local: {len(rows)} resultados existentes registrados")
+        return len(rows)
+
+    def page(self, limit: int, cursor: str | None = None, disfraz: str | None = None) -> tuple[list[dict], str | None]:
+        """Página ordenada por (ts, id) descendente. Devuelve (items, siguiente cursor o None).
+
+        Las filas cuyo archivo ya no está se borran y se leen más hasta llenar la página: una página
+        corta haría creer al cliente que la galería terminó.
+        """
+        filters, filter_args = [], []
+        if disfraz:
+            filters.append('disfraz = ?')
+            filter_args.append(disfraz)
+        after = decode_cursor(cursor) if cursor else None
+        key = (float(after[0]), int(after[1])) if after and len(after) == 2 else None
+        items: list[dict] = []
+        more = False
+        with self._connect() as conn:
+            while True:
+                where, args = list(filters), list(filter_args)
+                if key:
+                    where.append('(ts, id) < (?, ?)')
+                    args.extend(key)
+                sql = 'SELECT id, ts, filename, disfraz, display_name, poem_lines FROM items'
+                if where:
+                    sql += ' WHERE ' + ' AND '.join(where)
+                sql += ' ORDER BY ts DESC, id DESC LIMIT ?'
+                want = limit - len(items)
+                rows = conn.execute(sql, args + [want + 1]).fetchall()
+                missing = []
+                for row in rows[:want]:
+                    key = (row['ts'], row['id'])
+                    # Resultados borrados por el conserje o a mano: quitarlos del índice al encontrarlos
+                    if self.verify_files and not os.path.isfile(os.path.join(self.results_folder, row['filename'])):
+                        missing.append(row['id'])
+                        continue
+                    items.append({
+                        'id': row['id'],
+                        'ts': row['ts'],
+                        'filename': row['filename'],
+                        'disfraz': row['disfraz'],
+                        'display_name': row['display_name'],
+                        'poem_lines': json.loads(row['poem_lines'] or '[]'),
+                    })
+                if missing:
+                    conn.executemany('DELETE FROM items WHERE id = ?', [(i,) for i in missing])
+                more = len(rows) > want
+                if len(items) >= limit or not more:
+                    break
+        next_cursor = encode_cursor(*key) if more and key else None
+        return items, next_cursor
+
+
+def encode_cursor(*parts) -> str:
+    """Cursor opaco para el cliente: los valores de la clave de orden del último ítem."""
+    raw = json.dumps(list(parts), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> list | None:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        parts = json.loads(raw)
+        return parts if isinstance(parts, list) else None
+    except Exception:
+        return None
@@ -0,0 +1,20 @@
+# Configuración de gunicorn para el modo ASGI: gunicorn -c gunicorn_asgi.py asgi:application
+# Pensada para E/S: las peticiones esperan al modelo, a Firestore o a clientes lentos, no a la CPU
+# (el trabajo de Pillow va al pool de procesos de la app).
+import os
+
+bind = f":{os.environ.get('PORT', '8080')}"
+worker_class = 'uvicorn.workers.UvicornWorker'
+# Un worker por contenedor (Cloud Run escala por instancias); la cola y la caché en memoria son por proceso
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+# Sin límite de inactividad: streams SSE y subidas lentas no deben matar al worker
+timeout = 0
+graceful_timeout = 30
+# Mayor que el idle timeout típico de los balanceadores (60 s) para reutilizar conexiones
+keepalive = 75
+
+# Los trabajos de /transform pasan casi todo el tiempo esperando al modelo: más hilos cuestan poca
+# memoria (la pila de un hilo en espera) y la cuota real la regula el limitador
+os.environ.setdefault('JOBS_WORKERS', '32')
+# Hilos que ejecutan la app Flask tras recibir el cuerpo completo de la petición
+os.environ.setdefault('ASGI_WSGI_THREADS', '32')
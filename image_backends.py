@@ -0,0 +1,228 @@
+# Backends del modelo de imagen detrás de una interfaz común: Imagen (generate_images), edición
+# Gemini (generate_content con la foto) y un sustituto local "fake" con Pillow (latencia, fallos
+# y 429 configurables) para pruebas de carga y benchmarks sin API key. El fake sin latencia ni
+# fallos sirve además de modo degradado: si el modelo real no responde (cuota agotada, error) se
+# devuelve la foto con el tinte del disfraz en lugar de la subida sin cambios.
+import base64
+import os
+import random
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+
+def tint_image(image_bytes: bytes, tint, max_side: int = 1024) -> bytes:
+    """Imagen "transformada" local: la foto en gris coloreada con el tinte del disfraz (sombras, luces)
+    y mezclada con el original. Determinista para (bytes, tinte). Función de módulo: se ejecuta en el pool."""
+    with Image.open(BytesIO(image_bytes)) as im:
+        im.draft('RGB', (max_side, max_side))
+        img = im.convert('RGB')
+    img.thumbnail((max_side, max_side))
+    dark, light = tint
+    tinted = ImageOps.colorize(ImageOps.grayscale(img), black=dark, white=light)
+    out = Image.blend(img, tinted, 0.6)
+    buf = BytesIO()
+    # PNG rápido: el resultado se vuelve a codificar a WebP en el pipeline
+    out.save(buf, format='PNG', compress_level=1)
+    return buf.getvalue()
+
+
+class ImageBackend:
+    """Interfaz: `generate(prompt, image_bytes, costume, call)` devuelve los bytes de la imagen.
+
+    `call(fn)` envuelve la llamada remota (cupo del limitador y reintentos ante 429); los backends
+    pasan por ahí la parte que cuenta como petición al modelo. `needs_input` indica si hace falta la
+    foto subida. `model` es el nombre que entra en la clave de caché y en el limitador. `costume` es
+    la entrada del registro de disfraces (costumes.py).
+    """
+    name = ''
+    mode = ''
+    needs_input = False
+
+    def __init__(self, model: str):
+        self.model = model
+
+    def generate(self, prompt: str, image_bytes: bytes | None, costume, call) -> bytes:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {'backend': self.name, 'model': self.model}
+
+
+class ImagenBackend(ImageBackend):
+    """Familia Imagen: genera a partir del prompt con `GenerativeModel.generate_images`."""
+    name = 'imagen'
+    mode = 'generate'
+
+    def __init__(self, clients, model: str, api_key: str):
+        super().__init__(model)
+        self.clients = clients
+        self.api_key = api_key
+
+    def generate(self, prompt: str, image_bytes: bytes | None, costume, call) -> bytes:
+        model = self.clients.generative_model(self.model, self.api_key)
+        result = call(lambda: model.generate_images(
+            prompt=prompt,
+            number_of_images=1,
+            size='1024x1024'
+        ))
+        img_b64 = None
+        if hasattr(result, 'images') and result.images:
+            first = result.images[0]
+            if isinstance(first, bytes):
+                img_b64 = base64.b64encode(first).decode('utf-8')
+            elif isinstance(first, str):
+                img_b64 = first
+            elif hasattr(first, 'data'):
+                img_b64 = base64.b64encode(first.data).decode('utf-8')
+        elif hasattr(result, 'generations') and result.generations:
+            gen0 = result.generations[0]
+            if hasattr(gen0, 'image') and hasattr(gen0.image, 'base64_data'):
+                img_b64 = gen0.image.base64_data
+        if not img_b64:
+            raise RuntimeError('No se obtuvo imagen de Gemini (sin datos)')
+        print(f"[Gemini] Imagen generada (en memoria)")
+        return base64.b64decode(img_b64)
+
+
+class GeminiEditBackend(ImageBackend):
+    """Familia Gemini: edita la foto subida con `client.models.generate_content([prompt, imagen])`."""
+    name = 'gemini'
+    mode = 'edit'
+    needs_input = True
+
+    def __init__(self, clients, model: str, api_key: str):
+        super().__init__(model)
+        self.clients = clients
+        self.api_key = api_key
+
+    def generate(self, prompt: str, image_bytes: bytes | None, costume, call) -> bytes:
+        image_in = Image.open(BytesIO(image_bytes))
+        client = self.clients.genai_client(self.api_key)
+        response = call(lambda: client.models.generate_content(
+            model=self.model,
+            contents=[prompt, image_in]
+        ))
+
+        # Buscar part con inline_data
+        out_bytes = None
+        parts_count = 0
+        try:
+            parts = response.candidates[0].content.parts
+            parts_count = len(parts)
+            for part in parts:
+                if getattr(part, 'inline_data', None) and getattr(part.inline_data, 'data', None):
+                    out_bytes = part.inline_data.data
+                    break
+        except Exception:
+            pass
+        if not out_bytes:
+            raise RuntimeError('La respuesta no contiene imagen (inline_data)')
+        print(f"[Gemini Edit] Imagen editada (en memoria) | parts={parts_count} inline=True")
+        return out_bytes
+
+
+class FakeImageBackend(ImageBackend):
+    """Sustituto local: latencia (+ jitter), fallos y 429 inyectados, y tinte Pillow por disfraz.
+
+    La salida es determinista para (foto, tinte del disfraz); los fallos siguen una secuencia fija por `seed`.
+    `runner(fn, *args)` ejecuta el tinte (p. ej. en el pool de procesos).
+    """
+    name = 'fake'
+    mode = 'fake'
+    needs_input = True
+
+    def __init__(self, model: str = 'fake-image', latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 failure_rate: float = 0.0, rate_429: float = 0.0, retry_delay_s: int = 5,
+                 rpm: float | None = None, seed: int = 0, runner=None):
+        super().__init__(model)
+        self.latency_ms = max(0.0, latency_ms)
+        self.jitter_ms = max(0.0, jitter_ms)
+        self.failure_rate = max(0.0, min(1.0, failure_rate))
+        self.rate_429 = max(0.0, min(1.0, rate_429))
+        self.retry_delay_s = max(0, retry_delay_s)
+        self.rpm = rpm
+        self.runner = runner or (lambda fn, *args: fn(*args))
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.throttled = 0
+
+    def _remote(self) -> None:
+        # Lo que en un backend real sería la petición HTTP al modelo
+        with self._lock:
+            self.calls += 1
+            jitter = self._rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+            roll = self._rng.random()
+        delay_s = max(0.0, self.latency_ms + jitter) / 1000.0
+        if delay_s:
+            time.sleep(delay_s)
+        if roll < self.rate_429:
+            with self._lock:
+                self.throttled += 1
+            raise RuntimeError(f"429 RESOURCE_EXHAUSTED (fake) {{'retryDelay': '{self.retry_delay_s}s'}}")
+        if roll < self.rate_429 + self.failure_rate:
+            with self._lock:
+                self.failures += 1
+            raise RuntimeError('Fallo inyectado por el backend fake')
+
+    def generate(self, prompt: str, image_bytes: bytes | None, costume, call) -> bytes:
+        call(self._remote)
+        return self.runner(tint_image, image_bytes, costume.tint)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(super().stats(), calls=self.calls, failures=self.failures, throttled=self.throttled)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def create_image_backend(clients, runner=None) -> ImageBackend | None:
+    """IMAGE_BACKEND=auto|imagen|gemini|fake (auto: según GEMINI_IMAGE_MODEL si hay GEMINI_API_KEY).
+
+    El fake se configura con FAKE_IMAGE_LATENCY_MS, FAKE_IMAGE_JITTER_MS, FAKE_IMAGE_FAILURE_RATE,
+    FAKE_IMAGE_429_RATE, FAKE_IMAGE_RPM y FAKE_IMAGE_SEED. Devuelve None si no hay backend utilizable.
+    """
+    kind = os.environ.get('IMAGE_BACKEND', 'auto').strip().lower() or 'auto'
+    if kind == 'fake':
+        backend = FakeImageBackend(
+            latency_ms=_env_float('FAKE_IMAGE_LATENCY_MS', 0.0),
+            jitter_ms=_env_float('FAKE_IMAGE_JITTER_MS', 0.0),
+            failure_rate=_env_float('FAKE_IMAGE_FAILURE_RATE', 0.0),
+            rate_429=_env_float('FAKE_IMAGE_429_RATE', 0.0),
+            rpm=_env_float('FAKE_IMAGE_RPM', 600.0),
+            seed=int(_env_float('FAKE_IMAGE_SEED', 0)),
+            runner=runner,
+        )
+        print(f"[ImageBackend] fake ({backend.latency_ms:g} ms, fallos {backend.failure_rate:g}, 429 {backend.rate_429:g})")
+        return backend
+
+    # Selección de modelo de imagen. Recomendado: 'imagen-3.0-fast' o 'imagen-3.0'.
+    model = os.environ.get('GEMINI_IMAGE_MODEL', 'imagen-3.0-fast')
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if kind == 'auto':
+        kind = 'imagen' if model.lower().startswith('imagen') else 'gemini'
+    if kind not in ('imagen', 'gemini'):
+        print(f"[Aviso] IMAGE_BACKEND desconocido: {kind}")
+        return None
+    if not api_key:
+        return None
+    if kind == 'imagen':
+        return ImagenBackend(clients, model, api_key)
+    return GeminiEditBackend(clients, model, api_key)
+
+
+def create_degraded_backend(runner=None) -> ImageBackend | None:
+    """IMAGE_DEGRADED_BACKEND=fake (por defecto) o vacío para devolver la subida sin cambios."""
+    kind = os.environ.get('IMAGE_DEGRADED_BACKEND', 'fake').strip().lower()
+    if kind == 'fake':
+        return FakeImageBackend(model='degraded', runner=runner)
+    return None
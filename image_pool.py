@@ -0,0 +1,153 @@
+# Pool de procesos para el trabajo CPU de Pillow (decodificar, redimensionar, codificar).
+# Así no compite por el GIL con los hilos que atienden peticiones y escala con los núcleos.
+# La cola está acotada: si se llena, las rutas síncronas responden 503 en lugar de acumular.
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+
+class ImagePoolBusy(RuntimeError):
+    """La cola del pool de imágenes está llena (back-pressure)."""
+
+
+def _cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except Exception:
+        return os.cpu_count() or 1
+
+
+def _pool_context():
+    """forkserver con image_worker precargado; spawn donde no existe.
+
+    Los hijos se bifurcan de un servidor limpio (sin los hilos de la app) que ya importó Pillow y
+    las funciones de las tareas. Como con spawn, cada hijo importa además el `__main__` del padre:
+    con gunicorn/uvicorn es su lanzador, barato; `python app.py` usa Pillow en el mismo proceso.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['image_worker'])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+
+class ImagePool:
+    def __init__(self, workers: int, max_pending: int):
+        # workers=0: ejecutar en el mismo proceso (desarrollo, Windows o depuración)
+        self.workers = max(0, workers)
+        self.max_pending = max(1, max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self.rejected = 0
+
+    def _reset_after_fork(self) -> None:
+        # Los procesos hijos del pool pertenecen al padre; cada worker de gunicorn crea el suyo
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                import image_worker
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context(),
+                                                     initializer=image_worker.init_worker)
+            return self._executor
+
+    def _discard_executor(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            # Otro hilo pudo recrearlo ya: no tirar el pool nuevo
+            if self._executor is not broken:
+                return
+            self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _acquire(self, block: bool, timeout: float | None) -> None:
+        acquired = self._slots.acquire(timeout=timeout) if block else self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self.rejected += 1
+            raise ImagePoolBusy('Pool de imágenes saturado, intenta de nuevo en unos segundos')
+        with self._lock:
+            self._pending += 1
+
+    def _release(self, _future=None) -> None:
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def _submit(self, executor: ProcessPoolExecutor, fn, args, block: bool, timeout: float | None):
+        self._acquire(block, timeout)
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # El hueco se libera cuando la tarea termina de verdad, no cuando el llamador deja de esperar
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, fn, *args, block: bool = False, timeout: float | None = None):
+        """Ejecuta fn(*args) en el pool y devuelve su resultado.
+
+        Con block=False lanza ImagePoolBusy si ya hay `max_pending` tareas en cola o en curso
+        (rutas síncronas -> 503). Con block=True espera turno (trabajos en segundo plano).
+        Si vence `timeout` esperando el resultado, la tarea sigue ocupando su hueco hasta terminar.
+        """
+        if self.workers == 0:
+            self._acquire(block, timeout)
+            try:
+                return fn(*args)
+            finally:
+                self._release()
+        executor = self._get_executor()
+        try:
+            future = self._submit(executor, fn, args, block, timeout)
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeoutError:
+                # Si aún no empezó, no llega a ocupar un proceso
+                future.cancel()
+                raise
+        except BrokenProcessPool:
+            # Un hijo murió (OOM, señal): recrear el pool y reintentar una vez
+            print('[ImagePool] Pool roto, recreando…')
+            self._discard_executor(executor)
+            return self._submit(self._get_executor(), fn, args, block, timeout).result(timeout=timeout)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Cierra los procesos hijos (apagado ordenado del worker o de un benchmark)."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'rejected': self.rejected,
+            }
+
+
+def create_image_pool() -> ImagePool:
+    """IMAGE_POOL_WORKERS (por defecto: núcleos disponibles; 0 = en proceso), IMAGE_POOL_MAX_PENDING."""
+    try:
+        workers = int(os.environ.get('IMAGE_POOL_WORKERS', str(_cpu_count())))
+    except Exception:
+        workers = _cpu_count()
+    try:
+        max_pending = int(os.environ.get('IMAGE_POOL_MAX_PENDING', str(max(1, workers) * 4)))
+    except Exception:
+        max_pending = max(1, workers) * 4
+    pool = ImagePool(workers, max_pending)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=pool._reset_after_fork)
+    return pool
@@ -0,0 +1,16 @@
+# Módulo de los procesos hijos del pool de imágenes (image_pool.py): el servidor forkserver lo
+# precarga una vez, así que cada hijo nace con Pillow y las funciones de las tareas ya importadas
+# y no necesita la app (Flask, Firestore, pools, hilos).
+import signal
+
+from encoding import encode_result
+from imaging import write_derivatives
+from ingest import normalize_upload
+
+# Tareas que la app envía al pool (funciones de nivel de módulo, serializables)
+TASKS = (encode_result, normalize_upload, write_derivatives)
+
+
+def init_worker() -> None:
+    # Ctrl+C llega a todo el grupo de procesos: lo atiende el padre, que cierra el pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -0,0 +1,101 @@
+# Derivados de resultados: tamaños fijos para la grilla de la galería (srcset) y variante AVIF opcional.
+# Se guardan en results/derived/<hash>-<ancho>.<formato> junto al original results/<hash>.webp.
+import os
+from io import BytesIO
+
+from PIL import Image, features
+
+DERIVED_DIRNAME = 'derived'
+DERIVATIVE_WIDTHS = (256, 512)
+FULL_WIDTH = 1024
+
+
+def avif_enabled() -> bool:
+    # AVIF es opcional: depende del entorno y de que Pillow tenga soporte compilado
+    if os.environ.get('RESULT_AVIF', '0').strip() not in ('1', 'true', 'True', 'yes'):
+        return False
+    try:
+        return bool(features.check('avif'))
+    except Exception:
+        return False
+
+
+def derived_name(result_hash: str, width: int | None, fmt: str) -> str:
+    return f"{result_hash}-{width or FULL_WIDTH}.{fmt}"
+
+
+def make_derivatives(image_bytes: bytes, avif: bool = False) -> dict[tuple[int, str], bytes]:
+    """Genera los derivados de un resultado. Devuelve {(ancho, formato): bytes}.
+
+    Los anchos mayores o iguales al original no se generan en WebP (se sirve el original);
+    la variante AVIF sí se genera también a tamaño completo.
+    """
+    img = Image.open(BytesIO(image_bytes))
+    img.load()
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    w, h = img.size
+    out = {}
+    for width in DERIVATIVE_WIDTHS + (FULL_WIDTH,):
+        if width < w:
+            resized = img.resize((width, max(1, round(h * width / w))), Image.LANCZOS)
+        elif width == FULL_WIDTH:
+            resized = img
+        else:
+            continue
+        if width != FULL_WIDTH:
+            buf = BytesIO()
+            resized.save(buf, format='WEBP', quality=75, method=4)
+            out[(width, 'webp')] = buf.getvalue()
+        if avif:
+            buf = BytesIO()
+            resized.save(buf, format='AVIF', quality=55, speed=8)
+            out[(width, 'avif')] = buf.getvalue()
+    return out
+
+
+def write_derivatives(results_folder: str, result_hash: str, image_bytes: bytes) -> list[str]:
+    """Escribe los derivados de un resultado (idempotente). Devuelve los nombres escritos."""
+    folder = os.path.join(results_folder, DERIVED_DIRNAME)
+    os.makedirs(folder, exist_ok=True)
+    written = []
+    for (width, fmt), data in make_derivatives(image_bytes, avif=avif_enabled()).items():
+        name = derived_name(result_hash, width, fmt)
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            continue
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        written.append(name)
+    # Marcador: los derivados de este hash ya se generaron (aunque el original sea pequeño y no haya archivos)
+    with open(os.path.join(folder, f"{result_hash}.ok"), 'w') as f:
+        f.write(','.join(written))
+    return written
+
+
+def derivatives_ready(results_folder: str, result_hash: str) -> bool:
+    return os.path.isfile(os.path.join(results_folder, DERIVED_DIRNAME, f"{result_hash}.ok"))
+
+
+def pick_derivative(results_folder: str, result_hash: str, width: int | None, accept_avif: bool) -> str | None:
+    """Elige el derivado existente más pequeño que cubra `width`. None = servir el original."""
+    folder = os.path.join(results_folder, DERIVED_DIRNAME)
+    candidates = [w for w in DERIVATIVE_WIDTHS if width and w >= width] + [FULL_WIDTH]
+    for w in candidates:
+        formats = ('avif', 'webp') if accept_avif else ('webp',)
+        for fmt in formats:
+            if w == FULL_WIDTH and fmt == 'webp':
+                return None
+            name = derived_name(result_hash, w, fmt)
+            if os.path.isfile(os.path.join(folder, name)):
+                return name
+    return None
+
+
+def srcset_for(result_url: str) -> str:
+    """srcset para una URL /results/<hash>.webp usando el parámetro ?w= del endpoint."""
+    parts = [f"{result_url}?w={w} {w}w" for w in DERIVATIVE_WIDTHS]
+    parts.append(f"{result_url} {FULL_WIDTH}w")
+    return ', '.join(parts)
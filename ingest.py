@@ -0,0 +1,184 @@
+# Normalización de subidas: la foto del cliente (a menudo JPEG de 10-20 MB del móvil) se guarda
+# en streaming con tope de tamaño, se orienta según EXIF, se reduce al lado máximo configurado y se
+# re-codifica sin metadatos. El resto del pipeline (hash, caché, payload al modelo) trabaja sobre
+# esta versión canónica pequeña. Un índice SQLite (uploads/.index.sqlite3) guarda hash, tamaño,
+# dimensiones y mime de cada archivo canónico, y resuelve subidas repetidas sin volver a decodificar.
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from result_cache import content_hash
+
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_MAX_SIDE = 1536
+CANONICAL_JPEG_QUALITY = 90
+_CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """La subida supera UPLOAD_MAX_BYTES."""
+
+
+class InvalidImage(ValueError):
+    """El archivo subido no es una imagen que Pillow pueda decodificar."""
+
+
+def upload_max_bytes() -> int:
+    try:
+        return int(os.environ.get('UPLOAD_MAX_BYTES', str(DEFAULT_MAX_BYTES)))
+    except Exception:
+        return DEFAULT_MAX_BYTES
+
+
+def upload_max_side() -> int:
+    try:
+        return max(256, int(os.environ.get('UPLOAD_MAX_SIDE', str(DEFAULT_MAX_SIDE))))
+    except Exception:
+        return DEFAULT_MAX_SIDE
+
+
+def stream_to_temp(stream, folder: str, max_bytes: int) -> tuple[str, str]:
+    """Copia el stream a un archivo temporal en `folder` por bloques, cortando al superar `max_bytes`.
+
+    Devuelve (ruta temporal, hash blake2b de los bytes originales) calculado durante la copia.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.incoming-')
+    total = 0
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if total > max_bytes:
+                    raise UploadTooLarge(f'La imagen supera el máximo de {max_bytes // (1024 * 1024)} MB')
+                h.update(chunk)
+                f.write(chunk)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except Exception:
+            pass
+        raise
+    return tmp_path, h.hexdigest()
+
+
+def normalize_upload(src_path: str, dest_folder: str, max_side: int) -> dict:
+    """Decodifica `src_path`, aplica orientación EXIF, reduce a `max_side` y guarda la versión canónica.
+
+    JPEG sin canal alfa, PNG si la imagen tiene transparencia; en ambos casos sin EXIF/ICC/XMP.
+    Función de nivel de módulo para ejecutarse en el pool de procesos. Devuelve
+    {'filename', 'hash', 'size', 'width', 'height', 'mime'}.
+    """
+    try:
+        img = Image.open(src_path)
+        # JPEG: decodificar directamente a escala 1/2, 1/4 o 1/8 (mucho más rápido que decodificar completo)
+        if img.format == 'JPEG':
+            img.draft('RGB', (max_side, max_side))
+        img.load()
+    except Image.DecompressionBombError:
+        raise InvalidImage('La imagen tiene demasiados píxeles')
+    except Exception as e:
+        print(f"[Upload] Imagen inválida: {e}")
+        raise InvalidImage('No se pudo leer la imagen (formato no soportado o archivo dañado)')
+
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buf = BytesIO()
+    if has_alpha:
+        img.save(buf, format='PNG', optimize=True)
+        ext, mime = 'png', 'image/png'
+    else:
+        img.save(buf, format='JPEG', quality=CANONICAL_JPEG_QUALITY, optimize=True)
+        ext, mime = 'jpg', 'image/jpeg'
+    data = buf.getvalue()
+    digest = content_hash(data)
+
+    filename = f"{digest}.{ext}"
+    final_path = os.path.join(dest_folder, filename)
+    if not os.path.isfile(final_path):
+        fd, tmp_path = tempfile.mkstemp(dir=dest_folder, prefix='.tmp-', suffix=f'.{ext}')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, final_path)
+    return {
+        'filename': filename,
+        'hash': digest,
+        'size': len(data),
+        'width': img.width,
+        'height': img.height,
+        'mime': mime,
+    }
+
+
+class UploadIndex:
+    """Índice de subidas canónicas: hash -> (archivo, tamaño, dimensiones, mime) y hash original -> hash."""
+
+    def __init__(self, folder: str, db_path: str | None = None):
+        self.folder = folder
+        self.db_path = db_path or os.path.join(folder, '.index.sqlite3')
+        os.makedirs(folder, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                ' hash TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL,'
+                ' width INTEGER NOT NULL, height INTEGER NOT NULL, mime TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE TABLE IF NOT EXISTS raw_hashes (raw_hash TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS raw_hashes_hash ON raw_hashes(hash)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _row(self, conn, where: str, value: str) -> dict | None:
+        row = conn.execute(
+            f'SELECT hash, filename, size, width, height, mime FROM uploads WHERE {where} = ?', (value,)
+        ).fetchone()
+        if row and os.path.isfile(os.path.join(self.folder, row['filename'])):
+            return dict(row)
+        return None
+
+    def get(self, content_hash: str) -> dict | None:
+        with self._connect() as conn:
+            return self._row(conn, 'hash', content_hash)
+
+    def get_by_filename(self, filename: str) -> dict | None:
+        with self._connect() as conn:
+            return self._row(conn, 'filename', filename)
+
+    def get_by_raw_hash(self, raw_hash: str) -> dict | None:
+        """Versión canónica ya guardada para unos bytes originales idénticos, si existe."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT hash FROM raw_hashes WHERE raw_hash = ?', (raw_hash,)).fetchone()
+            return self._row(conn, 'hash', row['hash']) if row else None
+
+    def forget_file(self, filename: str) -> None:
+        """Quita del índice una subida borrada (y los hashes originales que resolvían a ella)."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT hash FROM uploads WHERE filename = ?', (filename,)).fetchone()
+            if row:
+                conn.execute('DELETE FROM raw_hashes WHERE hash = ?', (row['hash'],))
+                conn.execute('DELETE FROM uploads WHERE hash = ?', (row['hash'],))
+
+    def add(self, info: dict, raw_hash: str | None = None) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO uploads (hash, filename, size, width, height, mime, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (info['hash'], info['filename'], info['size'], info['width'], info['height'], info['mime'], time.time())
+            )
+            if raw_hash:
+                conn.execute('INSERT OR REPLACE INTO raw_hashes (raw_hash, hash) VALUES (?, ?)', (raw_hash, info['hash']))
@@ -0,0 +1,409 @@
+# Retención de uploads/ y results/: en Cloud Run el sistema de archivos vive en memoria, así que
+# lo que no se borra ocupa RAM del contenedor. Un conserje en segundo plano aplica por carpeta una
+# edad máxima y un tope de bytes, respetando los archivos referenciados (caché de resultados,
+# índice de galería, Firestore), y limpia temporales, locks viejos y derivados huérfanos.
+# Trabajo incremental: un registro SQLite de archivos (alimentado al escribir y por un recorrido
+# del directorio de a `batch` entradas por pasada) evita listar y hacer stat de todo cada vez.
+import glob
+import os
+import sqlite3
+import stat
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl  # type: ignore
+except Exception:  # Windows: sin exclusión entre procesos
+    fcntl = None
+
+# Temporales que dejan las escrituras atómicas y las subidas cortadas a medias
+TEMP_PREFIXES = ('.tmp-', '.incoming-')
+
+
+class FolderPolicy:
+    """Retención de una carpeta: edad máxima y tope de bytes (0 = sin límite).
+
+    Nada más nuevo que `min_age_s` se toca (escrituras en curso, subidas a punto de transformarse).
+    """
+
+    def __init__(self, path: str, max_age_s: float = 0.0, max_bytes: int = 0, min_age_s: float = 900.0):
+        self.path = path
+        self.max_age_s = max(0.0, max_age_s)
+        self.max_bytes = max(0, max_bytes)
+        self.min_age_s = max(0.0, min_age_s)
+
+
+class Janitor:
+    def __init__(self, db_path: str, folders: dict[str, FolderPolicy], is_referenced=None, on_delete=None,
+                 derived_dir: str | None = None, locks_dir: str | None = None, batch: int = 500,
+                 interval_s: float = 60.0, temp_max_age_s: float = 3600.0, hold_s: float = 3600.0):
+        # is_referenced(carpeta, nombre) -> bool; on_delete(carpeta, nombre) -> bytes extra liberados
+        self.db_path = db_path
+        self.folders = folders
+        self.is_referenced = is_referenced or (lambda _folder, _name: False)
+        self.on_delete = on_delete
+        self.derived_dir = derived_dir
+        self.locks_dir = locks_dir
+        self.batch = max(10, batch)
+        self.interval_s = interval_s
+        self.temp_max_age_s = temp_max_age_s
+        self.hold_s = hold_s
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listings: dict[str, list[str]] = {}
+        self.passes = 0
+        self.reclaimed_bytes = 0
+        self.deleted: dict[str, dict[str, int]] = {}
+        self.last_pass: dict = {}
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                ' folder TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL,'
+                ' checked_at REAL NOT NULL, hold_until REAL NOT NULL DEFAULT 0, PRIMARY KEY (folder, name))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS files_age ON files(folder, mtime)')
+            conn.execute('CREATE INDEX IF NOT EXISTS files_checked ON files(checked_at)')
+
+    def _reset_after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listings = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # --- Registro de archivos ---
+
+    def track(self, folder: str, name: str, size: int) -> None:
+        """Registra un archivo recién escrito o reusado (así la pasada no necesita descubrirlo en el directorio).
+
+        Volver a registrarlo renueva su edad: un archivo reusado cuenta como nuevo para la retención.
+        """
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    'INSERT INTO files (folder, name, size, mtime, checked_at) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT(folder, name) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+                    'checked_at = excluded.checked_at',
+                    (folder, name, int(size), now, now)
+                )
+        except Exception as e:
+            print(f"[Janitor] No se pudo registrar {folder}/{name}: {e}")
+
+    def _next_names(self, key: str, path: str, n: int) -> list[str]:
+        # Listar sólo nombres (sin stat) una vez por vuelta completa y consumir la lista de a `n`
+        names = self._listings.get(key)
+        if not names:
+            try:
+                names = os.listdir(path)
+            except FileNotFoundError:
+                names = []
+            names.reverse()
+        out = [names.pop() for _ in range(min(n, len(names)))]
+        self._listings[key] = names
+        return out
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st
+
+    # --- Pasada ---
+
+    def run_pass(self, dry_run: bool = False) -> dict:
+        """Una pasada acotada a ~`batch` archivos por etapa. Devuelve el resumen (bytes liberados, etc.)."""
+        report = {'started': time.time(), 'deleted': {}, 'reclaimed_bytes': 0, 'held': 0, 'dry_run': dry_run}
+        with self._pass_lock() as acquired:
+            if not acquired:
+                report['skipped'] = 'otro worker está limpiando'
+                return report
+            now = time.time()
+            with self._connect() as conn:
+                for folder, policy in self.folders.items():
+                    self._discover(conn, folder, policy, now, report, dry_run)
+                self._verify(conn, now)
+                for folder, policy in self.folders.items():
+                    self._enforce(conn, folder, policy, now, report, dry_run)
+                    report.setdefault('bytes', {})[folder] = conn.execute(
+                        'SELECT COALESCE(SUM(size), 0) FROM files WHERE folder = ?', (folder,)).fetchone()[0]
+            self._sweep_derived(now, report, dry_run)
+            self._sweep_locks(now, report, dry_run)
+        report['seconds'] = round(time.time() - report['started'], 3)
+        with self._lock:
+            self.passes += 1
+            self.last_pass = report
+            if not dry_run:
+                self.reclaimed_bytes += report['reclaimed_bytes']
+                for folder, reasons in report['deleted'].items():
+                    totals = self.deleted.setdefault(folder, {})
+                    for reason, count in reasons.items():
+                        totals[reason] = totals.get(reason, 0) + count
+        if report['deleted']:
+            summary = ', '.join(f"{folder}: " + ', '.join(f"{n} por {reason}" for reason, n in reasons.items())
+                                for folder, reasons in report['deleted'].items())
+            verb = 'se liberarían' if dry_run else 'liberados'
+            print(f"[Janitor] {report['reclaimed_bytes'] / 1048576:.1f} MB {verb} ({summary})")
+        return report
+
+    @contextmanager
+    def _pass_lock(self):
+        # Un solo worker por host limpia a la vez (lock de archivo no bloqueante)
+        if fcntl is None:
+            yield True
+            return
+        with open(f"{self.db_path}.lock", 'a+') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _count(self, report: dict, folder: str, reason: str, size: int) -> None:
+        reasons = report['deleted'].setdefault(folder, {})
+        reasons[reason] = reasons.get(reason, 0) + 1
+        report['reclaimed_bytes'] += size
+
+    def _remove(self, path: str, dry_run: bool) -> bool:
+        if dry_run:
+            return os.path.exists(path)
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"[Janitor] No se pudo borrar {path}: {e}")
+            return False
+
+    def _discover(self, conn, folder: str, policy: FolderPolicy, now: float, report: dict, dry_run: bool) -> None:
+        # Archivos que no pasaron por track() (otros procesos, anteriores al registro) y temporales
+        rows = []
+        for name in self._next_names(folder, policy.path, self.batch):
+            path = os.path.join(policy.path, name)
+            if name.startswith(TEMP_PREFIXES):
+                st = self._stat(path)
+                if st is not None and now - st.st_mtime > self.temp_max_age_s and self._remove(path, dry_run):
+                    self._count(report, folder, 'temp', st.st_size)
+                continue
+            if name.startswith('.'):
+                continue  # índices SQLite, locks y demás estado interno
+            st = self._stat(path)
+            if st is None or not stat.S_ISREG(st.st_mode):
+                continue
+            rows.append((folder, name, st.st_size, st.st_mtime, now))
+        if rows:
+            conn.executemany(
+                'INSERT INTO files (folder, name, size, mtime, checked_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(folder, name) DO UPDATE SET size = excluded.size, checked_at = excluded.checked_at',
+                rows
+            )
+
+    def _verify(self, conn, now: float) -> None:
+        # Filas cuyo archivo ya no existe (borrado manual, otro contenedor) no deben inflar
+        # los totales: se revisan las menos recientes de a `batch`
+        rows = conn.execute('SELECT folder, name FROM files ORDER BY checked_at ASC LIMIT ?', (self.batch,)).fetchall()
+        gone, seen = [], []
+        for row in rows:
+            policy = self.folders.get(row['folder'])
+            st = self._stat(os.path.join(policy.path, row['name'])) if policy else None
+            if st is None:
+                gone.append((row['folder'], row['name']))
+            else:
+                seen.append((st.st_size, now, row['folder'], row['name']))
+        if gone:
+            conn.executemany('DELETE FROM files WHERE folder = ? AND name = ?', gone)
+        if seen:
+            conn.executemany('UPDATE files SET size = ?, checked_at = ? WHERE folder = ? AND name = ?', seen)
+
+    def _delete(self, conn, folder: str, policy: FolderPolicy, name: str, size: int, reason: str,
+                report: dict, dry_run: bool) -> int:
+        removed = self._remove(os.path.join(policy.path, name), dry_run)
+        if not dry_run:
+            conn.execute('DELETE FROM files WHERE folder = ? AND name = ?', (folder, name))
+        if not removed:
+            return 0
+        extra = 0
+        if self.on_delete is not None and not dry_run:
+            try:
+                extra = int(self.on_delete(folder, name) or 0)
+            except Exception as e:
+                print(f"[Janitor] Limpieza de referencias de {folder}/{name} falló: {e}")
+        self._count(report, folder, reason, size + extra)
+        return size
+
+    def _hold(self, conn, folder: str, name: str, now: float, report: dict) -> None:
+        # Referenciado: no volver a consultarlo hasta dentro de `hold_s`
+        conn.execute('UPDATE files SET hold_until = ? WHERE folder = ? AND name = ?', (now + self.hold_s, folder, name))
+        report['held'] += 1
+
+    def _enforce(self, conn, folder: str, policy: FolderPolicy, now: float, report: dict, dry_run: bool) -> None:
+        newest = now - policy.min_age_s
+        if policy.max_age_s:
+            cutoff = min(newest, now - policy.max_age_s)
+            rows = conn.execute(
+                'SELECT name, size FROM files WHERE folder = ? AND mtime < ? AND hold_until < ? ORDER BY mtime LIMIT ?',
+                (folder, cutoff, now, self.batch)).fetchall()
+            for row in rows:
+                if self.is_referenced(folder, row['name']):
+                    self._hold(conn, folder, row['name'], now, report)
+                else:
+                    self._delete(conn, folder, policy, row['name'], row['size'], 'age', report, dry_run)
+
+        if not policy.max_bytes:
+            return
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM files WHERE folder = ?', (folder,)).fetchone()[0]
+        if total <= policy.max_bytes:
+            return
+        # Sobre el tope: primero los más viejos sin referencias
+        rows = conn.execute(
+            'SELECT name, size FROM files WHERE folder = ? AND mtime < ? AND hold_until < ? ORDER BY mtime LIMIT ?',
+            (folder, newest, now, self.batch)).fetchall()
+        for row in rows:
+            if total <= policy.max_bytes:
+                return
+            if self.is_referenced(folder, row['name']):
+                self._hold(conn, folder, row['name'], now, report)
+                continue
+            self._delete(conn, folder, policy, row['name'], row['size'], 'quota', report, dry_run)
+            total -= row['size']
+        if total <= policy.max_bytes or len(rows) >= self.batch:
+            return
+        # Sólo quedan referenciados: no se borran (la caché, la galería o Firestore los siguen sirviendo).
+        # Se informa para subir el tope o acortar la retención de las referencias
+        report.setdefault('over_quota', {})[folder] = total
+        print(f"[Janitor] {folder} sigue sobre el tope ({total} > {policy.max_bytes} bytes): sólo quedan referenciados")
+
+    def _sweep_derived(self, now: float, report: dict, dry_run: bool) -> None:
+        # Miniaturas/AVIF cuyo original ya no está (p. ej. borrado por cuota) y temporales
+        results = self.folders.get('results')
+        if not self.derived_dir or results is None:
+            return
+        for name in self._next_names('derived', self.derived_dir, self.batch):
+            path = os.path.join(self.derived_dir, name)
+            st = self._stat(path)
+            if st is None:
+                continue
+            if name.endswith('.tmp'):
+                if now - st.st_mtime > self.temp_max_age_s and self._remove(path, dry_run):
+                    self._count(report, 'derived', 'temp', st.st_size)
+                continue
+            result_hash = name.split('-', 1)[0].split('.', 1)[0]
+            if now - st.st_mtime < results.min_age_s or self._has_original(results.path, result_hash):
+                continue
+            if self._remove(path, dry_run):
+                self._count(report, 'derived', 'orphan', st.st_size)
+
+    @staticmethod
+    def _has_original(path: str, result_hash: str) -> bool:
+        # El original es <hash>.webp casi siempre; los migrados de Firestore conservan su extensión
+        if os.path.exists(os.path.join(path, f"{result_hash}.webp")):
+            return True
+        return bool(glob.glob(os.path.join(glob.escape(path), glob.escape(result_hash) + '.*')))
+
+    def _sweep_locks(self, now: float, report: dict, dry_run: bool) -> None:
+        # Un archivo .lock por clave de single-flight: se borran los viejos que nadie tiene tomados
+        if not self.locks_dir:
+            return
+        for name in self._next_names('locks', self.locks_dir, self.batch):
+            path = os.path.join(self.locks_dir, name)
+            st = self._stat(path)
+            if st is None or now - st.st_mtime < self.temp_max_age_s:
+                continue
+            if dry_run or fcntl is None:
+                if dry_run:
+                    self._count(report, 'locks', 'stale', st.st_size)
+                continue
+            try:
+                with open(path, 'a+') as f:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(path)
+                self._count(report, 'locks', 'stale', st.st_size)
+            except OSError:
+                continue
+
+    # --- Hilo en segundo plano ---
+
+    def ensure_started(self) -> None:
+        """Arranca el hilo de limpieza de este proceso (perezoso: no sobrevive a un fork)."""
+        if self._thread is not None or self.interval_s <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='janitor', daemon=True)
+                self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            time.sleep(self.interval_s)
+            try:
+                self.run_pass()
+            except Exception as e:
+                print(f"[Janitor] Pasada falló: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            last = dict(self.last_pass)
+            return {
+                'passes': self.passes,
+                'reclaimed_bytes': self.reclaimed_bytes,
+                'deleted': {folder: dict(reasons) for folder, reasons in self.deleted.items()},
+                'bytes': last.get('bytes', {}),
+                'last_pass_seconds': last.get('seconds'),
+                'interval_s': self.interval_s,
+                'policies': {folder: {'max_age_s': p.max_age_s, 'max_bytes': p.max_bytes, 'min_age_s': p.min_age_s}
+                             for folder, p in self.folders.items()},
+            }
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def create_janitor(upload_folder: str, results_folder: str, derived_dir: str | None = None,
+                   is_referenced=None, on_delete=None) -> Janitor:
+    """Retención por entorno.
+
+    JANITOR_INTERVAL_S (0 = sin hilo; `flask janitor` sigue disponible), JANITOR_BATCH,
+    UPLOADS_MAX_AGE_S / UPLOADS_MAX_BYTES, RESULTS_MAX_AGE_S / RESULTS_MAX_BYTES (0 = sin límite),
+    JANITOR_MIN_AGE_S y JANITOR_TEMP_MAX_AGE_S.
+    """
+    min_age_s = _env_float('JANITOR_MIN_AGE_S', 900.0)
+    folders = {
+        'uploads': FolderPolicy(upload_folder,
+                                max_age_s=_env_float('UPLOADS_MAX_AGE_S', 86400.0),
+                                max_bytes=int(_env_float('UPLOADS_MAX_BYTES', 256 * 1024 * 1024)),
+                                min_age_s=min_age_s),
+        'results': FolderPolicy(results_folder,
+                                max_age_s=_env_float('RESULTS_MAX_AGE_S', 0.0),
+                                max_bytes=int(_env_float('RESULTS_MAX_BYTES', 1024 * 1024 * 1024)),
+                                min_age_s=min_age_s),
+    }
+    janitor = Janitor(
+        os.path.join(results_folder, '.janitor.sqlite3'),
+        folders,
+        is_referenced=is_referenced,
+        on_delete=on_delete,
+        derived_dir=derived_dir,
+        locks_dir=os.path.join(results_folder, '.locks'),
+        batch=int(_env_float('JANITOR_BATCH', 500)),
+        interval_s=_env_float('JANITOR_INTERVAL_S', 60.0),
+        temp_max_age_s=_env_float('JANITOR_TEMP_MAX_AGE_S', 3600.0),
+    )
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=janitor._reset_after_fork)
+    return janitor
@@ -0,0 +1,326 @@
+# Cola de trabajos para /transform: la petición HTTP sólo encola y devuelve un job_id;
+# un pool local de hilos ejecuta el pipeline (poema + imagen) y va publicando el estado.
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_STATES = ('queued', 'generating', 'encoding', 'done', 'failed')
+TERMINAL_STATES = {'done', 'failed'}
+
+
+def _owner_id() -> str:
+    return str(os.getpid())
+
+
+def _owner_alive(owner: str | None) -> bool:
+    # Sólo tiene sentido en el mismo host: el dueño es el pid del worker que tomó el job
+    if not owner:
+        return False
+    try:
+        pid = int(owner)
+    except Exception:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+        return True
+    except Exception:
+        return False
+
+
+class MemoryJobStore:
+    """Almacén en proceso. Rápido, pero los trabajos se pierden al reiniciar."""
+
+    def __init__(self):
+        self._jobs: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id: str, params: dict) -> dict:
+        now = time.time()
+        job = {
+            'id': job_id, 'state': 'queued', 'params': params, 'result': None,
+            'error': None, 'created_at': now, 'updated_at': now, 'owner': _owner_id(),
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+        return dict(job)
+
+    def update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            job['updated_at'] = time.time()
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def claim_orphans(self) -> list[dict]:
+        # En memoria no hay huérfanos: al reiniciar el proceso no queda nada
+        return []
+
+    def prune(self, before: float) -> int:
+        """Borra los trabajos terminados (done/failed) sin cambios desde `before`. Devuelve cuántos."""
+        with self._lock:
+            old = [job_id for job_id, job in self._jobs.items()
+                   if job['state'] in TERMINAL_STATES and job['updated_at'] < before]
+            for job_id in old:
+                del self._jobs[job_id]
+        return len(old)
+
+
+class SQLiteJobStore:
+    """Almacén en SQLite: los trabajos sobreviven reinicios y se comparten entre workers del host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id TEXT PRIMARY KEY, state TEXT NOT NULL, params TEXT NOT NULL,'
+                ' result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL,'
+                ' owner TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_state_updated ON jobs(state, updated_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _row_to_job(row) -> dict:
+        return {
+            'id': row['id'], 'state': row['state'],
+            'params': json.loads(row['params'] or '{}'),
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'], 'created_at': row['created_at'],
+            'updated_at': row['updated_at'], 'owner': row['owner'],
+        }
+
+    def create(self, job_id: str, params: dict) -> dict:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, state, params, created_at, updated_at, owner) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(params), now, now, _owner_id())
+            )
+        return self.get(job_id)
+
+    def update(self, job_id: str, **fields) -> None:
+        if not fields:
+            return
+        cols = []
+        values = []
+        for k, v in fields.items():
+            if k not in ('state', 'result', 'error', 'owner'):
+                continue
+            cols.append(f'{k} = ?')
+            values.append(json.dumps(v) if k == 'result' and v is not None else v)
+        cols.append('updated_at = ?')
+        values.append(time.time())
+        values.append(job_id)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(cols)} WHERE id = ?", values)
+
+    def get(self, job_id: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def prune(self, before: float) -> int:
+        """Borra los trabajos terminados (done/failed) sin cambios desde `before`. Devuelve cuántos."""
+        with self._connect() as conn:
+            return conn.execute(
+                "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?", (before,)
+            ).rowcount
+
+    def claim_orphans(self) -> list[dict]:
+        """Reclama trabajos sin terminar cuyo worker dueño ya no existe (p.ej. tras un reinicio)."""
+        claimed = []
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE state IN ('queued', 'generating', 'encoding')"
+            ).fetchall()
+            for row in rows:
+                if _owner_alive(row['owner']) and row['owner'] != _owner_id():
+                    continue
+                cur = conn.execute(
+                    "UPDATE jobs SET owner = ?, state = 'queued', updated_at = ? WHERE id = ? AND owner IS ?",
+                    (_owner_id(), time.time(), row['id'], row['owner'])
+                )
+                if cur.rowcount == 1:
+                    claimed.append(self._row_to_job(row))
+        return claimed
+
+
+class JobQueue:
+    """Encola trabajos y los ejecuta en un pool de hilos.
+
+    `handler(params, progress)` ejecuta el trabajo y devuelve un dict serializable;
+    `progress(state)` permite publicar estados intermedios ('generating', 'encoding').
+    Inyectar un handler falso permite probar la cola sin tocar el modelo.
+    """
+
+    def __init__(self, store, handler, workers: int = 2, ttl_s: float = 3600.0):
+        self.store = store
+        self.handler = handler
+        self.workers = max(1, workers)
+        # Los trabajos terminados (y su resultado) se conservan ttl_s para que el cliente los lea
+        self.ttl_s = ttl_s
+        self._pruned_at = 0.0
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._listeners = []
+
+    def add_listener(self, fn) -> None:
+        """`fn(job_id)` se llama (desde el hilo del trabajo) en cada cambio de estado local.
+
+        Permite esperar sin bloquear un hilo, p. ej. el stream SSE asíncrono del modo ASGI.
+        """
+        self._listeners.append(fn)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Creación perezosa: el pool de hilos no sobrevive a un fork de gunicorn
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+            return self._executor
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Cierra el pool de hilos; con wait=True espera a que terminen los trabajos en curso."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _reset_after_fork(self) -> None:
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._cond = threading.Condition()
+
+    def _notify(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+    def _set(self, job_id: str, **fields) -> None:
+        self.store.update(job_id, **fields)
+        self._notify()
+        for fn in list(self._listeners):
+            try:
+                fn(job_id)
+            except Exception as e:
+                print(f"[Jobs] Listener falló: {e}")
+
+    def prune(self) -> int:
+        """Borra los trabajos terminados hace más de ttl_s."""
+        self._pruned_at = time.time()
+        try:
+            removed = self.store.prune(time.time() - self.ttl_s)
+        except Exception as e:
+            print(f"[Jobs] No se pudieron purgar trabajos: {e}")
+            return 0
+        if removed:
+            print(f"[Jobs] Purgados {removed} trabajos terminados")
+        return removed
+
+    def submit(self, params: dict) -> str:
+        # La purga va con los envíos (como mucho una vez por minuto): sin hilo extra
+        if self.ttl_s > 0 and time.time() - self._pruned_at > min(60.0, self.ttl_s):
+            self.prune()
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, params)
+        self._get_executor().submit(self._run, job_id, params)
+        self._notify()
+        return job_id
+
+    def resume_orphans(self) -> int:
+        jobs = self.store.claim_orphans()
+        for job in jobs:
+            print(f"[Jobs] Reanudando trabajo {job['id']} (estado previo={job['state']})")
+            self._get_executor().submit(self._run, job['id'], job['params'])
+        return len(jobs)
+
+    def get(self, job_id: str) -> dict | None:
+        return self.store.get(job_id)
+
+    def wait_for_update(self, job_id: str, since: float, timeout: float = 15.0) -> dict | None:
+        """Bloquea hasta que el trabajo cambie respecto a `since` (updated_at) o venza el timeout.
+
+        Las notificaciones sólo llegan desde el propio proceso; para trabajos de otro worker
+        (backend SQLite) se re-consulta el almacén cada segundo.
+        """
+        deadline = time.time() + timeout
+        while True:
+            job = self.store.get(job_id)
+            if job is None or job['updated_at'] != since or job['state'] in TERMINAL_STATES:
+                return job
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return job
+            with self._cond:
+                self._cond.wait(min(1.0, remaining))
+
+    def _run(self, job_id: str, params: dict) -> None:
+        def progress(state: str) -> None:
+            if state in JOB_STATES and state not in TERMINAL_STATES:
+                self._set(job_id, state=state)
+
+        try:
+            result = self.handler(params, progress)
+            self._set(job_id, state='done', result=result)
+        except Exception as e:
+            print(f"[Jobs] Trabajo {job_id} falló: {e}")
+            self._set(job_id, state='failed', error=str(e))
+
+
+def public_job(job: dict) -> dict:
+    """Vista pública de un trabajo (sin parámetros internos)."""
+    out = {
+        'job_id': job['id'],
+        'state': job['state'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    }
+    if job.get('result') is not None:
+        out['result'] = job['result']
+    if job.get('error'):
+        out['error'] = job['error']
+    return out
+
+
+def create_job_queue(handler, base_dir: str) -> JobQueue:
+    """Construye la cola según el entorno: JOBS_BACKEND=memory|sqlite, JOBS_DB_PATH, JOBS_WORKERS
+    y JOBS_TTL_S (segundos que se conservan los trabajos terminados; 0 = sin purga)."""
+    backend = os.environ.get('JOBS_BACKEND', 'memory').strip().lower()
+    try:
+        workers = int(os.environ.get('JOBS_WORKERS', '4'))
+    except Exception:
+        workers = 4
+    try:
+        ttl_s = float(os.environ.get('JOBS_TTL_S', '3600'))
+    except Exception:
+        ttl_s = 3600.0
+    if backend == 'sqlite':
+        path = os.environ.get('JOBS_DB_PATH', '').strip() or os.path.join(base_dir, 'jobs.sqlite3')
+        store = SQLiteJobStore(path)
+        print(f"[Jobs] Backend SQLite en {path} ({workers} workers)")
+    else:
+        store = MemoryJobStore()
+        print(f"[Jobs] Backend en memoria ({workers} workers)")
+    queue = JobQueue(store, handler, workers=workers, ttl_s=ttl_s)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=queue._reset_after_fork)
+    return queue
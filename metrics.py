@@ -0,0 +1,218 @@
+# Métricas en formato Prometheus (texto) sin dependencias: contadores e histogramas con etiquetas,
+# más un temporizador por etapas para /transform y las peticiones HTTP. Las etapas medidas se
+# exportan en /metrics (histograma por ámbito y etapa) y en la cabecera Server-Timing.
+# Los valores son por proceso: con varios workers de gunicorn cada uno expone los suyos.
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Segundos: de operaciones locales (ms) a llamadas al modelo con espera de cuota (minutos)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _label_str(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _fmt(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, value: float = 1.0, **labels) -> None:
+        key = tuple(str(labels.get(n, '')) for n in self.labels)
+        self._values[key] = self._values.get(key, 0.0) + value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_label_str(self.labels, key)} {_fmt(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}  # etiquetas -> [conteos por bucket..., suma, total]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(n, '')) for n in self.labels)
+        row = self._values.get(key)
+        if row is None:
+            row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, row in sorted(self._values.items()):
+            for i, bound in enumerate(self.buckets):
+                le = 'le="%s"' % _fmt(bound)
+                lines.append(f'{self.name}_bucket{_label_str(self.labels, key, le)} {row[i]}')
+            le = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_label_str(self.labels, key, le)} {row[-1]}')
+            lines.append(f'{self.name}_sum{_label_str(self.labels, key)} {_fmt(round(row[-2], 6))}')
+            lines.append(f'{self.name}_count{_label_str(self.labels, key)} {row[-1]}')
+        return lines
+
+
+class StageTimer:
+    """Tiempos por etapa de una unidad de trabajo (una transformación, una petición HTTP).
+
+    Cada etapa se acumula (si se repite) y se observa en el histograma de etapas del registro.
+    """
+
+    def __init__(self, registry: 'Metrics', scope: str):
+        self.registry = registry
+        self.scope = scope
+        self.stages: dict[str, float] = {}
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.registry.observe_stage(self.scope, stage, seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def as_ms(self) -> dict[str, float]:
+        return {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()}
+
+    def server_timing(self, total: bool = True) -> str:
+        parts = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items()]
+        if total:
+            parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+
+def server_timing_from_ms(stages_ms: dict[str, float]) -> str:
+    """Cabecera Server-Timing a partir de tiempos ya medidos (p. ej. los guardados en un trabajo)."""
+    return ', '.join(f'{name};dur={float(ms):.1f}' for name, ms in stages_ms.items())
+
+
+class Metrics:
+    def __init__(self, prefix: str = 'halloween'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._metrics: dict[str, Counter | Histogram] = {}
+        self._gauges: list[tuple[str, str, object]] = []
+        self.stage_seconds = self.histogram('stage_seconds', 'Duración de cada etapa en segundos', ('scope', 'stage'))
+        self.request_seconds = self.histogram('http_request_seconds', 'Duración de las peticiones HTTP en segundos',
+                                              ('endpoint', 'method', 'status'))
+
+    def _reset_after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def counter(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Counter:
+        with self._lock:
+            metric = self._metrics.setdefault(name, Counter(f'{self.prefix}_{name}', help_text, labels))
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            metric = self._metrics.setdefault(name, Histogram(f'{self.prefix}_{name}', help_text, labels, buckets))
+        return metric
+
+    def gauge(self, name: str, help_text: str, fn) -> None:
+        """Gauge leído al exportar: `fn()` devuelve un número o un dict {etiqueta: valor}."""
+        self._gauges.append((f'{self.prefix}_{name}', help_text, fn))
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        with self._lock:
+            self._metrics[name].inc(value, **labels)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._metrics[name].observe(value, **labels)
+
+    def observe_stage(self, scope: str, stage: str, seconds: float) -> None:
+        self.observe('stage_seconds', seconds, scope=scope, stage=stage)
+
+    # --- Temporizador activo del hilo: las funciones internas registran etapas sin recibirlo ---
+
+    def current(self) -> StageTimer | None:
+        return getattr(self._local, 'timer', None)
+
+    @contextmanager
+    def timer(self, scope: str):
+        """Activa un StageTimer para el hilo actual mientras dura el bloque."""
+        previous = self.current()
+        timer = StageTimer(self, scope)
+        self._local.timer = timer
+        try:
+            yield timer
+        finally:
+            self._local.timer = previous
+
+    def activate(self, timer: StageTimer | None) -> None:
+        self._local.timer = timer
+
+    @contextmanager
+    def stage(self, name: str):
+        """Mide una etapa en el temporizador activo (o sólo en el histograma, con scope 'other')."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def record(self, stage: str, seconds: float) -> None:
+        timer = self.current()
+        if timer is not None:
+            timer.add(stage, seconds)
+        else:
+            self.observe_stage('other', stage, seconds)
+
+    def render(self) -> str:
+        with self._lock:
+            lines = []
+            for metric in self._metrics.values():
+                lines.extend(metric.render())
+        for name, help_text, fn in self._gauges:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} gauge'])
+            if isinstance(value, dict):
+                for label, v in sorted(value.items()):
+                    lines.append(f'{name}{{key="{_escape(label)}"}} {_fmt(v)}')
+            else:
+                lines.append(f'{name} {_fmt(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def create_metrics() -> Metrics:
+    metrics = Metrics()
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=metrics._reset_after_fork)
+    return metrics
@@ -0,0 +1,66 @@
+# Registro de clientes de los SDK de Gemini: uno por (SDK, modelo, API key), creado en el primer uso
+# y reutilizado entre peticiones (conexiones keep-alive, sin repetir configure()/handshakes TLS).
+# Los SDK se importan aquí de forma perezosa, no al importar la app. Tras un fork (workers de
+# gunicorn) el registro se vacía: las conexiones del padre no se comparten con los hijos.
+import hashlib
+import os
+import threading
+
+
+def _key_id(api_key: str) -> str:
+    # No guardar la clave en claro como parte de la clave del diccionario (aparece en logs/depuración)
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+class ModelClients:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: dict[tuple, object] = {}
+        self._configured_key = None
+
+    def _reset_after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._configured_key = None
+
+    def generative_model(self, model_name: str, api_key: str):
+        """`google.generativeai.GenerativeModel` compartido para (modelo, API key)."""
+        key = ('generativeai', model_name, _key_id(api_key))
+        with self._lock:
+            model = self._clients.get(key)
+            if model is not None and self._configured_key == key[2]:
+                return model
+            import google.generativeai as genai  # type: ignore
+            # configure() es global en este SDK: sólo se repite si cambia la API key
+            if self._configured_key != key[2]:
+                genai.configure(api_key=api_key)
+                self._configured_key = key[2]
+                self._clients = {k: v for k, v in self._clients.items() if k[0] != 'generativeai'}
+            model = genai.GenerativeModel(model_name)
+            self._clients[key] = model
+            return model
+
+    def genai_client(self, api_key: str):
+        """`google.genai.Client` compartido para una API key (sirve para todos los modelos)."""
+        key = ('genai', '', _key_id(api_key))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                try:
+                    from google import genai as genai_new  # type: ignore
+                except Exception:
+                    raise RuntimeError('Paquete google-genai no disponible. Ejecuta pip install google-genai')
+                client = genai_new.Client(api_key=api_key)
+                self._clients[key] = client
+            return client
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'clients': len(self._clients)}
+
+
+def create_model_clients() -> ModelClients:
+    clients = ModelClients()
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=clients._reset_after_fork)
+    return clients
@@ -0,0 +1,103 @@
+# Poemas en paralelo con la imagen: la llamada al modelo de texto se lanza en un pool propio al
+# empezar /transform y se recoge al final con un plazo; si no llega a tiempo se usa el poema base.
+# Los poemas generados se cachean por (display_name, disfraz).
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+
+class PoemService:
+    def __init__(self, generate, fallback, timeout_s: float = 8.0, cache_size: int = 1024, workers: int = 4):
+        # generate(display_name, disfraz, timeout_s) -> list[str] | None; fallback(display_name, disfraz) -> list[str]
+        self.generate = generate
+        self.fallback = fallback
+        self.timeout_s = timeout_s
+        self.cache_size = max(0, cache_size)
+        self.workers = max(1, workers)
+        self._cache: OrderedDict[tuple[str, str], list[str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self.hits = 0
+        self.timeouts = 0
+
+    def _reset_after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='poem')
+            return self._executor
+
+    def _cached(self, key: tuple[str, str]) -> list[str] | None:
+        with self._lock:
+            lines = self._cache.get(key)
+            if lines is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            return lines
+
+    def _store(self, key: tuple[str, str], lines: list[str]) -> None:
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[key] = lines
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _run(self, key: tuple[str, str]) -> list[str] | None:
+        lines = self.generate(key[0], key[1], self.timeout_s)
+        # Aunque el plazo de la petición ya haya vencido, el poema queda para la siguiente
+        if lines:
+            self._store(key, lines)
+        return lines
+
+    def start(self, display_name: str, disfraz: str):
+        """Lanza la generación en segundo plano. Devuelve un identificador para `result()`."""
+        key = ((display_name or '').strip(), (disfraz or '').strip())
+        lines = self._cached(key)
+        if lines is not None:
+            return key, lines, None, time.monotonic()
+        return key, None, self._get_executor().submit(self._run, key), time.monotonic()
+
+    def result(self, handle) -> list[str]:
+        """Poema de `start()`; espera como mucho hasta el plazo contado desde el inicio."""
+        key, lines, future, started = handle
+        if lines is not None:
+            return lines
+        remaining = max(0.0, self.timeout_s - (time.monotonic() - started))
+        try:
+            lines = future.result(timeout=remaining)
+        except FutureTimeout:
+            self.timeouts += 1
+            print(f"[Poema] Sin respuesta en {self.timeout_s}s, usando poema base")
+            lines = None
+        except Exception as e:
+            print(f"[Poema] Error generando poema: {e}")
+            lines = None
+        return lines or self.fallback(key[0], key[1])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'cached': len(self._cache), 'hits': self.hits, 'timeouts': self.timeouts}
+
+
+def create_poem_service(generate, fallback) -> PoemService:
+    """POEM_TIMEOUT_S (por defecto 8) y POEM_CACHE_SIZE (por defecto 1024)."""
+    try:
+        timeout_s = float(os.environ.get('POEM_TIMEOUT_S', '8'))
+    except Exception:
+        timeout_s = 8.0
+    try:
+        cache_size = int(os.environ.get('POEM_CACHE_SIZE', '1024'))
+    except Exception:
+        cache_size = 1024
+    service = PoemService(generate, fallback, timeout_s=timeout_s, cache_size=cache_size)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=service._reset_after_fork)
+    return service
@@ -0,0 +1,230 @@
+# Precalentamiento especulativo: mientras el usuario elige disfraz y escribe su nombre, la imagen
+# probable (foto ya subida + disfraz seleccionado) se genera en segundo plano hacia la caché de
+# resultados, con prioridad mínima en el limitador de cuota. Cuando llega /transform, la clave ya
+# está en la caché o en vuelo (single-flight) y la espera se acerca a la de un acierto.
+# Límites: presupuesto de generaciones por sesión y ventana, presupuesto global (todas las sesiones)
+# por ventana, tope de pistas pendientes, caducidad de las que no empiezan a tiempo y cancelación de
+# las pendientes que el usuario ya no va a usar.
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Hint:
+    def __init__(self, session: str, params: dict):
+        self.session = session
+        self.params = params
+        self.created = time.monotonic()
+        self.cancelled = False
+        self.started = False
+
+
+class Prewarmer:
+    def __init__(self, run, enabled: bool = False, budget: int = 3, window_s: float = 3600.0,
+                 ttl_s: float = 120.0, max_pending: int = 8, workers: int = 2, global_budget: int = 200):
+        # run(params, hint) -> (estado, clave de caché | None); estado: generated, cached, cancelled, failed
+        self.run = run
+        self.enabled = enabled
+        self.budget = max(0, budget)
+        # Tope de generaciones especulativas del proceso por ventana, sumando todas las sesiones:
+        # pedir sesiones nuevas (sin cookie) no amplía el gasto
+        self.global_budget = max(0, global_budget)
+        self.window_s = window_s
+        self.ttl_s = ttl_s
+        self.max_pending = max(1, max_pending)
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending: dict[str, list[_Hint]] = {}             # sesión -> pistas aún sin empezar
+        self._spent: dict[str, list[float]] = {}               # sesión -> instantes de generaciones
+        self._global_spent: deque[float] = deque()             # instantes de todas las sesiones
+        self._generated: OrderedDict[str, float] = OrderedDict()  # claves precalentadas aún sin usar
+        self.counts = {'scheduled': 0, 'generated': 0, 'cached': 0, 'failed': 0, 'cancelled': 0,
+                       'expired': 0, 'over_budget': 0, 'used': 0}
+
+    def _reset_after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+        self._global_spent = deque()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Creación perezosa: el pool de hilos no sobrevive a un fork de gunicorn
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prewarm')
+            return self._executor
+
+    @staticmethod
+    def _same(a: dict, b: dict) -> bool:
+        return all(a.get(k) == b.get(k) for k in ('image_url', 'disfraz', 'extra_prompt', 'use_thematic_bg'))
+
+    def _spent_in_window(self, session: str, now: float) -> list[float]:
+        spent = [t for t in self._spent.get(session, ()) if now - t < self.window_s]
+        if spent:
+            self._spent[session] = spent
+        else:
+            self._spent.pop(session, None)
+        return spent
+
+    def _global_spent_in_window(self, now: float) -> int:
+        while self._global_spent and now - self._global_spent[0] >= self.window_s:
+            self._global_spent.popleft()
+        return len(self._global_spent)
+
+    def hint(self, session: str, items: list[dict]) -> list[str]:
+        """Programa la generación de `items` (params de /transform) para `session`.
+
+        Las pistas pendientes de la sesión que no coinciden con las nuevas se cancelan: el usuario
+        cambió de foto o de disfraz. Devuelve un estado por ítem: scheduled, pending, over_budget,
+        busy o disabled.
+        """
+        if not self.enabled:
+            return ['disabled'] * len(items)
+        now = time.monotonic()
+        statuses = []
+        to_submit = []
+        with self._lock:
+            if len(self._spent) > 10000:
+                for key in list(self._spent):
+                    self._spent_in_window(key, now)
+            pending = self._pending.setdefault(session, [])
+            for h in pending:
+                if not any(self._same(h.params, p) for p in items):
+                    h.cancelled = True
+                    self.counts['cancelled'] += 1
+                    self._refund_locked(session)
+            pending[:] = [h for h in pending if not h.cancelled]
+            total_pending = sum(len(hs) for hs in self._pending.values())
+            for params in items:
+                if any(self._same(h.params, params) for h in pending):
+                    statuses.append('pending')
+                    continue
+                spent = self._spent_in_window(session, now)
+                if len(spent) >= self.budget or self._global_spent_in_window(now) >= self.global_budget:
+                    self.counts['over_budget'] += 1
+                    statuses.append('over_budget')
+                    continue
+                if total_pending >= self.max_pending:
+                    statuses.append('busy')
+                    continue
+                h = _Hint(session, params)
+                pending.append(h)
+                self._spent.setdefault(session, []).append(now)
+                self._global_spent.append(now)
+                total_pending += 1
+                self.counts['scheduled'] += 1
+                to_submit.append(h)
+                statuses.append('scheduled')
+            if not pending:
+                self._pending.pop(session, None)
+        for h in to_submit:
+            self._get_executor().submit(self._execute, h)
+        return statuses
+
+    def cancel(self, session: str) -> int:
+        """Cancela las pistas de `session` que aún no empezaron (nueva foto, /transform ya enviado)."""
+        with self._lock:
+            pending = self._pending.pop(session, [])
+            for h in pending:
+                h.cancelled = True
+            self.counts['cancelled'] += len(pending)
+            # Lo no gastado vuelve al presupuesto de la sesión
+            for _h in pending:
+                self._refund_locked(session)
+        return len(pending)
+
+    def _finish(self, h: _Hint) -> None:
+        with self._lock:
+            pending = self._pending.get(h.session)
+            if pending is not None and h in pending:
+                pending.remove(h)
+                if not pending:
+                    self._pending.pop(h.session, None)
+
+    def _refund_locked(self, session: str) -> None:
+        spent = self._spent.get(session)
+        if spent:
+            spent.pop()
+            if self._global_spent:
+                self._global_spent.pop()
+
+    def _refund(self, h: _Hint) -> None:
+        with self._lock:
+            self._refund_locked(h.session)
+
+    def _execute(self, h: _Hint) -> None:
+        with self._lock:
+            if h.cancelled:
+                return
+            h.started = True
+            expired = time.monotonic() - h.created > self.ttl_s
+            if expired:
+                self.counts['expired'] += 1
+        if expired:
+            self._finish(h)
+            self._refund(h)
+            return
+        # Una vez empezada, la pista deja de contar como pendiente: /transform se une a ella
+        # por single-flight en lugar de cancelarla
+        self._finish(h)
+        try:
+            status, key = self.run(h.params, h)
+        except Exception as e:
+            print(f"[Prewarm] Falló: {e}")
+            status, key = 'failed', None
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if status == 'generated' and key:
+                self._generated[key] = time.monotonic()
+                while len(self._generated) > 1024:
+                    self._generated.popitem(last=False)
+        if status != 'generated':
+            # Sólo gastan presupuesto las generaciones reales
+            self._refund(h)
+
+    def consume(self, key: str) -> bool:
+        """Marca como usada una clave precalentada (acierto de /transform). True si lo era."""
+        with self._lock:
+            if self._generated.pop(key, None) is None:
+                return False
+            self.counts['used'] += 1
+            return True
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(hs) for hs in self._pending.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts, enabled=self.enabled, budget=self.budget, global_budget=self.global_budget,
+                        global_spent=self._global_spent_in_window(time.monotonic()),
+                        pending=sum(len(hs) for hs in self._pending.values()), unused=len(self._generated))
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def create_prewarmer(run) -> Prewarmer:
+    """PREWARM=1 lo activa. PREWARM_SESSION_BUDGET generaciones por sesión y PREWARM_GLOBAL_BUDGET
+    en total cada PREWARM_WINDOW_S, PREWARM_TTL_S de caducidad, PREWARM_MAX_PENDING pistas en cola
+    y PREWARM_WORKERS hilos."""
+    prewarmer = Prewarmer(
+        run,
+        enabled=os.environ.get('PREWARM', '').strip().lower() in ('1', 'true', 'yes'),
+        budget=int(_env_float('PREWARM_SESSION_BUDGET', 3)),
+        window_s=_env_float('PREWARM_WINDOW_S', 3600.0),
+        ttl_s=_env_float('PREWARM_TTL_S', 120.0),
+        max_pending=int(_env_float('PREWARM_MAX_PENDING', 8)),
+        workers=int(_env_float('PREWARM_WORKERS', 2)),
+        global_budget=int(_env_float('PREWARM_GLOBAL_BUDGET', 200)),
+    )
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=prewarmer._reset_after_fork)
+    return prewarmer
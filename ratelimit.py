@@ -0,0 +1,226 @@
+# Limitador de cuota para las llamadas a Gemini: un token bucket por modelo (peticiones por minuto)
+# compartido por todo el proceso (y opcionalmente por todos los workers del host vía SQLite).
+# Un 429/RESOURCE_EXHAUSTED pausa el modelo para todos durante el retryDelay indicado, y los
+# que esperan turno se atienden por prioridad: las transformaciones interactivas antes que los lotes.
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+# Precalentamiento especulativo: sólo cupo sobrante, detrás de todo lo demás
+PRIORITY_PREFETCH = 20
+
+
+class RateLimitTimeout(RuntimeError):
+    """No hubo cupo para el modelo dentro del tiempo máximo de espera."""
+
+
+class MemoryBuckets:
+    """Estado de los buckets en el proceso."""
+
+    def __init__(self):
+        self._state: dict[str, list[float]] = {}  # modelo -> [tokens, actualizado, pausa_hasta]
+        self._lock = threading.Lock()
+
+    def take(self, model: str, rpm: float, now: float) -> float:
+        """Consume un token si hay; si no, devuelve los segundos hasta el próximo (0 = concedido)."""
+        with self._lock:
+            tokens, updated, cooldown_until = self._state.get(model, [rpm, now, 0.0])
+            if now < cooldown_until:
+                return cooldown_until - now
+            tokens = min(rpm, tokens + max(0.0, now - updated) * rpm / 60.0)
+            if tokens >= 1:
+                self._state[model] = [tokens - 1, now, cooldown_until]
+                return 0.0
+            self._state[model] = [tokens, now, cooldown_until]
+            return (1 - tokens) * 60.0 / rpm
+
+    def pause(self, model: str, until: float) -> None:
+        with self._lock:
+            tokens, updated, cooldown_until = self._state.get(model, [0.0, time.time(), 0.0])
+            # Tras la pausa se arranca sin ráfaga acumulada
+            self._state[model] = [0.0, max(updated, until), max(cooldown_until, until)]
+
+
+class SQLiteBuckets:
+    """Estado de los buckets en SQLite: todos los workers del host comparten la misma cuota."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS buckets ('
+                ' model TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, cooldown_until REAL NOT NULL)'
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def take(self, model: str, rpm: float, now: float) -> float:
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT tokens, updated, cooldown_until FROM buckets WHERE model = ?', (model,)
+                ).fetchone()
+                tokens, updated, cooldown_until = row if row else (rpm, now, 0.0)
+                tokens = min(rpm, tokens + max(0.0, now - updated) * rpm / 60.0)
+                if now < cooldown_until:
+                    wait = cooldown_until - now
+                elif tokens >= 1:
+                    tokens -= 1
+                    wait = 0.0
+                else:
+                    wait = (1 - tokens) * 60.0 / rpm
+                conn.execute(
+                    'INSERT OR REPLACE INTO buckets (model, tokens, updated, cooldown_until) VALUES (?, ?, ?, ?)',
+                    (model, tokens, max(now, updated), cooldown_until)
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return wait
+
+    def pause(self, model: str, until: float) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO buckets (model, tokens, updated, cooldown_until) VALUES (?, 0, ?, ?) '
+                'ON CONFLICT(model) DO UPDATE SET tokens = 0, updated = MAX(updated, excluded.updated), '
+                'cooldown_until = MAX(cooldown_until, excluded.cooldown_until)',
+                (model, until, until)
+            )
+
+
+class RateLimiter:
+    def __init__(self, buckets, default_rpm: float = 10.0, overrides: dict[str, float] | None = None,
+                 max_wait_s: float = 600.0):
+        self.buckets = buckets
+        self.default_rpm = default_rpm
+        self.overrides = overrides or {}
+        self.max_wait_s = max_wait_s
+        self._cond = threading.Condition()
+        self._waiters: dict[str, list[tuple[int, int]]] = {}  # modelo -> heap de (prioridad, orden de llegada)
+        self._seq = itertools.count()
+        self.granted = 0
+        self.throttled = 0
+        self.pauses = 0
+
+    def _reset_after_fork(self) -> None:
+        self._cond = threading.Condition()
+        self._waiters = {}
+
+    def rpm_for(self, model: str) -> float:
+        return max(0.1, float(self.overrides.get(model, self.default_rpm)))
+
+    def acquire(self, model: str, priority: int = PRIORITY_INTERACTIVE, timeout: float | None = None) -> float:
+        """Espera turno y cupo para llamar a `model`. Devuelve los segundos esperados.
+
+        Entre los que esperan en este proceso pasa primero el de menor prioridad (y, a igualdad,
+        el que llegó antes). Lanza RateLimitTimeout si se supera `timeout` (o RATE_LIMIT_MAX_WAIT_S).
+        """
+        timeout = self.max_wait_s if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        me = (priority, next(self._seq))
+        rpm = self.rpm_for(model)
+        with self._cond:
+            queue = self._waiters.setdefault(model, [])
+            heapq.heappush(queue, me)
+        waited = None
+        try:
+            while True:
+                # El candado sólo cubre la cola de prioridad: esperar turno sin tocar el almacén
+                with self._cond:
+                    while queue[0] != me:
+                        # Otro con más prioridad (o que llegó antes) va delante: esperar a que lo atiendan
+                        if time.monotonic() >= deadline:
+                            raise RateLimitTimeout(f'Sin cupo para {model} en {timeout:.0f}s')
+                        self._cond.wait(timeout=0.5)
+                # Con turno, el token se toma fuera del candado (SQLite puede tardar en disco)
+                wait = self.buckets.take(model, rpm, time.time())
+                now = time.monotonic()
+                if wait <= 0:
+                    waited = now - start
+                    if waited > 0.5:
+                        print(f"[RateLimit] {model}: turno tras {waited:.1f}s de espera")
+                    return waited
+                if now + wait > deadline:
+                    raise RateLimitTimeout(f'Sin cupo para {model} en {timeout:.0f}s')
+                with self._cond:
+                    self._cond.wait(timeout=min(wait, 1.0))
+        finally:
+            with self._cond:
+                if waited is not None:
+                    self.granted += 1
+                    if waited > 0.5:
+                        self.throttled += 1
+                queue.remove(me)
+                heapq.heapify(queue)
+                if not queue:
+                    self._waiters.pop(model, None)
+                self._cond.notify_all()
+
+    def pause(self, model: str, seconds: float) -> None:
+        """Pausa `model` para todos (429 con retryDelay): nadie llama hasta que pase el plazo."""
+        self.pauses += 1
+        self.buckets.pause(model, time.time() + max(0.0, seconds))
+        print(f"[RateLimit] {model} en pausa {seconds:.0f}s por cuota agotada")
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            waiting = {model: len(queue) for model, queue in self._waiters.items()}
+        return {
+            'default_rpm': self.default_rpm,
+            'overrides': self.overrides,
+            'waiting': waiting,
+            'granted': self.granted,
+            'throttled': self.throttled,
+            'pauses': self.pauses,
+        }
+
+
+def _parse_overrides(raw: str) -> dict[str, float]:
+    # "imagen-3.0-fast=20,gemini-1.5-flash=60"
+    out = {}
+    for part in (raw or '').split(','):
+        if '=' not in part:
+            continue
+        name, value = part.split('=', 1)
+        try:
+            out[name.strip()] = float(value)
+        except Exception:
+            continue
+    return out
+
+
+def create_rate_limiter(base_dir: str) -> RateLimiter:
+    """RATE_LIMIT_BACKEND=memory|sqlite, RATE_LIMIT_DB_PATH, GEMINI_RPM, GEMINI_RPM_OVERRIDES, RATE_LIMIT_MAX_WAIT_S."""
+    backend = os.environ.get('RATE_LIMIT_BACKEND', 'memory').strip().lower()
+    try:
+        default_rpm = float(os.environ.get('GEMINI_RPM', '10'))
+    except Exception:
+        default_rpm = 10.0
+    try:
+        max_wait_s = float(os.environ.get('RATE_LIMIT_MAX_WAIT_S', '600'))
+    except Exception:
+        max_wait_s = 600.0
+    overrides = _parse_overrides(os.environ.get('GEMINI_RPM_OVERRIDES', ''))
+    if backend == 'sqlite':
+        path = os.environ.get('RATE_LIMIT_DB_PATH', '').strip() or os.path.join(base_dir, 'ratelimit.sqlite3')
+        buckets = SQLiteBuckets(path)
+        print(f"[RateLimit] Cuota compartida en SQLite {path} ({default_rpm:g} rpm por modelo)")
+    else:
+        buckets = MemoryBuckets()
+    limiter = RateLimiter(buckets, default_rpm=default_rpm, overrides=overrides, max_wait_s=max_wait_s)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=limiter._reset_after_fork)
+    return limiter
@@ -0,0 +1,170 @@
+# Caché persistente de resultados: los WebP se guardan en results/ con nombre por contenido
+# (blake2b) y un índice SQLite mapea la clave de la petición -> archivo, con desalojo LRU del índice
+# (los archivos los borra el conserje de retención).
+# SQLite + escrituras atómicas (os.replace) hacen que sea seguro entre workers de gunicorn.
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+
+_HASHED_NAME = re.compile(r'^([0-9a-f]{32})\.[a-z0-9]+$')
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def hash_from_filename(filename: str) -> str | None:
+    """Hash de contenido de un archivo de results/ nombrado por contenido, o None si es un nombre legado."""
+    m = _HASHED_NAME.match(filename)
+    return m.group(1) if m else None
+
+
+class ResultCache:
+    def __init__(self, folder: str, db_path: str | None = None,
+                 max_bytes: int = 512 * 1024 * 1024, max_entries: int = 5000):
+        self.folder = folder
+        self.db_path = db_path or os.path.join(folder, '.cache.sqlite3')
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(folder, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                ' key TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL,'
+                ' created_at REAL NOT NULL, last_access REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_access)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_file ON entries(filename)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _bump(conn, name: str, n: int = 1) -> None:
+        conn.execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, n)
+        )
+
+    def path_for(self, filename: str) -> str:
+        return os.path.join(self.folder, filename)
+
+    def get(self, key: str, count: bool = True) -> dict | None:
+        """Devuelve {'filename', 'size'} si la clave está en caché y su archivo existe.
+
+        Con count=False no se actualizan los contadores (re-consultas internas).
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT filename, size FROM entries WHERE key = ?', (key,)).fetchone()
+            if row and os.path.isfile(self.path_for(row['filename'])):
+                conn.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+                if count:
+                    self._bump(conn, 'hits')
+                return {'filename': row['filename'], 'size': row['size']}
+            if row:
+                # El archivo desapareció (limpieza manual, otro contenedor): la entrada ya no sirve
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            if count:
+                self._bump(conn, 'misses')
+        return None
+
+    def store(self, data: bytes, ext: str = 'webp') -> str:
+        """Escribe los bytes en results/<hash>.<ext> (idempotente y atómico). Devuelve el nombre."""
+        filename = f"{content_hash(data)}.{ext}"
+        final_path = self.path_for(filename)
+        if not os.path.isfile(final_path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix='.tmp-', suffix=f'.{ext}')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, final_path)
+            except Exception:
+                try:
+                    os.remove(tmp_path)
+                except Exception:
+                    pass
+                raise
+        return filename
+
+    def put(self, key: str, data: bytes, ext: str = 'webp') -> dict:
+        """Guarda los bytes bajo su hash de contenido y asocia la clave. Devuelve {'filename', 'size'}."""
+        filename = self.store(data, ext)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO entries (key, filename, size, created_at, last_access) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET filename = excluded.filename, size = excluded.size, '
+                'last_access = excluded.last_access',
+                (key, filename, len(data), now, now)
+            )
+            self._bump(conn, 'stores')
+            self._evict(conn)
+        return {'filename': filename, 'size': len(data)}
+
+    def has_file(self, filename: str) -> bool:
+        """True si alguna clave de la caché apunta a `filename` (el conserje no lo borra por edad)."""
+        with self._connect() as conn:
+            return conn.execute('SELECT 1 FROM entries WHERE filename = ? LIMIT 1', (filename,)).fetchone() is not None
+
+    def forget_file(self, filename: str) -> int:
+        """Quita las claves que apuntan a un archivo ya borrado. Devuelve cuántas había."""
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM entries WHERE filename = ?', (filename,)).rowcount
+
+    def _evict(self, conn) -> None:
+        # LRU: desalojar las entradas menos usadas hasta quedar bajo ambos límites.
+        # Sólo se quita la fila clave -> archivo: el archivo puede seguir enlazado desde la galería,
+        # Firestore o sus miniaturas, y su borrado lo decide el conserje (janitor.py) por edad y cuota
+        total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        count, size = total[0], total[1]
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        rows = conn.execute('SELECT key, size FROM entries ORDER BY last_access ASC').fetchall()
+        evicted = 0
+        for row in rows:
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM entries WHERE key = ?', (row['key'],))
+            count -= 1
+            size -= row['size']
+            evicted += 1
+        if evicted:
+            self._bump(conn, 'evictions', evicted)
+            print(f"[Cache] Desalojadas {evicted} entradas (LRU)")
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            counters = {r['name']: r['value'] for r in conn.execute('SELECT name, value FROM counters')}
+            total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'stores': counters.get('stores', 0),
+            'evictions': counters.get('evictions', 0),
+            'entries': total[0],
+            'bytes': total[1],
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+        }
+
+
+def create_result_cache(results_folder: str) -> ResultCache:
+    """Construye la caché según el entorno: RESULT_CACHE_MAX_BYTES, RESULT_CACHE_MAX_ENTRIES."""
+    try:
+        max_bytes = int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+    except Exception:
+        max_bytes = 512 * 1024 * 1024
+    try:
+        max_entries = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '5000'))
+    except Exception:
+        max_entries = 5000
+    return ResultCache(results_folder, max_bytes=max_bytes, max_entries=max_entries)
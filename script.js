@@ -1,5 +1,104 @@
 // Variables globales
 let currentImageFile = null;
+// Sonido por disfraz; se completa con el registro del servidor (/api/costumes)
+const costumeSounds = {
+    'vampire': 'static/sounds/vampire_sound.mp3',
+    'witch': 'static/sounds/witch_sound.mp3',
+    'zombie': 'static/sounds/zombie_sound.mp3',
+    'werewolf': 'static/sounds/werewolf_sound.mp3',
+    'ghost': 'static/sounds/ghost_sound.mp3'
+};
+
+// Selector de disfraces y sonidos desde el registro; si falla quedan las opciones del HTML
+async function loadCostumes() {
+    try {
+        const resp = await fetch('/api/costumes');
+        if (!resp.ok) return;
+        const data = await resp.json();
+        const items = Array.isArray(data.items) ? data.items : [];
+        if (!items.length) return;
+        const selector = document.getElementById('disfrazSelector');
+        const current = selector ? selector.value : '';
+        if (selector) selector.innerHTML = '';
+        items.forEach(item => {
+            if (item.sound) costumeSounds[item.id] = item.sound;
+            if (!selector) return;
+            const opt = document.createElement('option');
+            opt.value = item.id;
+            opt.textContent = item.label || item.id;
+            selector.appendChild(opt);
+        });
+        if (selector && current && items.some(item => item.id === current)) selector.value = current;
+    } catch (_) {
+        // Sin registro: opciones estáticas
+    }
+}
+
+// --- Precalentamiento (PREWARM en el servidor) ---
+// Con el modo activo, la foto se sube al elegirla y el disfraz seleccionado empieza a generarse
+// mientras el usuario escribe su nombre; /transform reutiliza la subida y suele encontrar la caché.
+// La sesión la fija el servidor (cookie firmada): las peticiones same-origin la envían solas
+let prefetchEnabled = false;
+let earlyUpload = null; // { file, promise } de la subida anticipada
+
+async function loadPrefetchConfig() {
+    try {
+        const resp = await fetch('/api/prefetch');
+        if (!resp.ok) return;
+        const data = await resp.json();
+        prefetchEnabled = !!data.enabled;
+    } catch (_) {
+        prefetchEnabled = false;
+    }
+}
+
+function currentPrefetchFields() {
+    const disfraz = document.getElementById('disfrazSelector')?.value || '';
+    const extraPrompt = document.getElementById('extraPrompt')?.value || '';
+    const useThematicBg = document.getElementById('useThematicBg');
+    return {
+        disfraz,
+        extra_prompt: extraPrompt,
+        use_thematic_bg: useThematicBg ? (useThematicBg.checked ? '1' : '0') : '1'
+    };
+}
+
+function startEarlyUpload(file) {
+    if (!prefetchEnabled || !file) return;
+    if (earlyUpload && earlyUpload.file !== file) cancelPrefetch();
+    const fd = new FormData();
+    fd.append('image', file);
+    // El disfraz elegido viaja con la subida: el servidor lo precalienta sin otra petición
+    Object.entries(currentPrefetchFields()).forEach(([k, v]) => fd.append(k, v));
+    const promise = fetch('/upload', { method: 'POST', body: fd }).then(async (resp) => {
+        if (!resp.ok) throw new Error(`Upload HTTP ${resp.status}`);
+        const data = await resp.json();
+        if (!data.image_url) throw new Error('Respuesta de /upload inválida');
+        return data;
+    });
+    // Sin manejador, un fallo aquí se reintenta como subida normal al transformar
+    promise.catch(() => {});
+    earlyUpload = { file, promise };
+}
+
+async function sendPrefetchHint() {
+    if (!prefetchEnabled || !earlyUpload) return;
+    try {
+        const uploadData = await earlyUpload.promise;
+        await fetch('/api/prefetch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ image_url: uploadData.image_url, ...currentPrefetchFields() })
+        });
+    } catch (_) {
+        // Sólo una pista: si falla, /transform genera como siempre
+    }
+}
+
+function cancelPrefetch() {
+    if (!prefetchEnabled) return;
+    fetch('/api/prefetch', { method: 'DELETE', keepalive: true }).catch(() => {});
+}
 
 // --- Helpers narrativa tipo brochure ---
 function generatePoem(disfraz, displayName) {
@@ -119,6 +218,60 @@ function escapeHtml(s){
     }[c]));
 }
 
+// ---- Trabajos de /transform (cola asíncrona) ----
+function jobStateMessage(state){
+    switch(state){
+        case 'generating': return 'Invocando a los espíritus de la IA <br> esto puede tardar un poco...';
+        case 'encoding': return 'Puliendo tu transformación...';
+        default: return 'Procesando tu magia de Halloween <br> esto puede tardar un poco...';
+    }
+}
+
+// Espera a que el trabajo termine: SSE si el navegador lo soporta, si no polling a /api/jobs/<id>
+function waitForJob(job, onState){
+    if (!job || !job.job_id) return Promise.reject(new Error('Respuesta de /transform inválida'));
+    const statusUrl = job.status_url || `/api/jobs/${job.job_id}`;
+    const eventsUrl = job.events_url || `/api/jobs/${job.job_id}/events`;
+    const settle = (data) => {
+        if (data.state === 'done') return data.result || {};
+        throw new Error(data.error || 'La transformación falló');
+    };
+    const poll = async () => {
+        let delay = 1000;
+        while (true) {
+            const resp = await fetch(statusUrl);
+            if (!resp.ok) throw new Error(`Job HTTP ${resp.status}`);
+            const data = await resp.json();
+            if (onState) onState(data.state);
+            if (data.state === 'done' || data.state === 'failed') return settle(data);
+            await new Promise(r => setTimeout(r, delay));
+            delay = Math.min(delay * 1.5, 5000);
+        }
+    };
+    if (typeof EventSource === 'undefined') return poll();
+    return new Promise((resolve, reject) => {
+        const es = new EventSource(eventsUrl);
+        let finished = false;
+        const handle = (ev) => {
+            let data = null;
+            try { data = JSON.parse(ev.data); } catch(_) { return; }
+            if (onState) onState(data.state);
+            if (data.state === 'done' || data.state === 'failed') {
+                finished = true;
+                es.close();
+                try { resolve(settle(data)); } catch (err) { reject(err); }
+            }
+        };
+        ['queued', 'generating', 'encoding', 'done', 'failed'].forEach(name => es.addEventListener(name, handle));
+        es.onerror = () => {
+            // Si el stream se corta, continuar con polling
+            if (finished) return;
+            es.close();
+            poll().then(resolve, reject);
+        };
+    });
+}
+
 // Función para manejar la selección de archivo
 function handleFileSelect(file) {
     if (!file) return;
@@ -152,6 +305,7 @@ function handleFileSelect(file) {
     
     // Mostrar mensaje de éxito
     showSuccess('¡Imagen cargada con éxito!');
+    startEarlyUpload(file);
 }
 
 // Función para mostrar mensajes de error
@@ -434,6 +588,13 @@ function showSuccess(message) {
 
 // Inicialización cuando el DOM esté completamente cargado
 document.addEventListener('DOMContentLoaded', () => {
+    loadCostumes();
+    loadPrefetchConfig();
+    // Cambiar de disfraz o de modo de fondo actualiza la pista (el servidor cancela la anterior)
+    const disfrazSelectorEl = document.getElementById('disfrazSelector');
+    const useThematicBgEl = document.getElementById('useThematicBg');
+    if (disfrazSelectorEl) disfrazSelectorEl.addEventListener('change', sendPrefetchHint);
+    if (useThematicBgEl) useThematicBgEl.addEventListener('change', sendPrefetchHint);
     const dropZone = document.getElementById('dropZone');
     const fileInput = document.getElementById('userImage');
     const changeImageBtn = document.getElementById('changeImageBtn');
@@ -562,13 +723,19 @@ document.getElementById('transformButton').addEventListener('click', async () =>
 
     // Conectar con el backend: /upload luego /transform
     try {
-        // 1) Subir imagen
-        const fd = new FormData();
-        fd.append('image', userImageFile);
-        const uploadResp = await fetch('/upload', { method: 'POST', body: fd });
-        if (!uploadResp.ok) throw new Error(`Upload HTTP ${uploadResp.status}`);
-        const uploadData = await uploadResp.json();
-        if (!uploadData.image_url) throw new Error('Respuesta de /upload inválida');
+        // 1) Subir imagen (o reutilizar la subida anticipada del precalentamiento)
+        let uploadData = null;
+        if (earlyUpload && earlyUpload.file === userImageFile) {
+            uploadData = await earlyUpload.promise.catch(() => null);
+        }
+        if (!uploadData) {
+            const fd = new FormData();
+            fd.append('image', userImageFile);
+            const uploadResp = await fetch('/upload', { method: 'POST', body: fd });
+            if (!uploadResp.ok) throw new Error(`Upload HTTP ${uploadResp.status}`);
+            uploadData = await uploadResp.json();
+            if (!uploadData.image_url) throw new Error('Respuesta de /upload inválida');
+        }
 
         // 2) Registrar transformación (futuro: IA real aquí)
         const transformFD = new FormData();
@@ -583,13 +750,15 @@ document.getElementById('transformButton').addEventListener('click', async () =>
         transformFD.append('display_name', displayName);
         const transformResp = await fetch('/transform', { method: 'POST', body: transformFD });
         if (!transformResp.ok) throw new Error(`Transform HTTP ${transformResp.status}`);
-        const transformData = await transformResp.json();
+        const job = await transformResp.json();
+        const transformData = await waitForJob(job, (state) => {
+            if (loadingMessage) loadingMessage.innerHTML = jobStateMessage(state);
+        });
 
+        // El resultado llega como URL (/results/<hash>.webp): el navegador descarga los bytes
+        // directamente, sin base64 dentro del JSON
         let imgSrc = null;
-        if (transformData.data_url) {
-            imgSrc = transformData.data_url;
-            transformedImage.src = imgSrc;
-        } else if (transformData.transformed_image_url) {
+        if (transformData.transformed_image_url) {
             imgSrc = transformData.transformed_image_url;
             transformedImage.src = imgSrc;
         }
@@ -599,7 +768,7 @@ document.getElementById('transformButton').addEventListener('click', async () =>
         // Configurar botón de descarga
         if (imgSrc && downloadArea && downloadBtn) {
             const base = (displayName || 'imagen').toLowerCase().replace(/[^a-z0-9_-]+/g, '-').replace(/^-+|-+$/g, '') || 'imagen';
-            const ext = transformData.data_url ? 'webp' : (imgSrc.endsWith('.png') ? 'png' : (imgSrc.endsWith('.jpg') || imgSrc.endsWith('.jpeg') ? 'jpg' : 'png'));
+            const ext = imgSrc.endsWith('.webp') ? 'webp' : (imgSrc.endsWith('.png') ? 'png' : (imgSrc.endsWith('.jpg') || imgSrc.endsWith('.jpeg') ? 'jpg' : 'png'));
             downloadBtn.href = imgSrc;
             downloadBtn.download = `${base}.${ext}`;
             downloadArea.style.display = 'block';
@@ -607,17 +776,10 @@ document.getElementById('transformButton').addEventListener('click', async () =>
 
         // Reproducir sonido según disfraz (con manejo de autoplay)
         try {
-            const soundMap = {
-                'vampire': 'static/sounds/vampire_sound.mp3',
-                'witch': 'static/sounds/witch_sound.mp3',
-                'zombie': 'static/sounds/zombie_sound.mp3',
-                'werewolf': 'static/sounds/werewolf_sound.mp3',
-                'ghost': 'static/sounds/ghost_sound.mp3'
-            };
             if (halloweenSound) {
                 // Preparar audio
                 halloweenSound.pause();
-                halloweenSound.src = soundMap[disfraz] || '';
+                halloweenSound.src = costumeSounds[disfraz] || '';
                 halloweenSound.currentTime = 0;
                 // Ocultar controles por defecto; sólo mostrarlos si falla autoplay
                 halloweenSound.style.display = 'none';
@@ -682,6 +844,7 @@ document.getElementById('transformButton').addEventListener('click', async () =>
        // alert('No se pudo completar la transformación. Intenta nuevamente más tarde.');
     } finally {
         loadingMessage.style.display = 'none';
+        loadingMessage.innerHTML = jobStateMessage('queued');
         if (spinner) spinner.style.display = 'none';
         if (btn) { btn.disabled = false; btn.textContent = '¡Transformar y Animar!'; }
     }
@@ -0,0 +1,92 @@
+# Single-flight: peticiones concurrentes con la misma clave esperan a una sola ejecución
+# y reciben su resultado. Entre hilos del worker se coordina en memoria; entre workers de
+# gunicorn del mismo host, con un lock de archivo (flock) por clave.
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl  # type: ignore
+except Exception:  # Windows: sólo deduplicación dentro del proceso
+    fcntl = None
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, lock_dir: str | None = None):
+        self.lock_dir = lock_dir
+        self._calls: dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def _reset_after_fork(self) -> None:
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _file_lock(self, key: str):
+        if not self.lock_dir or fcntl is None:
+            yield
+            return
+        path = os.path.join(self.lock_dir, f"{key}.lock")
+        with open(path, 'a+') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def do(self, key: str, fn):
+        """Ejecuta `fn()` una sola vez por clave en vuelo y devuelve (resultado, compartido).
+
+        `compartido` es True cuando el resultado vino de otra ejecución en curso del mismo proceso.
+        Entre procesos, el segundo worker espera al lock y ejecuta `fn()` después del primero,
+        así que `fn` debe volver a consultar la caché antes de trabajar.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            with self._file_lock(key):
+                call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            if call.waiters:
+                print(f"[SingleFlight] {key}: {call.waiters} petición(es) reutilizaron la misma generación")
+            call.event.set()
+        return call.result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+def create_single_flight(results_folder: str) -> SingleFlight:
+    flight = SingleFlight(os.path.join(results_folder, '.locks'))
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=flight._reset_after_fork)
+    return flight
@@ -0,0 +1,421 @@
+# Almacén de blobs para uploads/ y results/. Las carpetas locales siguen siendo el espacio de trabajo
+# de cada contenedor (Pillow, derivados, X-Accel-Redirect, conserje); el almacén es la copia
+# compartida entre instancias:
+#
+# - al escribir una subida canónica o un resultado, el archivo se sube al almacén (por partes si es
+#   grande, sin cargarlo entero en memoria);
+# - si una URL /uploads/... o /results/... llega a una instancia que no tiene el archivo en disco,
+#   se trae del almacén (o se redirige a una URL firmada / pública con STORAGE_REDIRECT=1).
+#
+# Backends: `local` (por defecto; con STORAGE_LOCAL_ROOT en un volumen compartido hace de almacén
+# común, sin él no hace nada) y `s3`, compatible con S3, MinIO y GCS (API XML con claves HMAC),
+# firmado con SigV4 sin dependencias externas.
+import hashlib
+import hmac
+import os
+import re
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timezone
+from http.client import HTTPConnection, HTTPSConnection
+from mimetypes import guess_type
+from urllib.parse import quote, urlsplit
+from xml.sax.saxutils import escape
+
+# S3 exige partes de al menos 5 MiB (salvo la última)
+MIN_PART_SIZE = 5 * 1024 * 1024
+_CHUNK = 64 * 1024
+_EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+
+class StorageError(RuntimeError):
+    pass
+
+
+class LocalBlobStore:
+    """Backend de disco. Con root == BASE_DIR las claves son los propios archivos de trabajo."""
+
+    name = 'local'
+    url_expires_s = 0
+
+    def __init__(self, root: str, work_root: str):
+        self.root = os.path.abspath(root)
+        self.work_root = os.path.abspath(work_root)
+        # Sólo hay algo que copiar si el almacén es otro directorio (p. ej. un volumen compartido)
+        self.shared = self.root != self.work_root
+        self._lock = threading.Lock()
+        self.counts = {'put': 0, 'put_bytes': 0, 'fetch': 0, 'fetch_miss': 0, 'errors': 0}
+
+    def _reset_after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += n
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError(f"Clave fuera del almacén: {key}")
+        return path
+
+    def put_file(self, key: str, path: str, content_type: str | None = None,
+                 cache_control: str | None = None) -> None:
+        dest = self._path(key)
+        if os.path.abspath(path) == dest:
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as out, open(path, 'rb') as src:
+                shutil.copyfileobj(src, out, _CHUNK)
+            os.replace(tmp_path, dest)
+        except Exception:
+            self._count('errors')
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+            raise
+        self._count('put')
+        self._count('put_bytes', os.path.getsize(dest))
+
+    def fetch(self, key: str, dest: str) -> bool:
+        """Copia la clave a `dest` (atómico). False si no existe."""
+        src = self._path(key)
+        if os.path.abspath(dest) == src:
+            return os.path.isfile(src)
+        if not os.path.isfile(src):
+            self._count('fetch_miss')
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as out, open(src, 'rb') as f:
+                shutil.copyfileobj(f, out, _CHUNK)
+            os.replace(tmp_path, dest)
+        except Exception:
+            self._count('errors')
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+            raise
+        self._count('fetch')
+        return True
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key: str, expires_s: int | None = None) -> str | None:
+        # Sin URL propia: la app sirve el archivo
+        return None
+
+    def public_url(self, key: str) -> str | None:
+        return None
+
+    def origins(self) -> list[str]:
+        return []
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts, backend=self.name, shared=self.shared)
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _uri_encode(value: str, safe: str = '-_.~') -> str:
+    return quote(value, safe=safe)
+
+
+def _canonical_query(query: dict) -> str:
+    return '&'.join(f"{_uri_encode(k)}={_uri_encode(str(v))}" for k, v in sorted(query.items()))
+
+
+class S3BlobStore:
+    """Backend S3 (AWS, MinIO, GCS en modo interoperable) con firma SigV4 hecha a mano.
+
+    Objetos pequeños en un PUT; los mayores que `multipart_threshold`, en subida multiparte con
+    partes de `part_size` leídas del archivo una a una. Descargas en streaming a disco.
+    """
+
+    name = 's3'
+    shared = True
+
+    def __init__(self, endpoint: str, bucket: str, access_key: str, secret_key: str,
+                 region: str = 'us-east-1', prefix: str = '', virtual_host: bool = False,
+                 public_base_url: str = '', url_expires_s: int = 3600,
+                 multipart_threshold: int = 8 * 1024 * 1024, part_size: int = 8 * 1024 * 1024,
+                 timeout: float = 30.0):
+        parts = urlsplit(endpoint if '://' in endpoint else f"https://{endpoint}")
+        if not parts.netloc or not bucket:
+            raise StorageError('S3_ENDPOINT y S3_BUCKET son obligatorios')
+        self.scheme = parts.scheme or 'https'
+        self.bucket = bucket
+        self.virtual_host = virtual_host
+        self.host = f"{bucket}.{parts.netloc}" if virtual_host else parts.netloc
+        base = parts.path.rstrip('/')
+        self.base_path = base if virtual_host else f"{base}/{bucket}"
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region or 'us-east-1'
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.public_base_url = public_base_url.rstrip('/')
+        self.url_expires_s = max(1, min(url_expires_s, 7 * 86400))
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self.multipart_threshold = max(self.part_size, multipart_threshold)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.counts = {'put': 0, 'put_bytes': 0, 'multipart': 0, 'fetch': 0, 'fetch_miss': 0,
+                       'errors': 0}
+
+    def _reset_after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += n
+
+    # --- Firma SigV4 ---
+
+    def _path(self, key: str) -> str:
+        return f"{self.base_path}/{_uri_encode(self.prefix + key, safe='-_.~/')}"
+
+    def _scope(self, date: str) -> str:
+        return f"{date}/{self.region}/s3/aws4_request"
+
+    def _signature(self, amz_date: str, canonical_request: str) -> str:
+        date = amz_date[:8]
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, self._scope(date),
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ])
+        key = _hmac(('AWS4' + self.secret_key).encode('utf-8'), date)
+        for part in (self.region, 's3', 'aws4_request'):
+            key = _hmac(key, part)
+        return hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def sign_headers(self, method: str, path: str, query: dict, headers: dict, payload_hash: str,
+                     now: datetime | None = None) -> dict:
+        """Cabeceras con Authorization para una petición (host, x-amz-date y x-amz-content-sha256 incluidas)."""
+        amz_date = (now or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+        headers = dict(headers, host=self.host)
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+        canonical = {k.lower(): ' '.join(str(v).split()) for k, v in headers.items()}
+        signed = ';'.join(sorted(canonical))
+        canonical_request = '\n'.join([
+            method, path, _canonical_query(query),
+            ''.join(f"{k}:{canonical[k]}\n" for k in sorted(canonical)),
+            signed, payload_hash,
+        ])
+        headers['Authorization'] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{self._scope(amz_date[:8])}, "
+            f"SignedHeaders={signed}, Signature={self._signature(amz_date, canonical_request)}"
+        )
+        return headers
+
+    def presign(self, method: str, key: str, expires_s: int | None = None,
+                now: datetime | None = None) -> str:
+        """URL firmada (query string) válida `expires_s` segundos."""
+        amz_date = (now or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+        path = self._path(key)
+        query = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f"{self.access_key}/{self._scope(amz_date[:8])}",
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(expires_s or self.url_expires_s),
+            'X-Amz-SignedHeaders': 'host',
+        }
+        canonical_request = '\n'.join([
+            method, path, _canonical_query(query), f"host:{self.host}\n", 'host', 'UNSIGNED-PAYLOAD',
+        ])
+        query['X-Amz-Signature'] = self._signature(amz_date, canonical_request)
+        return f"{self.scheme}://{self.host}{path}?{_canonical_query(query)}"
+
+    # --- HTTP ---
+
+    def _request(self, method: str, key: str, query: dict | None = None, body: bytes = b'',
+                 headers: dict | None = None, ok=(200,)):
+        """Hace la petición firmada. Devuelve (conexión, respuesta) con el cuerpo sin leer."""
+        query = query or {}
+        path = self._path(key)
+        payload_hash = hashlib.sha256(body).hexdigest() if body else _EMPTY_SHA256
+        signed = self.sign_headers(method, path, query, headers or {}, payload_hash)
+        signed['Content-Length'] = str(len(body))
+        target = f"{path}?{_canonical_query(query)}" if query else path
+        conn_cls = HTTPSConnection if self.scheme == 'https' else HTTPConnection
+        conn = conn_cls(self.host, timeout=self.timeout)
+        try:
+            conn.request(method, target, body=body or None, headers=signed)
+            resp = conn.getresponse()
+        except Exception as e:
+            conn.close()
+            self._count('errors')
+            raise StorageError(f"{method} {key}: {e}") from e
+        if resp.status not in ok:
+            detail = resp.read(512).decode('utf-8', 'replace')
+            conn.close()
+            self._count('errors')
+            raise StorageError(f"{method} {key}: HTTP {resp.status} {detail}")
+        return conn, resp
+
+    def _call(self, method: str, key: str, query: dict | None = None, body: bytes = b'',
+              headers: dict | None = None, ok=(200,)) -> tuple[int, dict, bytes]:
+        conn, resp = self._request(method, key, query, body, headers, ok)
+        try:
+            return resp.status, {k.lower(): v for k, v in resp.getheaders()}, resp.read()
+        finally:
+            conn.close()
+
+    # --- API del almacén ---
+
+    def put_file(self, key: str, path: str, content_type: str | None = None,
+                 cache_control: str | None = None) -> None:
+        headers = {'Content-Type': content_type or guess_type(key)[0] or 'application/octet-stream'}
+        if cache_control:
+            headers['Cache-Control'] = cache_control
+        size = os.path.getsize(path)
+        if size > self.multipart_threshold:
+            self._put_multipart(key, path, headers)
+        else:
+            with open(path, 'rb') as f:
+                self._call('PUT', key, body=f.read(), headers=headers)
+        self._count('put')
+        self._count('put_bytes', size)
+
+    def _put_multipart(self, key: str, path: str, headers: dict) -> None:
+        _status, _headers, body = self._call('POST', key, query={'uploads': ''}, headers=headers)
+        match = re.search(rb'<UploadId>([^<]+)</UploadId>', body)
+        if not match:
+            raise StorageError(f"POST {key}: respuesta sin UploadId")
+        upload_id = match.group(1).decode('utf-8')
+        etags = []
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(self.part_size)
+                    if not chunk:
+                        break
+                    number = len(etags) + 1
+                    _status, part_headers, _body = self._call(
+                        'PUT', key, query={'partNumber': str(number), 'uploadId': upload_id}, body=chunk)
+                    etags.append(part_headers.get('etag', ''))
+            parts = ''.join(f"<Part><PartNumber>{i}</PartNumber><ETag>{escape(etag)}</ETag></Part>"
+                            for i, etag in enumerate(etags, 1))
+            complete = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode('utf-8')
+            _status, _headers, body = self._call('POST', key, query={'uploadId': upload_id}, body=complete,
+                                                 headers={'Content-Type': 'application/xml'})
+            # S3 puede responder 200 con un <Error> en el cuerpo si la composición falla
+            if b'<Error>' in body:
+                raise StorageError(f"POST {key}: {body[:512].decode('utf-8', 'replace')}")
+        except Exception:
+            try:
+                self._call('DELETE', key, query={'uploadId': upload_id}, ok=(200, 204, 404))
+            except Exception:
+                pass
+            raise
+        self._count('multipart')
+
+    def fetch(self, key: str, dest: str) -> bool:
+        """Descarga la clave a `dest` en streaming (atómico). False si no existe."""
+        conn, resp = self._request('GET', key, ok=(200, 404))
+        try:
+            if resp.status == 404:
+                resp.read()
+                self._count('fetch_miss')
+                return False
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    shutil.copyfileobj(resp, out, _CHUNK)
+                os.replace(tmp_path, dest)
+            except Exception as e:
+                self._count('errors')
+                try:
+                    os.remove(tmp_path)
+                except Exception:
+                    pass
+                raise StorageError(f"GET {key}: {e}") from e
+        finally:
+            conn.close()
+        self._count('fetch')
+        return True
+
+    def exists(self, key: str) -> bool:
+        status, _headers, _body = self._call('HEAD', key, ok=(200, 404))
+        return status == 200
+
+    def delete(self, key: str) -> None:
+        self._call('DELETE', key, ok=(200, 204, 404))
+
+    def public_url(self, key: str) -> str | None:
+        # Bucket público o CDN delante del bucket (S3_PUBLIC_BASE_URL)
+        if not self.public_base_url:
+            return None
+        return f"{self.public_base_url}/{_uri_encode(self.prefix + key, safe='-_.~/')}"
+
+    def url(self, key: str, expires_s: int | None = None) -> str | None:
+        return self.public_url(key) or self.presign('GET', key, expires_s)
+
+    def origins(self) -> list[str]:
+        """Orígenes desde los que el navegador carga imágenes del almacén (para la CSP)."""
+        origins = [f"{self.scheme}://{self.host}"]
+        if self.public_base_url:
+            parts = urlsplit(self.public_base_url)
+            origins.append(f"{parts.scheme}://{parts.netloc}")
+        return origins
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts, backend=self.name, shared=True, bucket=self.bucket)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def create_blob_store(base_dir: str):
+    """STORAGE_BACKEND=local (STORAGE_LOCAL_ROOT, por defecto base_dir) o s3 (S3_ENDPOINT, S3_BUCKET,
+    S3_REGION, S3_ACCESS_KEY_ID, S3_SECRET_ACCESS_KEY, S3_PREFIX, S3_VIRTUAL_HOST, S3_PUBLIC_BASE_URL,
+    STORAGE_URL_EXPIRES_S, S3_MULTIPART_THRESHOLD, S3_PART_SIZE, S3_TIMEOUT_S)."""
+    backend = os.environ.get('STORAGE_BACKEND', 'local').strip().lower() or 'local'
+    if backend == 's3':
+        store = S3BlobStore(
+            endpoint=os.environ.get('S3_ENDPOINT', '').strip(),
+            bucket=os.environ.get('S3_BUCKET', '').strip(),
+            access_key=os.environ.get('S3_ACCESS_KEY_ID', '').strip() or os.environ.get('AWS_ACCESS_KEY_ID', '').strip(),
+            secret_key=os.environ.get('S3_SECRET_ACCESS_KEY', '').strip() or os.environ.get('AWS_SECRET_ACCESS_KEY', '').strip(),
+            region=os.environ.get('S3_REGION', '').strip() or 'us-east-1',
+            prefix=os.environ.get('S3_PREFIX', ''),
+            virtual_host=os.environ.get('S3_VIRTUAL_HOST', '').strip().lower() in ('1', 'true', 'yes'),
+            public_base_url=os.environ.get('S3_PUBLIC_BASE_URL', '').strip(),
+            url_expires_s=_env_int('STORAGE_URL_EXPIRES_S', 3600),
+            multipart_threshold=_env_int('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024),
+            part_size=_env_int('S3_PART_SIZE', 8 * 1024 * 1024),
+            timeout=float(_env_int('S3_TIMEOUT_S', 30)),
+        )
+        print(f"[Storage] S3 {store.scheme}://{store.host}{store.base_path} (prefijo '{store.prefix}')")
+    elif backend == 'local':
+        root = os.environ.get('STORAGE_LOCAL_ROOT', '').strip() or base_dir
+        store = LocalBlobStore(root, base_dir)
+        if store.shared:
+            print(f"[Storage] Directorio compartido {store.root}")
+    else:
+        raise StorageError(f"STORAGE_BACKEND desconocido: {backend}")
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=store._reset_after_fork)
+    return store
@@ -0,0 +1,96 @@
+# Fixtures comunes. `app_module` importa app.py desde una copia del árbol en un directorio
+# temporal: uploads/, results/ y las bases SQLite de la app no tocan las del repo.
+import importlib
+import os
+import shutil
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+TEST_ENV = {
+    'IMAGE_POOL_WORKERS': '0',
+    'IMAGE_BACKEND': 'fake',
+    'GEMINI_API_KEY': '',
+    'JANITOR_INTERVAL_S': '0',
+    'STORAGE_BACKEND': 'local',
+    'JOBS_BACKEND': 'memory',
+    'PREWARM': '0',
+}
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    tree = tmp_path_factory.mktemp('app') / 'tree'
+    shutil.copytree(ROOT, tree, ignore=shutil.ignore_patterns(
+        '.git', 'tests', 'uploads', 'results', '__pycache__', 'benchmarks', '*.sqlite3*', '.env'))
+    saved_env = {k: os.environ.get(k) for k in TEST_ENV}
+    saved_cwd = os.getcwd()
+    os.environ.update(TEST_ENV)
+    # Sólo app.py sale de la copia (BASE_DIR = su carpeta); los módulos ya importados por los tests
+    # se reutilizan tal cual
+    sys.path.insert(0, str(tree))
+    sys.modules.pop('app', None)
+    os.chdir(tree)
+    try:
+        module = importlib.import_module('app')
+        module.app.config['TESTING'] = True
+        yield module
+    finally:
+        try:
+            module.FIRESTORE_WRITER.close()
+        except Exception:
+            pass
+        os.chdir(saved_cwd)
+        sys.modules.pop('app', None)
+        sys.path.remove(str(tree))
+        for k, v in saved_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+class FakeQuery:
+    """Consulta de Firestore mínima: registra la cadena de llamadas y devuelve `docs`."""
+
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return call
+
+    def stream(self):
+        limit = next((args[0] for name, args, _ in reversed(self.calls) if name == 'limit'), None)
+        return iter(self.docs[:limit])
+
+
+@pytest.fixture
+def fake_firestore(monkeypatch):
+    """Módulo google.cloud.firestore falso (sin la librería ni credenciales)."""
+    firestore = types.SimpleNamespace(
+        DELETE_FIELD='<delete>',
+        Query=types.SimpleNamespace(DESCENDING='DESCENDING'),
+        FieldFilter=lambda *args: ('filter', args),
+    )
+    cloud = types.ModuleType('google.cloud')
+    cloud.firestore = firestore
+    google = types.ModuleType('google')
+    google.cloud = cloud
+    monkeypatch.setitem(sys.modules, 'google', google)
+    monkeypatch.setitem(sys.modules, 'google.cloud', cloud)
+    monkeypatch.setitem(sys.modules, 'google.cloud.firestore', firestore)
+    return firestore
@@ -0,0 +1,181 @@
+import asyncio
+import importlib
+import json
+import sys
+import time
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def asgi(app_module):
+    # asgi.py importa la app: sólo después de cargarla desde la copia del árbol
+    module = importlib.import_module('asgi')
+    yield module
+    module.BRIDGE.executor.shutdown(wait=True)
+    sys.modules.pop('asgi', None)
+
+
+def _scope(method='GET', path='/', headers=()):
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': list(headers),
+            'http_version': '1.1', 'scheme': 'http', 'server': ('test', 80), 'client': ('127.0.0.1', 1)}
+
+
+def _drive(handler, scope, body=b''):
+    """Llama a la app ASGI y devuelve (status, headers, cuerpo, mensajes)."""
+    messages = []
+    incoming = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        if incoming:
+            return incoming.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(handler(scope, receive, send))
+    start = next(m for m in messages if m['type'] == 'http.response.start')
+    data = b''.join(m.get('body', b'') for m in messages if m['type'] == 'http.response.body')
+    return start['status'], dict(start['headers']), data, messages
+
+
+class _Closing:
+    def __init__(self, chunks, log):
+        self.chunks = chunks
+        self.log = log
+
+    def __iter__(self):
+        yield from self.chunks()
+
+    def close(self):
+        self.log.append('closed')
+
+
+def test_write_callable_data_is_sent_in_order(asgi):
+    def wsgi_app(environ, start_response):
+        write = start_response('200 OK', [('Content-Type', 'text/plain')])
+        write(b'uno,')
+        return [b'dos,', b'tres']
+
+    status, headers, data, _ = _drive(asgi.WSGIBridge(wsgi_app, threads=2), _scope())
+    assert status == 200
+    assert headers[b'content-type'] == b'text/plain'
+    assert data == b'uno,dos,tres'
+
+
+def test_request_body_and_environ_reach_the_app(asgi):
+    seen = {}
+
+    def wsgi_app(environ, start_response):
+        seen['body'] = environ['wsgi.input'].read()
+        seen['length'] = environ['CONTENT_LENGTH']
+        seen['type'] = environ.get('CONTENT_TYPE')
+        start_response('201 Created', [])
+        return [b'ok']
+
+    status, _, data, _ = _drive(asgi.WSGIBridge(wsgi_app, threads=2),
+                                _scope('POST', '/x', [(b'content-type', b'application/json')]), b'{"a":1}')
+    assert (status, data) == (201, b'ok')
+    assert seen == {'body': b'{"a":1}', 'length': '7', 'type': 'application/json'}
+
+
+def test_exc_info_replaces_headers_not_yet_sent(asgi):
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        try:
+            raise ValueError('fallo antes del cuerpo')
+        except ValueError:
+            start_response('500 Internal Server Error', [('Content-Type', 'text/html')], sys.exc_info())
+        return [b'error']
+
+    status, headers, data, _ = _drive(asgi.WSGIBridge(wsgi_app, threads=2), _scope())
+    assert (status, headers[b'content-type'], data) == (500, b'text/html', b'error')
+
+
+def test_exc_info_after_headers_sent_aborts_and_closes(asgi):
+    log = []
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [])
+
+        def chunks():
+            yield b'parcial'
+            try:
+                raise ValueError('fallo a mitad del cuerpo')
+            except ValueError:
+                start_response('500 Internal Server Error', [], sys.exc_info())
+            yield b'nunca'
+        return _Closing(chunks, log)
+
+    with pytest.raises(ValueError, match='a mitad'):
+        _drive(asgi.WSGIBridge(wsgi_app, threads=2), _scope())
+    assert log == ['closed']
+
+
+def test_second_start_response_without_exc_info_is_an_error(asgi):
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [])
+        start_response('200 OK', [])
+        return [b'']
+
+    with pytest.raises(AssertionError):
+        _drive(asgi.WSGIBridge(wsgi_app, threads=2), _scope())
+
+
+def test_request_body_is_closed_when_the_app_raises(asgi):
+    inputs = []
+
+    def wsgi_app(environ, start_response):
+        inputs.append(environ['wsgi.input'])
+        raise RuntimeError('antes de responder')
+
+    with pytest.raises(RuntimeError):
+        _drive(asgi.WSGIBridge(wsgi_app, threads=2), _scope('POST'), b'cuerpo')
+    assert inputs[0].closed
+
+
+def test_oversized_body_gets_413(asgi):
+    bridge = asgi.WSGIBridge(lambda environ, start_response: [], threads=1, max_body=4)
+    status, _, data, _ = _drive(bridge, _scope('POST'), b'demasiado')
+    assert status == 413
+    assert 'error' in json.loads(data)
+
+
+def test_flask_app_through_the_bridge(asgi):
+    status, headers, data, _ = _drive(asgi.application, _scope('GET', '/api/costumes'))
+    assert status == 200
+    assert headers[b'content-type'] == b'application/json'
+    assert json.loads(data)['items']
+
+
+def test_job_events_stream_ends_on_terminal_state(asgi, app_module):
+    job_id = app_module.JOB_QUEUE.store.create('asgi-done', {})['id']
+    app_module.JOB_QUEUE.store.update(job_id, state='done', result={'ok': True})
+    status, headers, data, _ = _drive(asgi.application, _scope('GET', f'/api/jobs/{job_id}/events'))
+    assert status == 200
+    assert headers[b'content-type'].startswith(b'text/event-stream')
+    text = data.decode()
+    assert text.startswith('event: done\n')
+    assert json.loads(text.split('data: ', 1)[1])['result'] == {'ok': True}
+
+
+def test_job_events_share_the_wsgi_stream_cap(asgi, app_module, monkeypatch):
+    job_id = app_module.JOB_QUEUE.store.create('asgi-cap', {})['id']
+    monkeypatch.setenv('SSE_MAX_STREAMS', '1')
+    monkeypatch.setattr(asgi.JOB_EVENTS, 'open_streams', 1)
+    status, headers, data, _ = _drive(asgi.application, _scope('GET', f'/api/jobs/{job_id}/events'))
+    assert status == 503
+    assert headers[b'retry-after'] == b'2'
+    assert json.loads(data)['status_url'] == f'/api/jobs/{job_id}'
+
+
+def test_job_events_end_after_sse_max_seconds(asgi, app_module, monkeypatch):
+    job_id = app_module.JOB_QUEUE.store.create('asgi-slow', {})['id']
+    monkeypatch.setenv('SSE_MAX_SECONDS', '1')
+    started = time.monotonic()
+    status, _, data, _ = _drive(asgi.application, _scope('GET', f'/api/jobs/{job_id}/events'))
+    assert status == 200
+    assert time.monotonic() - started < 5
+    assert data.decode().startswith('event: queued\n')
+    assert asgi.JOB_EVENTS.open_streams == 0
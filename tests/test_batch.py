@@ -0,0 +1,149 @@
+import io
+import json
+
+from PIL import Image
+
+from batch import FIRESTORE_COMMIT_MAX_BYTES, FirestoreBatchWriter, record_size, run_batch, summarize
+
+
+def _png(color):
+    buf = io.BytesIO()
+    Image.new('RGB', (40, 30), color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def _ndjson(resp):
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines() if line]
+    return lines[:-1], lines[-1]['summary']
+
+
+class _FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def set(self, ref, record):
+        self.ops.append(record)
+
+    def commit(self):
+        if self.db.fail:
+            raise RuntimeError('UNAVAILABLE')
+        if sum(record_size(record) for record in self.ops) > 10 * 1024 * 1024:
+            raise RuntimeError('INVALID_ARGUMENT: Request payload size exceeds the limit')
+        self.db.commits.append(list(self.ops))
+
+
+class _FakeDb:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.commits = []
+
+    def collection(self, name):
+        return self
+
+    def document(self):
+        return object()
+
+    def batch(self):
+        return _FakeBatch(self)
+
+
+def test_multipart_batch_streams_one_line_per_item_and_a_summary(client):
+    resp = client.post('/api/batch', data={
+        'images': [(io.BytesIO(_png((200, 0, 0))), 'a.png'), (io.BytesIO(_png((0, 0, 200))), 'b.png')],
+        'disfraz': 'vampiro,bruja',
+        'display_name': 'Evento Lote',
+    }, content_type='multipart/form-data')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/x-ndjson'
+
+    items, summary = _ndjson(resp)
+    assert sorted(item['index'] for item in items) == [0, 1, 2, 3]
+    assert {(item['image_url'], item['disfraz']) for item in items} == {
+        (url, d) for url in {item['image_url'] for item in items} for d in ('vampiro', 'bruja')}
+    for item in items:
+        assert item['ok'] is True
+        assert item['transformed_image_url'].startswith('/results/')
+        assert len(item['poem_lines']) == 3
+    assert summary['items'] == 4 and summary['ok'] == 4 and summary['failed'] == 0
+
+
+def test_json_batch_reports_failures_and_writes_firestore_in_batches(client, app_module, monkeypatch):
+    db = _FakeDb()
+    real = app_module._run_transform
+
+    def flaky(params, progress=None, record_sink=None):
+        if params['image_url'].endswith('missing.png'):
+            raise RuntimeError('imagen no encontrada')
+        return real(params, progress, record_sink)
+
+    monkeypatch.setattr(app_module, '_run_transform', flaky)
+    monkeypatch.setattr(app_module, 'get_db', lambda: db)
+    upload = client.post('/upload', data={'image': (io.BytesIO(_png((0, 150, 0))), 'c.png')},
+                         content_type='multipart/form-data').get_json()
+    resp = client.post('/api/batch', json={
+        'image_urls': [upload['image_url'], '/uploads/missing.png'],
+        'disfraces': ['vampiro'],
+        'display_name': 'Evento JSON',
+    })
+    items, summary = _ndjson(resp)
+    failed = [item for item in items if not item['ok']]
+    assert len(items) == 2
+    assert [item['error'] for item in failed] == ['imagen no encontrada']
+    assert summary['ok'] == 1 and summary['failed'] == 1
+    assert summary['firestore_writes'] == 1 and summary['firestore_commits'] == 1
+    assert db.commits[0][0]['display_name'] == 'Evento JSON'
+
+
+def test_batch_validation(client, monkeypatch):
+    assert client.post('/api/batch', json={'image_urls': ['/uploads/x.png'], 'disfraces': ['vampiro'],
+                                           'display_name': 'abc'}).status_code == 400
+    assert client.post('/api/batch', json={'image_urls': ['/uploads/x.png'], 'disfraces': [],
+                                           'display_name': 'Evento'}).status_code == 400
+    monkeypatch.setenv('BATCH_MAX_ITEMS', '3')
+    resp = client.post('/api/batch', json={'image_urls': ['/uploads/a.png', '/uploads/b.png'],
+                                           'disfraces': ['vampiro', 'bruja'], 'display_name': 'Evento'})
+    assert resp.status_code == 400
+    assert '3' in resp.get_json()['error']
+
+
+def test_batch_writer_commits_every_max_ops_and_falls_back_on_failure():
+    db = _FakeDb()
+    writer = FirestoreBatchWriter(db, 'c', max_ops=2)
+    for i in range(5):
+        writer.add({'i': i})
+    writer.flush()
+    assert [len(ops) for ops in db.commits] == [2, 2, 1]
+    assert writer.written == 5 and writer.commits == 3
+
+    spilled = []
+    writer = FirestoreBatchWriter(_FakeDb(fail=True), 'c', max_ops=10,
+                                  fallback=lambda coll, records: spilled.append((coll, records)))
+    writer.add({'i': 1})
+    writer.flush()
+    assert spilled == [('c', [{'i': 1}])]
+    assert writer.written == 0
+
+
+def test_batch_writer_cuts_commits_by_bytes():
+    # Sin almacén compartido cada registro lleva hasta ~930 KB de base64: 100 no entran en un commit
+    db = _FakeDb()
+    spilled = []
+    writer = FirestoreBatchWriter(db, 'c', max_ops=100, fallback=lambda coll, records: spilled.append(records))
+    record = {'transformed_image_b64': 'A' * (930 * 1024)}
+    for _ in range(30):
+        writer.add(dict(record))
+    writer.flush()
+    assert spilled == []
+    assert sum(len(ops) for ops in db.commits) == 30 and len(db.commits) > 1
+    assert all(len(ops) * record_size(record) <= FIRESTORE_COMMIT_MAX_BYTES for ops in db.commits)
+
+
+def test_run_batch_and_summary():
+    outcomes = list(run_batch([1, 2, 0], lambda x: 10 // x, workers=2))
+    by_index = {o['index']: o for o in outcomes}
+    assert by_index[0]['result'] == 10 and by_index[1]['result'] == 5
+    assert by_index[2]['ok'] is False and 'division' in by_index[2]['error']
+    summary = summarize(outcomes, 0.5)
+    assert summary['items'] == 3 and summary['ok'] == 2 and summary['failed'] == 1
+    assert summary['items_per_s'] == 6.0
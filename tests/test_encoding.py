@@ -0,0 +1,53 @@
+import random
+
+from PIL import Image
+
+from encoding import MAX_QUALITY, MIN_QUALITY, encode_webp, predict_quality
+
+
+def _noisy(size=(512, 512), seed=3):
+    rnd = random.Random(seed)
+    img = Image.new('RGB', size)
+    img.putdata([(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for _ in range(size[0] * size[1])])
+    return img
+
+
+def test_predict_quality_trusts_max_when_budget_is_ample():
+    assert predict_quality(256, 256, 4.0, 10 * 1024 * 1024) == (MAX_QUALITY, True)
+
+
+def test_predict_quality_estimates_lower_start_for_tight_budget():
+    quality, confident = predict_quality(1024, 1024, 7.5, 250 * 1024)
+    assert not confident
+    assert MIN_QUALITY < quality < MAX_QUALITY
+    # Más presupuesto, calidad inicial mayor; muy poco, la mínima
+    assert quality < predict_quality(1024, 1024, 7.5, 280 * 1024)[0] < MAX_QUALITY
+    assert predict_quality(1024, 1024, 7.5, 50 * 1024) == (MIN_QUALITY, False)
+
+
+def test_encode_webp_stays_under_budget():
+    img = _noisy()
+    data, stats = encode_webp(img, budget=120 * 1024)
+    assert len(data) <= 120 * 1024 or stats['quality'] == MIN_QUALITY
+    assert stats['bytes'] == len(data)
+    assert stats['attempts'][-1]['quality'] == stats['quality']
+
+
+def test_quality_search_bisects_instead_of_walking_the_grid(monkeypatch):
+    import encoding
+    calls = []
+
+    def fake_encode(img, quality, method, attempts):
+        # Tamaño proporcional a la calidad: con 7500 bytes cabe hasta 75
+        calls.append((quality, method))
+        attempts.append({'quality': quality, 'method': method, 'bytes': quality * 100, 'ms': 0})
+        return b'x' * (quality * 100)
+
+    monkeypatch.setattr(encoding, '_encode', fake_encode)
+    monkeypatch.setattr(encoding, 'predict_quality', lambda *args: (MIN_QUALITY, False))
+    data, stats = encode_webp(Image.new('RGB', (8, 8)), budget=7500)
+    probes = [q for q, method in calls if method == encoding.PROBE_METHOD]
+    # Rejilla de 7 calidades: a lo sumo 1 + ceil(log2(7)) sondeos, no uno por escalón
+    assert len(probes) <= 4
+    assert stats['quality'] == 75 and len(data) <= 7500
+    assert len(calls) == len(probes) + 1
@@ -0,0 +1,79 @@
+import io
+
+import pytest
+from PIL import Image
+
+from conftest import FakeQuery
+from gallery_index import encode_cursor
+
+
+class _FakeDb:
+    def __init__(self, query):
+        self.query = query
+
+    def collection(self, name):
+        return self.query
+
+
+def _upload(client, color):
+    buf = io.BytesIO()
+    Image.new('RGB', (40, 30), color).save(buf, 'PNG')
+    resp = client.post('/upload', data={'image': (io.BytesIO(buf.getvalue()), 'foto.png')},
+                       content_type='multipart/form-data')
+    assert resp.status_code == 200
+    return resp.get_json()['image_url']
+
+
+@pytest.mark.parametrize('raw, expected', [('5000', 100), ('0', 1), ('-3', 1), ('abc', 24)])
+def test_firestore_gallery_clamps_limit(client, app_module, fake_firestore, monkeypatch, raw, expected):
+    query = FakeQuery()
+    monkeypatch.setattr(app_module, 'get_db', lambda: _FakeDb(query))
+    cursor = encode_cursor('2026-01-01T00:00:00', 'doc-1')
+    resp = client.get(f'/api/gallery?limit={raw}&cursor={cursor}')
+    assert resp.status_code == 200
+    assert ('limit', (expected,), {}) in query.calls
+
+
+def test_local_gallery_clamps_limit(client, app_module, monkeypatch):
+    seen = []
+    monkeypatch.setattr(app_module, 'get_db', lambda: None)
+    monkeypatch.setattr(app_module.GALLERY_INDEX, 'page', lambda limit, *a: (seen.append(limit), ([], None))[1])
+    assert client.get('/api/gallery?limit=5000').status_code == 200
+    assert seen == [100]
+
+
+def test_record_is_generated_ai_only_when_the_model_produced_it(client, app_module, monkeypatch):
+    params = {'disfraz': 'vampiro', 'extra_prompt': '', 'use_thematic_bg': True, 'display_name': 'Estado IA'}
+    records = []
+    app_module._run_transform(dict(params, image_url=_upload(client, (10, 120, 40))), None, records.append)
+    assert records[-1]['estado'] == 'generated_ai'
+    assert app_module.GALLERY_INDEX.has_file(records[-1]['transformed_image_url'].rsplit('/', 1)[-1])
+
+    # Sin backend de imagen: el resultado se guarda en results/, pero no es IA
+    monkeypatch.setattr(app_module, 'IMAGE_BACKEND', None)
+    app_module._run_transform(dict(params, image_url=_upload(client, (130, 20, 90))), None, records.append)
+    assert records[-1]['transformed_image_url'].startswith('/results/')
+    assert records[-1]['estado'] == 'themed_local'
+    # Mismo conjunto que la consulta de Firestore: el índice local no lista lo que no generó el modelo
+    assert not app_module.GALLERY_INDEX.has_file(records[-1]['transformed_image_url'].rsplit('/', 1)[-1])
+
+
+def test_legacy_cursor_is_rejected(client, app_module, fake_firestore, monkeypatch):
+    query = FakeQuery()
+    monkeypatch.setattr(app_module, 'get_db', lambda: _FakeDb(query))
+    resp = client.get('/api/gallery?cursor=2025-10-31T20:15:00.123456')
+    assert resp.status_code == 400
+    assert not any(name == 'start_after' for name, _, _ in query.calls)
+
+
+def test_firestore_failure_with_cursor_does_not_restart_from_the_local_index(client, app_module, fake_firestore,
+                                                                            monkeypatch):
+    class _Failing(FakeQuery):
+        def stream(self):
+            raise RuntimeError('DEADLINE_EXCEEDED')
+
+    monkeypatch.setattr(app_module, 'get_db', lambda: _FakeDb(_Failing()))
+    monkeypatch.setattr(app_module.GALLERY_INDEX, 'page', lambda *a: pytest.fail('página local con cursor de Firestore'))
+    resp = client.get(f"/api/gallery?cursor={encode_cursor('2026-01-01T00:00:00', 'doc-1')}")
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '2'
@@ -0,0 +1,40 @@
+import os
+
+from gallery_index import GalleryIndex
+
+
+def _index_with_files(tmp_path, names):
+    index = GalleryIndex(str(tmp_path))
+    for i, name in enumerate(names):
+        (tmp_path / name).write_bytes(b'x')
+        index.add(name, disfraz='vampiro', ts=1000.0 + i)
+    return index
+
+
+def test_page_skips_stale_rows_and_stays_full(tmp_path):
+    names = [f'{i}.webp' for i in range(6)]
+    index = _index_with_files(tmp_path, names)
+    # Los más recientes (5, 4) y uno intermedio (2) ya no están en disco
+    for name in ('5.webp', '4.webp', '2.webp'):
+        os.remove(tmp_path / name)
+
+    items, cursor = index.page(2)
+    assert [item['filename'] for item in items] == ['3.webp', '1.webp']
+    assert cursor is not None
+    items, cursor = index.page(2, cursor)
+    assert [item['filename'] for item in items] == ['0.webp']
+    assert cursor is None
+    # Las filas huérfanas se borraron al encontrarlas
+    assert not index.has_file('5.webp') and not index.has_file('2.webp')
+
+
+def test_page_cursor_walks_every_item_once(tmp_path):
+    index = _index_with_files(tmp_path, [f'{i}.webp' for i in range(7)])
+    seen, cursor = [], None
+    while True:
+        items, cursor = index.page(3, cursor, disfraz='vampiro')
+        seen.extend(item['filename'] for item in items)
+        if not cursor:
+            break
+    assert seen == [f'{i}.webp' for i in reversed(range(7))]
+    assert index.page(3, disfraz='otro') == ([], None)
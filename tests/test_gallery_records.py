@@ -0,0 +1,111 @@
+import base64
+
+import pytest
+
+from conftest import FakeQuery
+from storage import LocalBlobStore
+
+
+class _FakeSnapshot:
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data)
+
+
+class _FakeRef:
+    def __init__(self, stored=None):
+        self.stored = stored or {}
+        self.updates = []
+        self.gets = []
+
+    def update(self, fields):
+        self.updates.append(fields)
+
+    def get(self, field_paths=None):
+        self.gets.append(field_paths)
+        return _FakeSnapshot({k: v for k, v in self.stored.items() if k in field_paths})
+
+
+class _FakeDoc:
+    id = 'doc-1'
+
+    def __init__(self, data=None, stored=None):
+        self.data = data or {}
+        self.reference = _FakeRef(dict(self.data, **(stored or {})))
+
+    def to_dict(self):
+        return dict(self.data)
+
+
+class _FakeDb:
+    def __init__(self, query):
+        self.query = query
+
+    def collection(self, name):
+        return self.query
+
+
+@pytest.fixture
+def shared_store(app_module, monkeypatch, tmp_path):
+    store = LocalBlobStore(str(tmp_path / 'bucket'), app_module.BASE_DIR)
+    monkeypatch.setattr(app_module, 'BLOB_STORE', store)
+    monkeypatch.setattr(app_module, '_published_results', {})
+    return store
+
+
+def test_local_only_result_keeps_base64_in_record(app_module):
+    url = app_module._write_result(b'RIFF-local-only')
+    fields = app_module._record_image_fields(url)
+    assert base64.b64decode(fields['transformed_image_b64']) == b'RIFF-local-only'
+    assert fields['result_hash'] == url.rsplit('/', 1)[-1].split('.')[0]
+
+
+def test_shared_result_record_is_url_only(app_module, shared_store):
+    url = app_module._write_result(b'RIFF-shared')
+    fields = app_module._record_image_fields(url)
+    assert 'transformed_image_b64' not in fields
+    assert shared_store.exists('results/' + url.rsplit('/', 1)[-1])
+
+
+def test_migration_keeps_base64_without_shared_store(app_module, fake_firestore):
+    doc = _FakeDoc()
+    data = {'transformed_image_b64': base64.b64encode(b'legacy-bytes').decode(), 'transformed_mime': 'image/webp'}
+    url = app_module._migrate_legacy_gallery_doc(doc, data)
+    with open(app_module.RESULT_CACHE.path_for(url.rsplit('/', 1)[-1]), 'rb') as f:
+        assert f.read() == b'legacy-bytes'
+    assert doc.reference.updates == []
+
+
+def test_migration_drops_base64_once_in_shared_store(app_module, shared_store, fake_firestore):
+    doc = _FakeDoc()
+    data = {'transformed_image_b64': base64.b64encode(b'legacy-shared').decode(), 'transformed_mime': 'image/webp'}
+    url = app_module._migrate_legacy_gallery_doc(doc, data)
+    filename = url.rsplit('/', 1)[-1]
+    assert shared_store.exists(f'results/{filename}')
+    assert doc.reference.updates == [{
+        'transformed_image_url': url,
+        'result_hash': filename.split('.')[0],
+        'transformed_image_b64': '<delete>',
+    }]
+
+
+def test_gallery_page_reads_base64_only_for_missing_images(client, app_module, fake_firestore, monkeypatch):
+    local_url = app_module._write_result(b'RIFF-local-gallery')
+    present = _FakeDoc({'timestamp': '2026-01-02', 'transformed_image_url': local_url},
+                       {'transformed_image_b64': base64.b64encode(b'RIFF-local-gallery').decode()})
+    missing = _FakeDoc({'timestamp': '2026-01-01', 'transformed_image_url': '/results/' + 'f' * 32 + '.webp'},
+                       {'transformed_image_b64': base64.b64encode(b'RIFF-from-b64').decode(),
+                        'transformed_mime': 'image/webp'})
+    query = FakeQuery([present, missing])
+    monkeypatch.setattr(app_module, 'get_db', lambda: _FakeDb(query))
+
+    items = client.get('/api/gallery').get_json()['items']
+    select = next(args[0] for name, args, _ in query.calls if name == 'select')
+    assert 'transformed_image_b64' not in select
+    assert present.reference.gets == []
+    assert missing.reference.gets == [app_module.GALLERY_B64_FIELDS]
+    restored = items[1]['image_url'].rsplit('/', 1)[-1]
+    with open(app_module.RESULT_CACHE.path_for(restored), 'rb') as f:
+        assert f.read() == b'RIFF-from-b64'
@@ -0,0 +1,87 @@
+import multiprocessing
+import sys
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+from image_pool import ImagePool, ImagePoolBusy
+
+
+def _child_modules() -> dict:
+    # Se ejecuta en el hijo: qué trajo precargado y si arrastró la app
+    return {
+        'start_method': multiprocessing.get_start_method(),
+        'image_worker': 'image_worker' in sys.modules,
+        'app': 'app' in sys.modules,
+        'flask': 'flask' in sys.modules,
+    }
+
+
+@pytest.fixture
+def pool():
+    pool = ImagePool(workers=1, max_pending=1)
+    yield pool
+    pool.shutdown()
+
+
+def test_children_come_from_a_preloaded_forkserver_without_touching_main(pool):
+    main = sys.modules['__main__']
+    swapped = []
+    stop = threading.Event()
+
+    def watch():
+        # Otro hilo de la app no debe ver nunca un `__main__` distinto mientras arranca el pool
+        while not stop.is_set():
+            if sys.modules.get('__main__') is not main:
+                swapped.append(sys.modules.get('__main__'))
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    try:
+        info = pool.run(_child_modules, block=True, timeout=60)
+    finally:
+        stop.set()
+        watcher.join()
+    assert swapped == []
+    assert info == {'start_method': 'forkserver', 'image_worker': True, 'app': False, 'flask': False}
+
+
+def test_timed_out_task_keeps_its_slot_until_it_finishes(pool):
+    pool.run(time.sleep, 0, block=True, timeout=60)  # arranca el proceso hijo
+    with pytest.raises(FutureTimeoutError):
+        pool.run(time.sleep, 1.0, block=True, timeout=0.2)
+    assert pool.stats()['pending'] == 1
+    with pytest.raises(ImagePoolBusy):
+        pool.run(time.sleep, 0)
+    assert pool.stats()['rejected'] == 1
+
+    deadline = time.time() + 10
+    while pool.stats()['pending'] and time.time() < deadline:
+        time.sleep(0.05)
+    assert pool.stats()['pending'] == 0
+    assert pool.run(abs, -3) == 3
+
+
+def test_rejections_are_counted_under_concurrency():
+    pool = ImagePool(workers=0, max_pending=1)
+    gate = threading.Event()
+    holder = threading.Thread(target=pool.run, args=(gate.wait, 5), kwargs={'block': True})
+    holder.start()
+    while pool.stats()['pending'] == 0:
+        time.sleep(0.01)
+
+    def reject_many():
+        for _ in range(200):
+            with pytest.raises(ImagePoolBusy):
+                pool.run(abs, 1)
+
+    threads = [threading.Thread(target=reject_many) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    gate.set()
+    holder.join()
+    assert pool.stats() == {'workers': 0, 'max_pending': 1, 'pending': 0, 'rejected': 800}
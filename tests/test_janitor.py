@@ -0,0 +1,132 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from gallery_index import GalleryIndex
+from janitor import FolderPolicy, Janitor
+from result_cache import ResultCache
+from storage import LocalBlobStore
+
+
+def _write(folder, name, size, age_s):
+    path = folder / name
+    path.write_bytes(b'x' * size)
+    old = time.time() - age_s
+    os.utime(path, (old, old))
+    return path
+
+
+def _janitor(tmp_path, referenced=(), **policy):
+    results = tmp_path / 'results'
+    derived = results / 'derived'
+    derived.mkdir(parents=True)
+    folders = {'results': FolderPolicy(str(results), min_age_s=0, **policy)}
+    return Janitor(str(tmp_path / 'janitor.sqlite3'), folders,
+                   is_referenced=lambda folder, name: name in referenced, derived_dir=str(derived))
+
+
+def test_quota_never_deletes_referenced_results(tmp_path):
+    janitor = _janitor(tmp_path, referenced={'a.webp', 'b.webp'}, max_bytes=150)
+    results = tmp_path / 'results'
+    _write(results, 'a.webp', 100, 300)
+    _write(results, 'b.webp', 100, 200)
+    _write(results, 'c.webp', 100, 100)
+
+    report = janitor.run_pass()
+    assert report['deleted'] == {'results': {'quota': 1}}
+    assert sorted(os.listdir(results)) == ['a.webp', 'b.webp', 'derived']
+    assert report['over_quota'] == {'results': 200}
+
+
+def test_tracking_again_renews_the_age(tmp_path):
+    janitor = _janitor(tmp_path, max_age_s=60)
+    path = _write(tmp_path / 'results', 'a.webp', 10, 300)
+    janitor.run_pass(dry_run=True)  # lo descubre con su mtime viejo
+    janitor.track('results', 'a.webp', 10)
+    report = janitor.run_pass()
+    assert report['deleted'] == {}
+    assert path.exists()
+
+
+def test_derived_kept_while_an_original_with_any_extension_exists(tmp_path):
+    janitor = _janitor(tmp_path)
+    results = tmp_path / 'results'
+    derived = results / 'derived'
+    _write(results, 'aaaa.png', 10, 100)
+    kept = _write(derived, 'aaaa-480.webp', 10, 100)
+    orphan = _write(derived, 'bbbb-480.webp', 10, 100)
+
+    report = janitor.run_pass()
+    assert kept.exists()
+    assert not orphan.exists()
+    assert report['deleted']['derived'] == {'orphan': 1}
+
+
+def test_repeated_upload_renews_its_age(client, app_module):
+    buf = io.BytesIO()
+    Image.new('RGB', (24, 24), (5, 80, 200)).save(buf, 'PNG')
+    upload = lambda: client.post('/upload', data={'image': (io.BytesIO(buf.getvalue()), 'r.png')},
+                                 content_type='multipart/form-data').get_json()
+    filename = upload()['image_url'].rsplit('/', 1)[-1]
+    path = os.path.join(app_module.UPLOAD_FOLDER, filename)
+    old = time.time() - 7 * 86400
+    os.utime(path, (old, old))
+    with app_module.JANITOR._connect() as conn:
+        conn.execute("UPDATE files SET mtime = ? WHERE folder = 'uploads' AND name = ?", (old, filename))
+
+    assert upload()['image_url'].endswith(filename)
+    assert os.path.getmtime(path) > old + 86400
+    with app_module.JANITOR._connect() as conn:
+        mtime = conn.execute("SELECT mtime FROM files WHERE folder = 'uploads' AND name = ?", (filename,)).fetchone()[0]
+    assert mtime > old + 86400
+
+
+@pytest.fixture
+def app_results(app_module, monkeypatch, tmp_path):
+    # results/ propio: la pasada con tope no toca los archivos de las demás pruebas
+    results = tmp_path / 'app-results'
+    (results / 'derived').mkdir(parents=True)
+    monkeypatch.setattr(app_module, 'RESULTS_FOLDER', str(results))
+    monkeypatch.setattr(app_module, 'GALLERY_INDEX', GalleryIndex(str(results)))
+    monkeypatch.setattr(app_module, 'RESULT_CACHE', ResultCache(str(results)))
+    monkeypatch.setattr(app_module, '_firestore_result_refs', lambda: set())
+    return results
+
+
+def test_quota_reclaims_old_gallery_results_without_a_store(app_module, app_results, monkeypatch, tmp_path):
+    monkeypatch.setenv('JANITOR_GALLERY_KEEP', '2')
+    for i in range(6):
+        _write(app_results, f"r{i}.webp", 100, 600 - i * 60)
+        app_module.GALLERY_INDEX.add(f"r{i}.webp", ts=time.time() - 600 + i * 60)
+    janitor = Janitor(str(tmp_path / 'app-janitor.sqlite3'),
+                      {'results': FolderPolicy(str(app_results), max_bytes=250, min_age_s=0)},
+                      is_referenced=app_module._janitor_is_referenced, on_delete=app_module._janitor_on_delete)
+
+    report = janitor.run_pass()
+    assert report['deleted'] == {'results': {'quota': 4}}
+    assert sorted(n for n in os.listdir(app_results) if n.endswith('.webp')) == ['r4.webp', 'r5.webp']
+    assert [row['filename'] for row in app_module.GALLERY_INDEX.page(10)[0]] == ['r5.webp', 'r4.webp']
+
+
+def test_durable_results_are_never_referenced(app_module, app_results, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, 'BLOB_STORE', LocalBlobStore(str(tmp_path / 'bucket'), app_module.BASE_DIR))
+    monkeypatch.setattr(app_module, '_published_results', {})
+    name = 'durable.webp'
+    _write(app_results, name, 100, 0)
+    app_module.GALLERY_INDEX.add(name)
+    assert app_module._janitor_is_referenced('results', name)
+    # Publicado en el almacén compartido: la copia local es caché
+    app_module._remember_published(name)
+    assert not app_module._janitor_is_referenced('results', name)
+
+
+def test_firestore_results_with_base64_are_recoverable(app_module, app_results, monkeypatch):
+    monkeypatch.setattr(app_module, '_firestore_result_refs', lambda: {'small.webp', 'big.webp'})
+    monkeypatch.setattr(app_module, 'FIRESTORE_B64_MAX_BYTES', 150)
+    _write(app_results, 'small.webp', 100, 0)
+    _write(app_results, 'big.webp', 200, 0)
+    assert not app_module._janitor_is_referenced('results', 'small.webp')
+    assert app_module._janitor_is_referenced('results', 'big.webp')
@@ -0,0 +1,182 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from jobs import JobQueue, MemoryJobStore, SQLiteJobStore, public_job
+
+
+def _wait_terminal(queue, job_id, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get(job_id)
+        if job and job['state'] in ('done', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f'el trabajo {job_id} no terminó')
+
+
+def _png_bytes(color=(200, 80, 20)):
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteJobStore(str(tmp_path / 'jobs.sqlite3'))
+    return MemoryJobStore()
+
+
+def test_job_lifecycle_publishes_states_and_result(store):
+    seen = []
+
+    def handler(params, progress):
+        progress('generating')
+        progress('encoding')
+        return {'echo': params['x']}
+
+    queue = JobQueue(store, handler, workers=1)
+    queue.add_listener(lambda job_id: seen.append(queue.get(job_id)['state']))
+    job_id = queue.submit({'x': 7})
+    job = _wait_terminal(queue, job_id)
+
+    assert job['state'] == 'done'
+    assert job['result'] == {'echo': 7}
+    assert seen == ['generating', 'encoding', 'done']
+    assert public_job(job) == {
+        'job_id': job_id, 'state': 'done', 'created_at': job['created_at'],
+        'updated_at': job['updated_at'], 'result': {'echo': 7},
+    }
+
+
+def test_failed_job_keeps_error(store):
+    def handler(params, progress):
+        raise RuntimeError('sin cupo')
+
+    queue = JobQueue(store, handler, workers=1)
+    job = _wait_terminal(queue, queue.submit({}))
+    assert job['state'] == 'failed'
+    assert public_job(job)['error'] == 'sin cupo'
+    assert 'result' not in public_job(job)
+
+
+def test_wait_for_update_returns_on_change(store):
+    release = threading.Event()
+
+    def handler(params, progress):
+        release.wait(5)
+        return {}
+
+    queue = JobQueue(store, handler, workers=1)
+    job_id = queue.submit({})
+    since = queue.get(job_id)['updated_at']
+    threading.Timer(0.05, release.set).start()
+    job = queue.wait_for_update(job_id, since, timeout=5)
+    assert job['updated_at'] != since
+
+
+def test_prune_removes_only_old_terminal_jobs(store):
+    queue = JobQueue(store, lambda params, progress: {}, workers=1, ttl_s=3600)
+    done_id = queue.submit({})
+    _wait_terminal(queue, done_id)
+    store.create('pending', {})
+
+    assert queue.prune() == 0
+    assert store.prune(time.time() + 1) == 1
+    assert store.get(done_id) is None
+    assert store.get('pending')['state'] == 'queued'
+
+
+def test_submit_prunes_expired_jobs(store):
+    queue = JobQueue(store, lambda params, progress: {}, workers=1, ttl_s=0.05)
+    first = queue.submit({})
+    _wait_terminal(queue, first)
+    time.sleep(0.1)
+    second = queue.submit({})
+    assert store.get(first) is None
+    _wait_terminal(queue, second)
+
+
+def test_sqlite_orphans_are_resumed(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    store = SQLiteJobStore(path)
+    store.create('orphan', {'x': 1})
+    store.update('orphan', state='generating', owner='999999999')
+
+    queue = JobQueue(SQLiteJobStore(path), lambda params, progress: {'x': params['x']}, workers=1)
+    assert queue.resume_orphans() == 1
+    job = _wait_terminal(queue, 'orphan')
+    assert job['state'] == 'done' and job['result'] == {'x': 1}
+
+
+def _parse_sse(body: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in body.split('\n\n'):
+        lines = [line for line in block.splitlines() if not line.startswith(':')]
+        if not lines:
+            continue
+        event = next(line[len('event: '):] for line in lines if line.startswith('event: '))
+        data = next(line[len('data: '):] for line in lines if line.startswith('data: '))
+        events.append((event, json.loads(data)))
+    return events
+
+
+def test_transform_job_over_http_and_sse(client):
+    upload = client.post('/upload', data={'image': (io.BytesIO(_png_bytes()), 'foto.png')},
+                         content_type='multipart/form-data')
+    assert upload.status_code == 200, upload.get_json()
+
+    resp = client.post('/transform', data={
+        'image_url': upload.get_json()['image_url'], 'disfraz': 'vampiro', 'display_name': 'Prueba SSE',
+    })
+    assert resp.status_code == 202
+    body = resp.get_json()
+    assert body['state'] == 'queued'
+
+    stream = client.get(body['events_url'])
+    assert stream.status_code == 200
+    assert stream.mimetype == 'text/event-stream'
+    events = _parse_sse(stream.get_data(as_text=True))
+    assert events[-1][0] == 'done'
+    assert events[-1][1]['job_id'] == body['job_id']
+    assert events[-1][1]['result']['transformed_image_url']
+
+    status = client.get(body['status_url']).get_json()
+    assert status['state'] == 'done'
+    assert status['result'] == events[-1][1]['result']
+
+
+def test_sse_unknown_job_is_404(client):
+    assert client.get('/api/jobs/nope/events').status_code == 404
+
+
+def test_sse_without_slots_falls_back_to_polling(client, app_module, monkeypatch):
+    job_id = app_module.JOB_QUEUE.store.create('sse-cap', {})['id']
+    monkeypatch.setattr(app_module, '_sse_slots', threading.BoundedSemaphore(1))
+    app_module._sse_slots.acquire()
+    try:
+        resp = client.get(f'/api/jobs/{job_id}/events')
+    finally:
+        app_module._sse_slots.release()
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '2'
+    assert resp.get_json()['status_url'] == f'/api/jobs/{job_id}'
+
+
+def test_sse_stream_is_capped_and_releases_its_slot(client, app_module, monkeypatch):
+    job_id = app_module.JOB_QUEUE.store.create('sse-slow', {})['id']
+    monkeypatch.setenv('SSE_MAX_SECONDS', '1')
+    monkeypatch.setattr(app_module, '_sse_slots', threading.BoundedSemaphore(1))
+    started = time.time()
+    resp = client.get(f'/api/jobs/{job_id}/events')
+    events = _parse_sse(resp.get_data(as_text=True))
+    resp.close()
+    assert time.time() - started < 5
+    assert [name for name, _ in events] == ['queued']
+    # El hueco vuelve al cerrar la respuesta
+    assert app_module._sse_slots.acquire(blocking=False)
@@ -0,0 +1,105 @@
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+from prewarm import Prewarmer
+
+
+def _params(disfraz, image_url='/uploads/a.webp'):
+    return {'image_url': image_url, 'disfraz': disfraz, 'extra_prompt': '', 'use_thematic_bg': True}
+
+
+def _drain(prewarmer):
+    executor = prewarmer._get_executor()
+    executor.submit(lambda: None).result(timeout=5)
+
+
+def test_global_budget_caps_spend_across_sessions():
+    prewarmer = Prewarmer(lambda params, hint: ('generated', params['disfraz']), enabled=True,
+                          budget=5, global_budget=2, workers=1)
+    assert prewarmer.hint('s1', [_params('vampire')]) == ['scheduled']
+    assert prewarmer.hint('s2', [_params('witch')]) == ['scheduled']
+    # Una sesión nueva no trae presupuesto nuevo
+    assert prewarmer.hint('s3', [_params('ghost')]) == ['over_budget']
+    _drain(prewarmer)
+    assert prewarmer.stats()['global_spent'] == 2
+
+
+def test_cancelled_and_cached_hints_refund_the_global_budget():
+    gate = threading.Event()
+
+    def run(params, hint):
+        gate.wait(5)
+        return 'cached', None
+
+    prewarmer = Prewarmer(run, enabled=True, budget=5, global_budget=2, workers=1)
+    assert prewarmer.hint('s1', [_params('vampire'), _params('witch')]) == ['scheduled', 'scheduled']
+    assert prewarmer.cancel('s1') in (1, 2)
+    gate.set()
+    _drain(prewarmer)
+    assert prewarmer.stats()['global_spent'] == 0
+    assert prewarmer.hint('s2', [_params('zombie')]) == ['scheduled']
+
+
+@pytest.fixture
+def prewarm(app_module, monkeypatch):
+    calls = []
+    prewarmer = Prewarmer(lambda params, hint: (calls.append(params) or ('generated', None)),
+                          enabled=True, budget=1, global_budget=10, workers=1)
+    monkeypatch.setattr(app_module, 'PREWARM', prewarmer)
+    return prewarmer
+
+
+def _upload(client):
+    buf = io.BytesIO()
+    Image.new('RGB', (32, 32), (90, 20, 160)).save(buf, 'PNG')
+    resp = client.post('/upload', data={'image': (io.BytesIO(buf.getvalue()), 'p.png')},
+                       content_type='multipart/form-data')
+    return resp.get_json()['image_url']
+
+
+def _hint(client, image_url, disfraz, **extra):
+    return client.post('/api/prefetch', json=dict({'image_url': image_url, 'disfraz': disfraz}, **extra))
+
+
+def test_session_comes_from_a_signed_server_cookie(app_module, prewarm):
+    client = app_module.app.test_client()
+    image_url = _upload(client)
+    first = _hint(client, image_url, 'vampire')
+    assert first.status_code == 202
+    cookie = client.get_cookie(app_module.PREFETCH_COOKIE)
+    assert cookie is not None and cookie.http_only
+    sid = cookie.value.split('.')[0]
+
+    # Mismo navegador: misma sesión y mismo presupuesto, aunque mande otro `session`
+    second = _hint(client, image_url, 'witch', session='otra')
+    assert second.get_json()['items'] == [{'disfraz': 'witch', 'status': 'over_budget'}]
+    assert set(prewarm._spent) == {sid}
+
+    # Cookie manipulada: se ignora y se emite una sesión nueva
+    forged = app_module.app.test_client()
+    forged.set_cookie(app_module.PREFETCH_COOKIE, f"{sid}.{'0' * 32}")
+    _hint(forged, image_url, 'ghost')
+    assert forged.get_cookie(app_module.PREFETCH_COOKIE).value.split('.')[0] != sid
+
+
+def test_delete_only_cancels_the_callers_own_session(app_module, prewarm, monkeypatch):
+    owner = app_module.app.test_client()
+    _hint(owner, _upload(owner), 'vampire')
+    owner_sid = owner.get_cookie(app_module.PREFETCH_COOKIE).value.split('.')[0]
+
+    cancelled = []
+    monkeypatch.setattr(prewarm, 'cancel', lambda session: cancelled.append(session) or 0)
+    other = app_module.app.test_client()
+    assert other.delete(f'/api/prefetch?session={owner_sid}').status_code == 200
+    assert other.delete('/api/prefetch', json={'session': owner_sid}).status_code == 200
+    assert owner_sid not in cancelled
+    owner.delete('/api/prefetch')
+    assert cancelled[-1] == owner_sid
+
+
+def test_hidden_files_in_results_are_not_served(client, app_module):
+    assert client.get('/results/.prefetch-secret').status_code == 404
+    assert client.get('/results/.cache.sqlite3').status_code == 404
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+from ratelimit import PRIORITY_BATCH, PRIORITY_INTERACTIVE, MemoryBuckets, RateLimiter, RateLimitTimeout
+
+
+class _SlowBuckets(MemoryBuckets):
+    """Bucket cuyo `take` se queda bloqueado como una escritura lenta en SQLite."""
+
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def take(self, model, rpm, now):
+        self.entered.set()
+        self.release.wait(5)
+        return super().take(model, rpm, now)
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_token_is_taken_outside_the_condition():
+    buckets = _SlowBuckets()
+    limiter = RateLimiter(buckets, default_rpm=60)
+    worker = threading.Thread(target=limiter.acquire, args=('m',))
+    worker.start()
+    assert buckets.entered.wait(5)
+    # Con `take` bloqueado, la contabilidad de la cola sigue disponible para los demás
+    seen = []
+    probe = threading.Thread(target=lambda: seen.append(limiter.stats()['waiting']))
+    probe.start()
+    probe.join(1)
+    buckets.release.set()
+    worker.join(5)
+    assert seen == [{'m': 1}]
+    assert limiter.stats()['granted'] == 1 and limiter.stats()['waiting'] == {}
+
+
+def test_waiters_are_served_by_priority():
+    buckets = _SlowBuckets()
+    limiter = RateLimiter(buckets, default_rpm=60)
+    order = []
+    first = threading.Thread(target=lambda: order.append(('first', limiter.acquire('m'))))
+    first.start()
+    assert buckets.entered.wait(5)
+    batch = threading.Thread(target=lambda: order.append(('batch', limiter.acquire('m', PRIORITY_BATCH))))
+    batch.start()
+    _wait_for(lambda: limiter.stats()['waiting'].get('m') == 2)
+    interactive = threading.Thread(target=lambda: order.append(('interactive', limiter.acquire('m', PRIORITY_INTERACTIVE))))
+    interactive.start()
+    _wait_for(lambda: limiter.stats()['waiting'].get('m') == 3)
+    buckets.release.set()
+    for t in (first, batch, interactive):
+        t.join(5)
+    assert [name for name, _waited in order] == ['first', 'interactive', 'batch']
+
+
+def test_acquire_times_out_without_tokens():
+    limiter = RateLimiter(MemoryBuckets(), default_rpm=1)
+    limiter.acquire('m', timeout=1)
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire('m', timeout=1)
+    assert limiter.stats()['waiting'] == {}
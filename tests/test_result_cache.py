@@ -0,0 +1,25 @@
+import os
+
+from result_cache import ResultCache
+
+
+def test_eviction_drops_index_rows_but_keeps_files(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=2)
+    first = cache.put('k1', b'uno')
+    cache.put('k2', b'dos')
+    cache.put('k3', b'tres')
+
+    assert cache.get('k1', count=False) is None
+    assert cache.stats()['evictions'] == 1
+    # El archivo desalojado sigue en disco: la galería o Firestore pueden enlazarlo
+    assert os.path.isfile(cache.path_for(first['filename']))
+    assert not cache.has_file(first['filename'])
+
+
+def test_shared_file_survives_while_any_key_points_to_it(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=1)
+    a = cache.put('a', b'mismo')
+    b = cache.put('b', b'mismo')
+    assert a['filename'] == b['filename']
+    assert cache.get('b', count=False) == b
+    assert os.path.isfile(cache.path_for(a['filename']))
@@ -0,0 +1,107 @@
+import json
+import os
+
+from batch import FIRESTORE_COMMIT_MAX_BYTES, record_size
+from writebehind import JOURNAL_PREFIX, WriteBehindBuffer
+
+# ~930 KB de base64: lo que llega a traer un registro con transformed_image_b64
+BIG = 'A' * (930 * 1024)
+
+
+class InvalidArgument(Exception):
+    code = 400
+
+
+class _FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.docs = []
+
+    def set(self, ref, record):
+        self.docs.append((ref, record))
+
+    def commit(self, timeout=None):
+        # Como Firestore: la petición entera no puede pasar de 10 MiB y no admite documentos inválidos
+        if sum(record_size(record) for _ref, record in self.docs) > 10 * 1024 * 1024:
+            raise InvalidArgument('Request payload size exceeds the limit')
+        if any(record.get('invalid') for _ref, record in self.docs):
+            raise InvalidArgument('Property invalid contains an invalid value')
+        self.db.commits.append(len(self.docs))
+        self.db.docs.update(self.docs)
+
+
+class _FakeDb:
+    def __init__(self):
+        self.commits = []
+        self.docs = {}
+
+    def collection(self, name):
+        return _FakeCollection(name)
+
+    def batch(self):
+        return _FakeBatch(self)
+
+
+class _FakeCollection:
+    def __init__(self, name):
+        self.name = name
+
+    def document(self, doc_id):
+        return self.name, doc_id
+
+
+def _buffer(tmp_path, db, **kwargs):
+    return WriteBehindBuffer(lambda: db, str(tmp_path), flush_interval_s=0, **kwargs)
+
+
+def test_batches_are_cut_by_bytes(tmp_path):
+    db = _FakeDb()
+    buffer = _buffer(tmp_path, db)
+    buffer.add_many('c', [{'i': i, 'transformed_image_b64': BIG} for i in range(30)])
+    assert buffer.flush(timeout=10)
+    buffer.close()
+    assert len(db.docs) == 30
+    assert max(db.commits) * record_size({'i': 0, 'transformed_image_b64': BIG}) <= FIRESTORE_COMMIT_MAX_BYTES
+    stats = buffer.stats()
+    assert (stats['failed_commits'], stats['spilled'], stats['invalid']) == (0, 0, 0)
+
+
+def test_invalid_document_is_isolated_and_dropped(tmp_path):
+    db = _FakeDb()
+    buffer = _buffer(tmp_path, db)
+    records = [{'i': i} for i in range(10)]
+    records[6]['invalid'] = True
+    buffer.add_many('c', records, [f"doc-{i}" for i in range(10)])
+    assert buffer.flush(timeout=10)
+    buffer.close()
+    assert sorted(doc_id for _c, doc_id in db.docs) == sorted(f"doc-{i}" for i in range(10) if i != 6)
+    stats = buffer.stats()
+    assert stats['invalid'] == 1 and stats['spilled'] == 0 and stats['journal_files'] == 0
+
+
+def test_document_over_the_size_limit_is_dropped_on_add(tmp_path):
+    db = _FakeDb()
+    buffer = _buffer(tmp_path, db)
+    buffer.add_many('c', [{'b64': 'A' * (2 * 1024 * 1024)}, {'ok': True}])
+    assert buffer.flush(timeout=10)
+    buffer.close()
+    assert len(db.docs) == 1
+    assert buffer.stats()['invalid'] == 1
+
+
+def test_journal_replay_splits_oversized_batches(tmp_path):
+    db = _FakeDb()
+    with open(os.path.join(tmp_path, f"{JOURNAL_PREFIX}999999.jsonl"), 'w', encoding='utf-8') as f:
+        for i in range(20):
+            f.write(json.dumps({'collection': 'c', 'id': f"doc-{i}",
+                                'record': {'i': i, 'transformed_image_b64': BIG}}) + '\n')
+    with open(os.path.join(tmp_path, f"{JOURNAL_PREFIX}bad.jsonl"), 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'collection': 'c', 'id': 'bad', 'record': {'invalid': True}}) + '\n')
+
+    buffer = _buffer(tmp_path, db)
+    buffer._replay()
+    buffer.close()
+    assert len(db.docs) == 20 and len(db.commits) >= 2
+    stats = buffer.stats()
+    assert stats['replayed'] == 21 and stats['invalid'] == 1
+    assert stats['journal_files'] == 0
@@ -0,0 +1,390 @@
+# Escrituras de Firestore en segundo plano (write-behind). Las rutas sólo encolan el documento y
+# responden; un hilo por worker los escribe con WriteBatch al juntar `batch_size` o pasado
+# `flush_interval_s` desde el más antiguo. Si el commit falla se reintenta con backoff exponencial;
+# tras varios fallos seguidos (o con la cola llena) los documentos se vuelcan a un journal JSONL en
+# disco y se reescriben cuando Firestore vuelve a responder. Cada documento lleva su id desde que
+# se encola, así que reintentos y re-lecturas del journal no crean duplicados. Los lotes se cortan
+# también por bytes; un commit que Firestore rechaza por inválido se parte en mitades hasta aislar
+# el documento culpable, que se descarta (reintentarlo o guardarlo en el journal no lo arregla).
+import atexit
+import glob
+import json
+import os
+import random
+import secrets
+import string
+import threading
+import time
+from collections import deque
+
+from batch import (FIRESTORE_BATCH_LIMIT, FIRESTORE_COMMIT_MAX_BYTES, FIRESTORE_DOC_MAX_BYTES,
+                   is_permanent_error, record_size)
+
+_ID_ALPHABET = string.ascii_letters + string.digits
+JOURNAL_PREFIX = '.firestore-journal-'
+
+
+def auto_id() -> str:
+    # Mismo formato que los ids automáticos de Firestore (20 caracteres alfanuméricos)
+    return ''.join(secrets.choice(_ID_ALPHABET) for _ in range(20))
+
+
+class WriteBehindBuffer:
+    def __init__(self, get_db, journal_dir: str, enabled: bool = True, batch_size: int = 100,
+                 flush_interval_s: float = 1.0, max_pending: int = 5000, retry_base_s: float = 1.0,
+                 retry_max_s: float = 60.0, spill_after: int = 3, commit_timeout_s: float = 10.0,
+                 max_bytes: int = FIRESTORE_COMMIT_MAX_BYTES):
+        self.get_db = get_db
+        self.journal_dir = journal_dir
+        self.enabled = enabled
+        self.batch_size = max(1, min(batch_size, FIRESTORE_BATCH_LIMIT))
+        self.max_bytes = max(FIRESTORE_DOC_MAX_BYTES, min(max_bytes, FIRESTORE_COMMIT_MAX_BYTES))
+        self.flush_interval_s = max(0.0, flush_interval_s)
+        self.max_pending = max(self.batch_size, max_pending)
+        self.retry_base_s = max(0.01, retry_base_s)
+        self.retry_max_s = max(self.retry_base_s, retry_max_s)
+        self.spill_after = max(1, spill_after)
+        self.commit_timeout_s = commit_timeout_s
+        # Cada cuánto se mira si hay journal que reescribir
+        self.replay_interval_s = 30.0
+        self.counts = {'queued': 0, 'written': 0, 'commits': 0, 'failed_commits': 0, 'spilled': 0,
+                       'replayed': 0, 'dropped': 0, 'invalid': 0}
+        os.makedirs(journal_dir, exist_ok=True)
+        self._reset_after_fork()
+        atexit.register(self.close)
+
+    def _reset_after_fork(self) -> None:
+        # La cola del padre la escribe el padre; el hijo empieza vacío y con su propio hilo
+        self._cond = threading.Condition()
+        self._pending: deque = deque()      # (colección, id, documento, instante en que se encoló, bytes)
+        self._thread = None
+        self._stopping = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self._last_replay = 0.0
+        self._journal_checked = False
+
+    # --- API ---
+
+    def add(self, collection: str, record: dict, doc_id: str | None = None) -> str | None:
+        """Encola un documento y devuelve su id. Sin Firestore configurado no hace nada (None)."""
+        doc_id = doc_id or auto_id()
+        if not self.enabled:
+            # Modo síncrono (FIRESTORE_WRITE_BEHIND=0): como antes, un set() en el hilo de la petición
+            try:
+                return doc_id if self._commit_isolating([(collection, doc_id, record)]) else None
+            except Exception as e:
+                print(f"[Firestore] No se pudo escribir el documento: {e}")
+                return None
+        self.add_many(collection, [record], [doc_id])
+        return doc_id
+
+    def add_many(self, collection: str, records: list[dict], doc_ids: list[str] | None = None) -> None:
+        now = time.monotonic()
+        items = []
+        for i, record in enumerate(records):
+            item = (collection, (doc_ids[i] if doc_ids else None) or auto_id(), record, now, record_size(record))
+            if item[4] > FIRESTORE_DOC_MAX_BYTES:
+                self._discard([item[:3]], f"{item[4]} bytes, más que el máximo de un documento")
+                continue
+            items.append(item)
+        spill = []
+        with self._cond:
+            self._pending.extend(items)
+            self.counts['queued'] += len(items)
+            # Cola llena (Firestore caído mucho tiempo): lo más antiguo va al journal
+            while len(self._pending) > self.max_pending:
+                spill.append(self._pending.popleft())
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        if spill:
+            self._spill(spill)
+        self._ensure_thread()
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Espera a que la cola se vacíe (commit o journal). True si quedó vacía a tiempo."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._retry_at = 0.0
+            self._cond.notify_all()
+            while self._pending and time.monotonic() < deadline:
+                self._cond.wait(timeout=0.05)
+            return not self._pending
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Al salir del proceso: último intento de escritura y, si no se puede, al journal."""
+        with self._cond:
+            self._stopping = True
+            self._retry_at = 0.0
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            leftover = list(self._pending)
+            self._pending.clear()
+        if leftover:
+            self._spill(leftover)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self.counts, enabled=self.enabled, pending=len(self._pending),
+                        failures=self._failures, journal_files=len(self._journal_files()))
+
+    # --- Hilo de escritura ---
+
+    def ensure_started(self) -> None:
+        """Arranca el hilo si hay journals pendientes de otra ejecución (primera petición del worker)."""
+        if self._journal_checked:
+            return
+        self._journal_checked = True
+        self._reclaim_orphans()
+        if self.enabled and self._thread is None and self._journal_files():
+            self._ensure_thread()
+
+    def _ensure_thread(self) -> None:
+        with self._cond:
+            if self._thread is not None or self._stopping:
+                return
+            self._thread = threading.Thread(target=self._run, name='firestore-writer', daemon=True)
+            self._thread.start()
+
+    def _take(self, queue: deque) -> list:
+        # Hasta `batch_size` documentos y `max_bytes` por commit (al menos uno)
+        batch, size = [], 0
+        while queue and len(batch) < self.batch_size:
+            if batch and size + queue[0][4] > self.max_bytes:
+                break
+            item = queue.popleft()
+            batch.append(item)
+            size += item[4]
+        return batch
+
+    def _next_batch(self) -> list | None:
+        """Espera a que toque escribir y saca un lote (`_take`). None al cerrar."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._stopping:
+                    # Al cerrar se intenta una vez lo que quede, sin esperar el backoff
+                    if not self._pending or self._failures:
+                        return None
+                    return self._take(self._pending)
+                if self._pending and now >= self._retry_at:
+                    due = self._pending[0][3] + self.flush_interval_s
+                    if len(self._pending) >= self.batch_size or now >= due:
+                        return self._take(self._pending)
+                    wait = due - now
+                elif self._pending:
+                    wait = self._retry_at - now
+                else:
+                    # Sin cola: de vez en cuando mirar si hay journal que reescribir
+                    wait = self.replay_interval_s
+                if not self._pending and self._journal_due(now):
+                    return []
+                self._cond.wait(timeout=max(0.01, wait))
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                self._replay()
+                continue
+            try:
+                if not self._commit_isolating([item[:3] for item in batch]):
+                    # Firestore no está configurado en este proceso: nada que escribir
+                    with self._cond:
+                        self.counts['dropped'] += len(batch)
+                        self._cond.notify_all()
+                    continue
+            except Exception as e:
+                self._on_failure(batch, e)
+                continue
+            with self._cond:
+                self._failures = 0
+                self._cond.notify_all()
+                replay = self._journal_due(time.monotonic())
+            # Firestore responde: reescribir lo que haya quedado en journals
+            if replay:
+                self._replay()
+
+    def _backoff_locked(self) -> int:
+        self._failures += 1
+        self.counts['failed_commits'] += 1
+        delay = min(self.retry_max_s, self.retry_base_s * (2 ** (self._failures - 1)))
+        # Jitter: los workers no reintentan todos a la vez
+        self._retry_at = time.monotonic() + delay * random.uniform(0.5, 1.0)
+        return self._failures
+
+    def _on_failure(self, batch: list, error: Exception) -> None:
+        with self._cond:
+            failures = self._backoff_locked()
+            if failures >= self.spill_after or self._stopping:
+                spill = batch + list(self._pending)
+                self._pending.clear()
+            else:
+                self._pending.extendleft(reversed(batch))
+                spill = []
+            self._cond.notify_all()
+        print(f"[Firestore] Falló un commit de {len(batch)} documentos ({failures} seguidos): {error}")
+        if spill:
+            self._spill(spill)
+
+    def _commit_isolating(self, items: list[tuple]) -> bool:
+        """Commit de `items`. Si Firestore lo rechaza por inválido, lo parte en mitades hasta aislar el
+        documento culpable y lo descarta. False sin Firestore; los errores transitorios se propagan."""
+        try:
+            return self._commit(items)
+        except Exception as e:
+            if not is_permanent_error(e):
+                raise
+            if len(items) == 1:
+                self._discard(items, e)
+                return True
+        mid = len(items) // 2
+        written = self._commit_isolating(items[:mid])
+        return self._commit_isolating(items[mid:]) or written
+
+    def _discard(self, items: list[tuple], reason) -> None:
+        with self._cond:
+            self.counts['invalid'] += len(items)
+        for collection, doc_id, _record in items:
+            print(f"[Firestore] Documento {collection}/{doc_id} descartado (inválido): {reason}")
+
+    def _commit(self, items: list[tuple]) -> bool:
+        db = self.get_db()
+        if db is None:
+            return False
+        wb = db.batch()
+        for collection, doc_id, record in items:
+            wb.set(db.collection(collection).document(doc_id), record)
+        wb.commit(timeout=self.commit_timeout_s)
+        with self._cond:
+            self.counts['written'] += len(items)
+            self.counts['commits'] += 1
+        return True
+
+    # --- Journal ---
+
+    def _journal_path(self) -> str:
+        return os.path.join(self.journal_dir, f"{JOURNAL_PREFIX}{os.getpid()}.jsonl")
+
+    def _journal_files(self) -> list[str]:
+        return sorted(glob.glob(os.path.join(self.journal_dir, f"{JOURNAL_PREFIX}*.jsonl")))
+
+    def _journal_due(self, now: float) -> bool:
+        # Tras un fallo, la reescritura del journal espera al backoff y hace de sondeo
+        if now < self._retry_at or now - self._last_replay < self.replay_interval_s:
+            return False
+        self._last_replay = now
+        self._reclaim_orphans()
+        return bool(self._journal_files())
+
+    def _spill(self, items: list) -> None:
+        try:
+            with open(self._journal_path(), 'a', encoding='utf-8') as f:
+                for item in items:
+                    f.write(json.dumps({'collection': item[0], 'id': item[1], 'record': item[2]},
+                                       ensure_ascii=False, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            with self._cond:
+                self.counts['dropped'] += len(items)
+            print(f"[Firestore] No se pudieron guardar {len(items)} documentos en el journal: {e}")
+            return
+        with self._cond:
+            self.counts['spilled'] += len(items)
+        print(f"[Firestore] {len(items)} documentos guardados en el journal")
+
+    def _reclaim_orphans(self) -> None:
+        # Journals a medio reescribir por un proceso que ya no existe vuelven a estar disponibles
+        for claimed in glob.glob(os.path.join(self.journal_dir, f"{JOURNAL_PREFIX}*.jsonl.replay-*")):
+            try:
+                pid = int(claimed.rsplit('-', 1)[1])
+                if pid == os.getpid():
+                    continue
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                try:
+                    os.rename(claimed, claimed.rsplit('.replay-', 1)[0])
+                except OSError:
+                    pass
+            except Exception:
+                continue
+
+    def _replay(self) -> None:
+        for path in self._journal_files():
+            # Renombrar reclama el archivo: con varios workers sólo uno lo reescribe
+            claimed = f"{path}.replay-{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            items = []
+            try:
+                with open(claimed, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                            items.append((entry['collection'], entry['id'], entry['record'], 0.0,
+                                          record_size(entry['record'])))
+                        except Exception:
+                            continue
+                queue = deque(items)
+                while queue:
+                    chunk = self._take(queue)
+                    try:
+                        if not self._commit_isolating([item[:3] for item in chunk]):
+                            raise RuntimeError('Firestore no disponible')
+                    except Exception as e:
+                        # Lo que falta vuelve al journal de este proceso para el próximo intento
+                        self._spill(chunk + list(queue))
+                        with self._cond:
+                            self._backoff_locked()
+                        print(f"[Firestore] Reescritura del journal interrumpida: {e}")
+                        os.remove(claimed)
+                        return
+                    with self._cond:
+                        self.counts['replayed'] += len(chunk)
+                        self._failures = 0
+                os.remove(claimed)
+                print(f"[Firestore] {len(items)} documentos reescritos desde {os.path.basename(path)}")
+            except Exception as e:
+                print(f"[Firestore] No se pudo leer el journal {os.path.basename(path)}: {e}")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except Exception:
+        return default
+
+
+def create_write_behind(get_db, journal_dir: str) -> WriteBehindBuffer:
+    """FIRESTORE_WRITE_BEHIND=0 vuelve a las escrituras síncronas. FIRESTORE_BATCH_SIZE documentos por
+    commit (y a lo sumo FIRESTORE_COMMIT_MAX_BYTES) o FIRESTORE_FLUSH_INTERVAL_S de espera máxima;
+    FIRESTORE_MAX_PENDING en memoria;
+    backoff FIRESTORE_RETRY_BASE_S..FIRESTORE_RETRY_MAX_S y journal tras FIRESTORE_SPILL_AFTER fallos."""
+    buffer = WriteBehindBuffer(
+        get_db,
+        journal_dir,
+        enabled=os.environ.get('FIRESTORE_WRITE_BEHIND', '1').strip().lower() not in ('0', 'false', 'no'),
+        batch_size=int(_env_float('FIRESTORE_BATCH_SIZE', 100)),
+        flush_interval_s=_env_float('FIRESTORE_FLUSH_INTERVAL_S', 1.0),
+        max_pending=int(_env_float('FIRESTORE_MAX_PENDING', 5000)),
+        retry_base_s=_env_float('FIRESTORE_RETRY_BASE_S', 1.0),
+        retry_max_s=_env_float('FIRESTORE_RETRY_MAX_S', 60.0),
+        spill_after=int(_env_float('FIRESTORE_SPILL_AFTER', 3)),
+        commit_timeout_s=_env_float('FIRESTORE_COMMIT_TIMEOUT_S', 10.0),
+        max_bytes=int(_env_float('FIRESTORE_COMMIT_MAX_BYTES', FIRESTORE_COMMIT_MAX_BYTES)),
+    )
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=buffer._reset_after_fork)
+    return buffer